@@ -0,0 +1,366 @@
+"""
+    sanic_dispatcher benchmarks
+    ~~~~
+
+    Measures the per-request overhead of the dispatcher against a plain Sanic app.
+
+    Every scenario runs offline, on a loopback server in this process, with one keep-alive
+    connection sending requests one at a time. The routing and url_for scenarios don't go
+    through a server at all. Those without a suffix repeat the same lookup, so after the
+    first call they measure the warm routing and url_for caches. The _uncached and _cold
+    variants miss the caches on every call. Results are written out as JSON, so runs can
+    be compared across releases:
+
+        python benchmarks/bench_dispatcher.py --output before.json
+        python benchmarks/bench_dispatcher.py --output after.json --compare before.json
+
+    :copyright: (c) 2017 by Ashley Sommer (based on DispatcherMiddleware in the Werkzeug Project).
+    :license: MIT, see LICENSE for more details.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import socket
+import statistics
+import sys
+from itertools import count
+from time import perf_counter
+
+from sanic import Sanic, response, __version__ as sanic_version
+from sanic_dispatcher import SanicDispatcherMiddlewareController, __version__ as dispatcher_version
+
+_app_ids = count()
+
+
+def _new_app(prefix):
+    # Sanic 21.03+ refuses two apps with the same name
+    return Sanic("{}_{}".format(prefix, next(_app_ids)))
+
+
+def _sanic_child(prefix):
+    child = _new_app(prefix)
+
+    @child.route("/test")
+    async def child_index(request):
+        return response.text("child")
+    return child
+
+
+def _parent_with_dispatcher(middleware=False):
+    parent = _new_app("parent")
+
+    @parent.route("/test")
+    async def parent_index(request):
+        return response.text("parent")
+
+    if middleware:
+        @parent.middleware("request")
+        async def request_mw(request):
+            return None
+
+        @parent.middleware("response")
+        async def response_mw(request, resp):
+            return None
+    return parent, SanicDispatcherMiddlewareController(parent)
+
+
+def _wsgi_app(body):
+    headers = [("Content-Type", "application/octet-stream"), ("Content-Length", str(len(body)))]
+
+    def wsgi_app(environ, start_response):
+        start_response("200 OK", headers)
+        return [body]
+    return wsgi_app
+
+
+# Each scenario builder returns (app, path, headers)
+
+def plain_sanic():
+    app = _new_app("plain")
+
+    @app.route("/test")
+    async def index(request):
+        return response.text("plain")
+    return app, "/test", {}
+
+
+def parent_route(mounts=10):
+    parent, dispatcher = _parent_with_dispatcher()
+    for i in range(mounts):
+        dispatcher.register_sanic_application(_sanic_child("child"), "/child{}".format(i))
+    return parent, "/test", {}
+
+
+def mount_depth(depth):
+    def build():
+        parent, dispatcher = _parent_with_dispatcher()
+        prefix = "".join("/level{}".format(i) for i in range(depth))
+        dispatcher.register_sanic_application(_sanic_child("child"), prefix)
+        return parent, prefix + "/test", {}
+    return build
+
+
+def mount_count(mounts):
+    def build():
+        parent, dispatcher = _parent_with_dispatcher()
+        for i in range(mounts):
+            dispatcher.register_sanic_application(_sanic_child("child"), "/child{}".format(i))
+        return parent, "/child{}/test".format(mounts - 1), {}
+    return build
+
+
+def host_mount():
+    parent, dispatcher = _parent_with_dispatcher()
+    dispatcher.register_sanic_application(_sanic_child("child"), "/child")
+    dispatcher.register_sanic_application(_sanic_child("hosted"), "/child", host="example.com")
+    return parent, "/child/test", {"Host": "example.com"}
+
+
+def apply_middleware(enabled):
+    def build():
+        parent, dispatcher = _parent_with_dispatcher(middleware=True)
+        dispatcher.register_sanic_application(_sanic_child("child"), "/child", apply_middleware=enabled)
+        return parent, "/child/test", {}
+    return build
+
+
+def wsgi_body(size, stream_response=False):
+    def build():
+        parent, dispatcher = _parent_with_dispatcher()
+        dispatcher.register_wsgi_application(_wsgi_app(b"x" * size), "/wsgichild", stream_response=stream_response)
+        return parent, "/wsgichild/test", {}
+    return build
+
+
+SERVER_SCENARIOS = [
+    ("plain_sanic", plain_sanic),
+    ("parent_route_10_mounts", parent_route),
+    ("sanic_child_depth_1", mount_depth(1)),
+    ("sanic_child_depth_4", mount_depth(4)),
+    ("sanic_child_depth_16", mount_depth(16)),
+    ("sanic_child_1_mount", mount_count(1)),
+    ("sanic_child_10_mounts", mount_count(10)),
+    ("sanic_child_100_mounts", mount_count(100)),
+    ("sanic_child_host_mount", host_mount),
+    ("sanic_child_middleware_off", apply_middleware(False)),
+    ("sanic_child_middleware_on", apply_middleware(True)),
+    ("wsgi_small_body", wsgi_body(16)),
+    ("wsgi_large_body", wsgi_body(1024 * 1024)),
+    ("wsgi_large_body_streamed", wsgi_body(1024 * 1024, stream_response=True)),
+]
+
+
+async def _read_response(reader):
+    head = await reader.readuntil(b"\r\n\r\n")
+    status = int(head.split(b" ", 2)[1])
+    headers = {}
+    for line in head.split(b"\r\n")[1:]:
+        if line:
+            name, _, value = line.partition(b":")
+            headers[name.strip().lower()] = value.strip()
+    if b"content-length" in headers:
+        await reader.readexactly(int(headers[b"content-length"]))
+    elif headers.get(b"transfer-encoding") == b"chunked":
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    return status
+
+
+async def _send_requests(port, path, headers, total):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    lines = ["GET {} HTTP/1.1".format(path)]
+    if "Host" not in headers:
+        lines.append("Host: 127.0.0.1:{}".format(port))
+    lines.extend("{}: {}".format(name, value) for name, value in headers.items())
+    raw_request = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+    timings = []
+    try:
+        for _ in range(total):
+            started = perf_counter()
+            writer.write(raw_request)
+            status = await _read_response(reader)
+            timings.append(perf_counter() - started)
+            if status != 200:
+                raise RuntimeError("{} returned status {}".format(path, status))
+    finally:
+        writer.close()
+    return timings
+
+
+def run_server_scenario(build, requests, warmup):
+    app, path, headers = build()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    # create_server() runs the before_server_start listeners and starts listening
+    server = loop.run_until_complete(app.create_server(sock=sock, access_log=False, return_asyncio_server=True))
+    try:
+        server.after_start()
+        loop.run_until_complete(_send_requests(port, path, headers, warmup))
+        return loop.run_until_complete(_send_requests(port, path, headers, requests))
+    finally:
+        server.before_stop()
+        close_task = server.close()
+        if close_task is not None:
+            loop.run_until_complete(close_task)
+        server.after_stop()
+        loop.close()
+
+
+def _timed_calls(func, requests, warmup):
+    for _ in range(warmup):
+        func()
+    timings = []
+    for _ in range(requests):
+        started = perf_counter()
+        func()
+        timings.append(perf_counter() - started)
+    return timings
+
+
+def routing_scenario(mounts, depth, hosted=False, cached=True):
+    def run(requests, warmup):
+        parent, dispatcher = _parent_with_dispatcher()
+        suffix = "".join("/level{}".format(i) for i in range(depth - 1))
+        for i in range(mounts):
+            dispatcher.register_sanic_application(_sanic_child("child"), "/child{}{}".format(i, suffix),
+                                                  host="example.com" if hosted else None)
+        router = parent.handle_request.router
+        prefix = "/child{}{}".format(mounts - 1, suffix)
+        if cached:
+            path = "{}/test".format(prefix).encode()
+            return _timed_calls(lambda: router.match("example.com", path), requests, warmup)
+        # A different path below the mount every time, so each match misses the routing table's cache
+        paths = iter(["{}/item{}".format(prefix, i).encode() for i in range(warmup + requests)])
+        return _timed_calls(lambda: router.match("example.com", next(paths)), requests, warmup)
+    return run
+
+
+def url_for_scenario(mounts, with_args, cache="warm"):
+    """
+    :param cache: "warm" repeats the same call, "uncached" passes a new item_id every time so each call
+                  misses the url cache, and "cold" also forgets which app owns each view before every call,
+                  as a mount change does
+    """
+    def run(requests, warmup):
+        parent, dispatcher = _parent_with_dispatcher()
+        for i in range(mounts):
+            child = _new_app("child")
+
+            @child.route("/item/<item_id>")
+            async def item(request, item_id):
+                return response.text(item_id)
+
+            @child.route("/")
+            async def index(request):
+                return response.text("index")
+            dispatcher.register_sanic_application(child, "/child{}".format(i))
+        item_ids = count() if cache != "warm" else None
+
+        def call():
+            if cache == "cold":
+                dispatcher._clear_url_index()
+            if not with_args:
+                return parent.url_for("index")
+            return parent.url_for("item", item_id=1 if item_ids is None else next(item_ids))
+        return _timed_calls(call, requests, warmup)
+    return run
+
+
+LOCAL_SCENARIOS = [
+    ("routing_1_mount_depth_1", routing_scenario(1, 1)),
+    ("routing_100_mounts_depth_1", routing_scenario(100, 1)),
+    ("routing_100_mounts_depth_8", routing_scenario(100, 8)),
+    ("routing_100_host_mounts_depth_1", routing_scenario(100, 1, hosted=True)),
+    ("routing_100_mounts_depth_8_uncached", routing_scenario(100, 8, cached=False)),
+    ("routing_100_host_mounts_depth_1_uncached", routing_scenario(100, 1, hosted=True, cached=False)),
+    ("url_for_30_mounts_no_args", url_for_scenario(30, False)),
+    ("url_for_30_mounts_with_args", url_for_scenario(30, True)),
+    ("url_for_30_mounts_with_args_uncached", url_for_scenario(30, True, cache="uncached")),
+    ("url_for_30_mounts_no_args_cold", url_for_scenario(30, False, cache="cold")),
+    ("url_for_30_mounts_with_args_cold", url_for_scenario(30, True, cache="cold")),
+]
+
+
+def summarize(name, timings):
+    timings_us = sorted(t * 1e6 for t in timings)
+    n = len(timings_us)
+    return {
+        "name": name,
+        "requests": n,
+        "mean_us": statistics.mean(timings_us),
+        "median_us": statistics.median(timings_us),
+        "p90_us": timings_us[int(n * 0.9) - 1],
+        "p99_us": timings_us[int(n * 0.99) - 1],
+        "min_us": timings_us[0],
+        "stdev_us": statistics.stdev(timings_us) if n > 1 else 0.0,
+        "per_second": n / sum(timings),
+    }
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {result["name"]: result for result in json.load(f)["results"]}
+    for result in results:
+        previous = baseline.get(result["name"], None)
+        if previous is None:
+            continue
+        change = (result["median_us"] - previous["median_us"]) / previous["median_us"] * 100.0
+        result["baseline_median_us"] = previous["median_us"]
+        result["change_percent"] = change
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Sanic-Dispatcher per-request overhead.")
+    parser.add_argument("--requests", type=int, default=2000, help="timed requests per scenario")
+    parser.add_argument("--warmup", type=int, default=200, help="untimed requests before each scenario")
+    parser.add_argument("--filter", default=None, help="only run scenarios whose name contains this")
+    parser.add_argument("--output", default=None, help="write the JSON results to this file, not stdout")
+    parser.add_argument("--compare", default=None, help="a previous JSON result to compare the medians against")
+    args = parser.parse_args(argv)
+
+    results = []
+    for name, build in SERVER_SCENARIOS:
+        if args.filter and args.filter not in name:
+            continue
+        print("running {}".format(name), file=sys.stderr)
+        results.append(summarize(name, run_server_scenario(build, args.requests, args.warmup)))
+    for name, run in LOCAL_SCENARIOS:
+        if args.filter and args.filter not in name:
+            continue
+        print("running {}".format(name), file=sys.stderr)
+        results.append(summarize(name, run(args.requests, args.warmup)))
+
+    baseline = next((result for result in results if result["name"] == "plain_sanic"), None)
+    if baseline is not None:
+        for result in results:
+            if result["name"] in dict(SERVER_SCENARIOS):
+                result["overhead_us"] = result["median_us"] - baseline["median_us"]
+    if args.compare:
+        compare(results, args.compare)
+
+    report = {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "sanic": sanic_version,
+        "sanic_dispatcher": dispatcher_version,
+        "settings": {"requests": args.requests, "warmup": args.warmup},
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
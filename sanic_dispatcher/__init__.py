@@ -7,7 +7,11 @@
     :license: MIT, see LICENSE for more details.
 """
 from .extension import SanicDispatcherMiddleware, SanicDispatcherMiddlewareController
+from .cache import RequestCoalescer, ResponseCache
+from .metrics import DispatcherMetrics
+from .snapshot import MountSnapshot
 from .version import __version__
 
-__all__ = ['SanicDispatcherMiddleware', 'SanicDispatcherMiddlewareController']
+__all__ = ['SanicDispatcherMiddleware', 'SanicDispatcherMiddlewareController', 'DispatcherMetrics', 'ResponseCache',
+           'RequestCoalescer', 'MountSnapshot']
 
@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+"""
+    sanic_dispatcher.cache
+    ~~~~
+
+    Opt-in, per-mount response caching and request coalescing for buffered WSGI responses.
+
+    :copyright: (c) 2017 by Ashley Sommer (based on DispatcherMiddleware in the Werkzeug Project).
+    :license: MIT, see LICENSE for more details.
+"""
+from asyncio import CancelledError, get_event_loop, shield
+from collections import OrderedDict
+from functools import partial
+from time import monotonic
+
+from sanic.response import HTTPResponse
+try:
+    from sanic.compat import Header
+except ImportError:
+    try:
+        from multidict import CIMultiDict as Header
+    except ImportError:
+        Header = dict
+
+# Headers which are copied from the full response onto a 304 Not Modified response
+_NOT_MODIFIED_HEADERS = ('Cache-Control', 'Content-Location', 'Date', 'ETag', 'Expires', 'Vary')
+
+
+def _parse_cache_control(value):
+    """
+    :param str value: a Cache-Control header value, or None
+    :return: a dict of lowercased directive names to their argument, which is '' for directives without one
+    """
+    directives = {}
+    if value:
+        for part in value.split(','):
+            name, _, argument = part.strip().partition('=')
+            if name:
+                directives[name.lower()] = argument.strip().strip('"')
+    return directives
+
+
+def _opaque_tag(etag):
+    etag = etag.strip()
+    # If-None-Match uses the weak comparison, so W/"x" matches "x"
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+def _etag_matches(if_none_match, etag):
+    if not if_none_match or etag is None:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    etag = _opaque_tag(etag)
+    return any(_opaque_tag(tag) == etag for tag in if_none_match.split(','))
+
+
+def _not_modified(headers):
+    not_modified_headers = Header()
+    for name in _NOT_MODIFIED_HEADERS:
+        value = headers.get(name, None)
+        if value is not None:
+            not_modified_headers[name] = value
+    return HTTPResponse(status=304, headers=not_modified_headers)
+
+
+def _copy_response(response):
+    return HTTPResponse(response.body, response.status, Header(response.headers), response.content_type)
+
+
+class SingleFlight(object):
+    """
+    Runs at most one call per key at a time. Calls made for a key while its call is in flight wait for that
+    call, and get its result, or its exception, instead of running again. If the call in flight is
+    cancelled, the next waiter runs the call itself.
+    """
+    __slots__ = ['calls', 'shared']
+
+    def __init__(self):
+        # Maps each key in flight to a future, which gets the call's result
+        self.calls = {}
+        # How many calls were answered with the result or exception of another call
+        self.shared = 0
+
+    def __contains__(self, key):
+        return key in self.calls
+
+    async def wait(self, key):
+        """
+        Waits for the call in flight for this key to finish, without taking its result.
+        :return: True if there was a call in flight
+        """
+        future = self.calls.get(key, None)
+        if future is None:
+            return False
+        try:
+            await shield(future)
+        except CancelledError:
+            if not future.cancelled():
+                raise
+        except Exception:
+            pass
+        return True
+
+    async def run(self, key, call):
+        """
+        :param key: a hashable key, equal for calls which can share a result
+        :param call: a coroutine function
+        :return: the result of call(), or of the call already in flight for this key
+        """
+        while True:
+            future = self.calls.get(key, None)
+            if future is None:
+                break
+            try:
+                result = await shield(future)
+            except CancelledError:
+                if future.cancelled():
+                    # The call in flight was given up, so try again, maybe running it this time
+                    continue
+                raise
+            except Exception:
+                self.shared += 1
+                raise
+            self.shared += 1
+            return result
+        future = self.calls[key] = get_event_loop().create_future()
+        try:
+            result = await call()
+        except CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Marks the exception as retrieved, so it isn't logged when nothing was waiting for it
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self.calls[key]
+
+
+class RequestCoalescer(object):
+    """
+    Lets identical GET and HEAD requests to one mount which arrive while the first of them is being handled
+    share that first request's buffered response, instead of each calling the app. Requests are identical
+    when their method, host, path, query string, and values of the chosen `key_headers` all match.
+
+    Requests with a Cookie or Authorization header may get a response meant for one client only. How they
+    are coalesced depends on `private`:
+      'bypass' - they are never coalesced
+      'key' - they are only coalesced with requests which have the same Cookie and Authorization headers
+      'share' - the headers are ignored, and they are coalesced like any other request
+    """
+    __slots__ = ['key_headers', 'private', 'flights', 'bypassed']
+
+    methods = frozenset(('GET', 'HEAD'))
+    private_headers = ('Cookie', 'Authorization')
+    private_policies = ('bypass', 'key', 'share')
+
+    def __init__(self, key_headers=None, private='bypass'):
+        """
+        :param key_headers: Names of request headers which the response depends on
+        :param str private: How to treat requests with a Cookie or Authorization header
+        """
+        assert private in self.private_policies, \
+            "private must be one of {}.".format(", ".join(self.private_policies))
+        key_headers = tuple(key_headers or ())
+        if private == 'key':
+            key_headers += self.private_headers
+        self.key_headers = key_headers
+        self.private = private
+        self.flights = SingleFlight()
+        # Requests which were not coalesced because they carried a Cookie or Authorization header
+        self.bypassed = 0
+
+    def _request_key(self, request, script_name, path_info):
+        if request.method not in self.methods:
+            return None
+        headers = request.headers
+        if self.private == 'bypass':
+            for name in self.private_headers:
+                if name in headers:
+                    self.bypassed += 1
+                    return None
+        return (request.method, headers.get('Host', ''), script_name, path_info, request.query_string,
+                tuple(headers.get(name, None) for name in self.key_headers))
+
+    async def fetch(self, request, script_name, path_info, call):
+        """
+        :param request: the Sanic request
+        :param str script_name: the mount prefix the request matched
+        :param str path_info: the rest of the path
+        :param call: a coroutine function which calls the app, and returns its buffered HTTPResponse
+        :return: the HTTPResponse to send
+        """
+        key = self._request_key(request, script_name, path_info)
+        if key is None:
+            return await call()
+        response = await self.flights.run(key, call)
+        # Every request gets its own copy, as middleware may change the response while it is sent
+        return _copy_response(response)
+
+    def stats(self):
+        return {'in_flight': len(self.flights.calls), 'shared': self.flights.shared, 'bypassed': self.bypassed}
+
+
+class CachedResponse(object):
+    __slots__ = ['status', 'headers', 'body', 'content_type', 'etag', 'stored', 'expires', 'size']
+
+    # Rough bookkeeping cost of one entry, on top of its body and headers
+    overhead = 256
+
+    def __init__(self, response, ttl, now):
+        self.status = response.status
+        self.headers = Header(response.headers)
+        self.body = response.body or b''
+        self.content_type = response.content_type
+        self.etag = self.headers.get('ETag', None)
+        self.stored = now
+        self.expires = now + ttl
+        self.size = len(self.body) + self.overhead + \
+            sum(len(name) + len(str(value)) for name, value in self.headers.items())
+
+    def respond(self, request, now):
+        # Only a 200 is turned into a 304, as with a response fresh from the app
+        if self.status == 200 and _etag_matches(request.headers.get('If-None-Match', None), self.etag):
+            return _not_modified(self.headers)
+        headers = Header(self.headers)
+        headers['Age'] = str(int(now - self.stored))
+        return HTTPResponse(self.body, self.status, headers, self.content_type)
+
+
+class ResponseCache(object):
+    """
+    An in-memory LRU cache of one mount's buffered GET and HEAD responses, bounded by the total size of the
+    cached responses. Only responses which the app marks as cacheable by a shared cache, with
+    Cache-Control max-age or s-maxage, are stored, unless a default TTL is given. Responses are stored once
+    per combination of the request headers named in their Vary header. Conditional requests are answered
+    with 304 Not Modified when their If-None-Match matches the response's ETag. Concurrent misses for the
+    same request wait for the first one to fetch the response, rather than each calling the app.
+    """
+    __slots__ = ['max_bytes', 'default_ttl', 'entries', 'vary', 'size', 'flights', 'hits', 'misses',
+                 'coalesced', 'not_modified', 'evictions']
+
+    cacheable_methods = frozenset(('GET', 'HEAD'))
+    cacheable_statuses = frozenset((200, 203, 300, 301, 404, 410))
+    # Requests with these headers get responses meant for one client only, so they skip the cache
+    private_request_headers = ('Authorization',)
+
+    def __init__(self, max_bytes, default_ttl=0):
+        """
+        :param int max_bytes: The most the cached responses may take up, in bytes
+        :param default_ttl: Seconds to keep responses which don't say how long they are fresh for
+        """
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl or 0
+        # Maps (request key, values of the Vary headers) to a CachedResponse, least recently used first
+        self.entries = OrderedDict()
+        # Maps each request key to [the header names its responses vary on, the number of entries stored]
+        self.vary = {}
+        self.size = 0
+        # The request keys which are being fetched from the app
+        self.flights = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.not_modified = 0
+        self.evictions = 0
+
+    def _request_key(self, request, script_name, path_info):
+        if request.method not in self.cacheable_methods:
+            return None
+        headers = request.headers
+        for name in self.private_request_headers:
+            if name in headers:
+                return None
+        return request.method, headers.get('Host', ''), script_name, path_info, request.query_string
+
+    def _entry_key(self, key, headers):
+        vary = self.vary.get(key, None)
+        if vary is None:
+            return key, ()
+        return key, tuple(headers.get(name, None) for name in vary[0])
+
+    def _lookup(self, key, headers, now):
+        entry_key = self._entry_key(key, headers)
+        entry = self.entries.get(entry_key, None)
+        if entry is None:
+            return None
+        if entry.expires <= now:
+            self._remove(entry_key)
+            return None
+        self.entries.move_to_end(entry_key)
+        return entry
+
+    def _remove(self, entry_key):
+        entry = self.entries.pop(entry_key)
+        self.size -= entry.size
+        key = entry_key[0]
+        vary = self.vary[key]
+        vary[1] -= 1
+        if not vary[1]:
+            del self.vary[key]
+
+    def _ttl(self, response):
+        cache_control = _parse_cache_control(response.headers.get('Cache-Control', None))
+        if 'no-store' in cache_control or 'no-cache' in cache_control or 'private' in cache_control:
+            return 0
+        max_age = cache_control.get('s-maxage', None)
+        if max_age is None:
+            max_age = cache_control.get('max-age', None)
+        if max_age is None:
+            return self.default_ttl
+        try:
+            return int(max_age)
+        except ValueError:
+            return 0
+
+    def _store(self, key, headers, response, now):
+        if response.status not in self.cacheable_statuses:
+            return
+        response_headers = response.headers
+        if 'Set-Cookie' in response_headers:
+            return
+        ttl = self._ttl(response)
+        if ttl <= 0:
+            return
+        vary = tuple(sorted({name.strip().lower() for name in response_headers.get('Vary', '').split(',')
+                             if name.strip()}))
+        if '*' in vary:
+            return
+        entry = CachedResponse(response, ttl, now)
+        if entry.size > self.max_bytes:
+            return
+        known = self.vary.get(key, None)
+        if known is not None and known[0] != vary:
+            # The app changed which headers the response varies on, so the old entries can't be looked up
+            for entry_key in [entry_key for entry_key in self.entries if entry_key[0] == key]:
+                self._remove(entry_key)
+        entry_key = (key, tuple(headers.get(name, None) for name in vary))
+        if entry_key in self.entries:
+            self._remove(entry_key)
+        vary_count = self.vary.setdefault(key, [vary, 0])
+        vary_count[1] += 1
+        self.entries[entry_key] = entry
+        self.size += entry.size
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def _conditional(self, request, response):
+        if response.status == 200 and \
+                _etag_matches(request.headers.get('If-None-Match', None), response.headers.get('ETag', None)):
+            self.not_modified += 1
+            return _not_modified(response.headers)
+        return response
+
+    async def fetch(self, request, script_name, path_info, call):
+        """
+        Answers the request from the cache, or calls the app and caches its response.
+        :param request: the Sanic request
+        :param str script_name: the mount prefix the request matched
+        :param str path_info: the rest of the path
+        :param call: a coroutine function which calls the app, and returns its buffered HTTPResponse
+        :return: the HTTPResponse to send
+        """
+        key = self._request_key(request, script_name, path_info)
+        if key is None:
+            return await call()
+        headers = request.headers
+        request_cache_control = _parse_cache_control(headers.get('Cache-Control', None))
+        if 'no-store' in request_cache_control:
+            return await call()
+        revalidate = 'no-cache' in request_cache_control or request_cache_control.get('max-age', None) == '0' \
+            or 'no-cache' in headers.get('Pragma', '')
+        if not revalidate:
+            now = monotonic()
+            entry = self._lookup(key, headers, now)
+            if entry is None:
+                # Wait for the request which is already fetching it. If its response turns out not to be
+                # cacheable, or to vary on headers this request doesn't share, this request fetches its own.
+                if await self.flights.wait(key):
+                    now = monotonic()
+                    entry = self._lookup(key, headers, now)
+                    if entry is not None:
+                        self.coalesced += 1
+            else:
+                self.hits += 1
+            if entry is not None:
+                response = entry.respond(request, now)
+                if response.status == 304:
+                    self.not_modified += 1
+                return response
+        self.misses += 1
+        if key in self.flights:
+            # Another request is fetching it, but this one can't use its response
+            response = await self._fetch_and_store(key, headers, call)
+        else:
+            response = await self.flights.run(key, partial(self._fetch_and_store, key, headers, call))
+        return self._conditional(request, response)
+
+    async def _fetch_and_store(self, key, headers, call):
+        response = await call()
+        self._store(key, headers, response, monotonic())
+        return response
+
+    def clear(self):
+        self.entries.clear()
+        self.vary.clear()
+        self.size = 0
+
+    def stats(self):
+        """
+        :return: a dict of the cache's counters and current size
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced,
+                'not_modified': self.not_modified, 'evictions': self.evictions,
+                'entries': len(self.entries), 'bytes': self.size}
@@ -6,20 +6,31 @@
     :copyright: (c) 2017 by Ashley Sommer (based on DispatcherMiddleware in the Werkzeug Project).
     :license: MIT, see LICENSE for more details.
 """
-from collections import defaultdict
-from inspect import isawaitable
+import re
+import sys
+from asyncio import CancelledError, Event, Queue, QueueFull, TimeoutError, ensure_future, gather, get_event_loop, \
+    run_coroutine_threadsafe, shield, sleep, wait_for
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from importlib import import_module
+from inspect import isawaitable, iscoroutinefunction
 from io import BytesIO
-from warnings import warn
+from time import monotonic, perf_counter
+from urllib.parse import quote, unquote
 try:
     from setuptools.extern import packaging
 except ImportError:
     from pkg_resources.extern import packaging
 
 from sanic import Sanic, __version__ as sanic_version
-from sanic.exceptions import URLBuildError
-from sanic.response import HTTPResponse, BaseHTTPResponse
-from sanic.server import HttpProtocol
-from sanic.websocket import WebSocketProtocol
+from sanic.exceptions import SanicException, URLBuildError, ServiceUnavailable
+from sanic.response import HTTPResponse, BaseHTTPResponse, StreamingHTTPResponse
+
+from .cache import RequestCoalescer, ResponseCache, SingleFlight
+from .metrics import DispatcherMetrics
+from .snapshot import MountSnapshot
 
 SANIC_VERSION = packaging.version.parse(sanic_version)
 SANIC_0_7_0 = packaging.version.parse('0.7.0')
@@ -32,29 +43,716 @@ IS_19_03 = SANIC_VERSION >= SANIC_19_03_0
 IS_18_12 = SANIC_VERSION >= SANIC_18_12_0
 IS_21_03 = SANIC_VERSION >= SANIC_21_03_0
 if IS_19_03:
-    from sanic.request import RequestParameters
-    from sanic.log import error_logger
+    from sanic.log import error_logger, logger
 else:
     import logging
     error_logger = logging.getLogger("sanic.error")
+    logger = logging.getLogger("sanic.root")
 if IS_21_03:
     from sanic.compat import CancelledErrors
+try:
+    from sanic.compat import Header
+except ImportError:
+    try:
+        from multidict import CIMultiDict as Header
+    except ImportError:
+        Header = dict
+
+class WsgiExecutor(object):
+    """
+    A dedicated thread pool for one WSGI child application. Calls which arrive when every worker is busy
+    and the queue is already full are refused immediately with a 503, rather than waiting for a worker.
+    """
+    __slots__ = ['max_workers', 'max_queue', 'pending', 'executor']
+
+    def __init__(self, max_workers, max_queue=None):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.pending = 0
+        self.executor = None
+
+    def start(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+    def shutdown(self, wait=False):
+        executor = self.executor
+        self.executor = None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def acquire(self):
+        """Admits one WSGI request, which may then make any number of run() calls until release()."""
+        if self.max_queue is not None and self.pending >= self.max_workers + self.max_queue:
+            raise ServiceUnavailable("The WSGI application is too busy to handle this request.")
+        self.pending += 1
+
+    def release(self):
+        self.pending -= 1
+
+    async def run(self, loop, func, *args):
+        if self.executor is None:
+            self.start()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+
+# The WSGI app of a process pool worker, set up by _init_wsgi_process when the worker starts
+_process_wsgi_app = None
+
+
+def _resolve_wsgi_app(app_ref):
+    """
+    :param app_ref: a WSGI app, or an import string for one, like 'package.module:app'
+    """
+    if not isinstance(app_ref, str):
+        return app_ref
+    module_name, _, attr = app_ref.partition(':')
+    app = import_module(module_name)
+    for part in (attr or 'application').split('.'):
+        app = getattr(app, part)
+    return app
+
+
+def _import_path(app):
+    """
+    :return: an import string which resolves to this app in any process, or None if there isn't one
+    """
+    module_name = getattr(app, '__module__', None)
+    qualname = getattr(app, '__qualname__', None)
+    if not module_name or not qualname or '<' in qualname:
+        return None
+    app_ref = '{}:{}'.format(module_name, qualname)
+    try:
+        if _resolve_wsgi_app(app_ref) is app:
+            return app_ref
+    except (ImportError, AttributeError):
+        pass
+    return None
+
+
+def _init_wsgi_process(app_ref):
+    global _process_wsgi_app
+    _process_wsgi_app = _resolve_wsgi_app(app_ref)
+
+
+def _call_wsgi_in_process(environ, body):
+    """
+    Runs in a process pool worker.
+    :return: a tuple of (status, headers, body bytes), or None if the app never called start_response
+    """
+    environ['wsgi.input'] = BytesIO(body)
+    environ['wsgi.errors'] = sys.stderr
+    started = []
+    chunks = []
+
+    def _start_response(status, headers, *args, **kwargs):
+        started[:] = [(status, [(str(name), str(value)) for name, value in headers])]
+        return chunks.append
+
+    wsgi_return = _process_wsgi_app(environ, _start_response)
+    try:
+        for body_part in wsgi_return:
+            if body_part:
+                chunks.append(body_part)
+    finally:
+        close = getattr(wsgi_return, 'close', None)
+        if close is not None:
+            close()
+    if not started:
+        return None
+    status, headers = started[0]
+    return status, headers, b''.join(SanicDispatcherMiddleware._encode_wsgi_body(chunk) for chunk in chunks)
+
+
+class WsgiProcessPool(object):
+    """
+    A pool of worker processes for one CPU-bound WSGI child application, so it does not hold the GIL of
+    the server process. Each request's environ and body are sent to a worker, and the whole response is
+    sent back. The pool is replaced with a fresh one after every `max_requests` requests, and the old pool
+    is left to finish the requests it already has. When a request runs past `timeout`, the worker running
+    it may be stuck for good, so the pool's processes are killed, and a fresh pool is started for the
+    next request. Other requests which were running on that pool fail with a 502.
+    Needs Python 3.7 or greater, for the pool's initializer.
+    """
+    __slots__ = ['app_ref', 'max_workers', 'max_requests', 'timeout', 'handled', 'pool']
+
+    def __init__(self, app_ref, max_workers, max_requests=None, timeout=None):
+        self.app_ref = app_ref
+        self.max_workers = max_workers
+        self.max_requests = max_requests
+        self.timeout = timeout
+        self.handled = 0
+        self.pool = None
+
+    def start(self):
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.max_workers, initializer=_init_wsgi_process,
+                                            initargs=(self.app_ref,))
+            self.handled = 0
+        return self.pool
+
+    def shutdown(self, wait=False):
+        pool = self.pool
+        self.pool = None
+        if pool is not None:
+            pool.shutdown(wait=wait)
+
+    def terminate(self, pool):
+        """Shuts down `pool` and kills its worker processes, rather than waiting for them to finish."""
+        if self.pool is pool:
+            self.pool = None
+        # ProcessPoolExecutor has no public way to stop a worker which is busy. They are killed, rather than
+        # terminated, as a worker forked from a process running an event loop may have SIGTERM handled.
+        processes = list((getattr(pool, '_processes', None) or {}).values())
+        for process in processes:
+            process.kill()
+        pool.shutdown(wait=False)
+
+    @staticmethod
+    def compact_environ(environ):
+        """Keeps only the plain values of a WSGI environ, the ones which can be sent to another process."""
+        environ = {key: value for key, value in environ.items()
+                   if isinstance(value, (str, bytes, int, float, bool, tuple))}
+        environ['wsgi.multithread'] = False
+        environ['wsgi.multiprocess'] = True
+        return environ
+
+    async def run(self, environ, body):
+        """
+        :return: a tuple of (status, headers, body bytes), or None if the app never called start_response
+        """
+        pool = self.start()
+        future = get_event_loop().run_in_executor(pool, _call_wsgi_in_process, self.compact_environ(environ),
+                                                  body or b'')
+        self.handled += 1
+        if self.max_requests is not None and self.handled >= self.max_requests:
+            # Recycle the workers, the next request starts a fresh pool
+            self.shutdown()
+        try:
+            if self.timeout is None:
+                return await future
+            return await wait_for(future, self.timeout)
+        except TimeoutError:
+            self.terminate(pool)
+            raise SanicException("The WSGI application did not respond in time.", status_code=504)
+        except BrokenProcessPool:
+            if self.pool is pool:
+                self.shutdown()
+            raise SanicException("The WSGI application's worker process was stopped.", status_code=502)
+
+
+class MountLimiter(object):
+    """
+    Bounds how many requests one mount handles at a time. Requests over `max_in_flight` wait in a FIFO queue
+    of at most `max_queued`, for at most `queue_timeout` seconds. Requests which can't be queued, or wait too
+    long, are shed with a 503 and a Retry-After header, before any middleware runs.
+    """
+    __slots__ = ['max_in_flight', 'max_queued', 'queue_timeout', 'retry_after', 'in_flight', 'waiters',
+                 'shed', 'timed_out']
+
+    def __init__(self, max_in_flight, max_queued=0, queue_timeout=None, retry_after=1):
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued or 0
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.waiters = deque()
+        # Requests refused because the queue was full, and requests which gave up waiting in the queue
+        self.shed = 0
+        self.timed_out = 0
+
+    async def acquire(self):
+        """
+        Waits for a free slot.
+        :raises ServiceUnavailable: if the request is shed
+        """
+        if self.in_flight < self.max_in_flight and not self.waiters:
+            self.in_flight += 1
+            return
+        if len(self.waiters) >= self.max_queued:
+            self.shed += 1
+            raise ServiceUnavailable("The application is too busy to handle this request.")
+        waiter = get_event_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await wait_for(waiter, self.queue_timeout)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as this request gave up, so pass it on
+                self.release()
+            else:
+                try:
+                    self.waiters.remove(waiter)
+                except ValueError:
+                    pass
+            if isinstance(e, TimeoutError):
+                self.timed_out += 1
+                raise ServiceUnavailable("The application is too busy to handle this request.")
+            raise
+
+    def release(self):
+        """Hands the slot straight to the next queued request, if there is one."""
+        waiters = self.waiters
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def shed_response(self):
+        return HTTPResponse("Service Unavailable: The application is too busy to handle this request.", 503,
+                            headers={'Retry-After': str(self.retry_after)}, content_type='text/plain')
+
+
+class WebsocketMount(object):
+    """
+    Tracks the websocket connections dispatched to one child Sanic app. Upgrades over `max_connections` are
+    refused with a 503. Connections on which no message is sent or received for `idle_timeout` seconds are
+    closed. The websocket library's own pings don't count as messages.
+    """
+    __slots__ = ['max_connections', 'idle_timeout', 'open', 'total', 'rejected', 'idle_closed']
+
+    # Close code 1001, Going Away
+    idle_close_code = 1001
+
+    def __init__(self, max_connections=None, idle_timeout=None):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.open = 0
+        self.total = 0
+        self.rejected = 0
+        self.idle_closed = 0
+
+    def is_full(self):
+        return self.max_connections is not None and self.open >= self.max_connections
+
+    async def watch(self, ws):
+        """Closes the connection once it has been idle for idle_timeout seconds."""
+        last_message = monotonic()
+        recv = ws.recv
+        send = ws.send
+
+        async def _recv():
+            nonlocal last_message
+            message = await recv()
+            last_message = monotonic()
+            return message
+
+        async def _send(message):
+            nonlocal last_message
+            last_message = monotonic()
+            return await send(message)
+        # The handler only gets the connection after the handshake, so it never sees the unwrapped methods
+        ws.recv = _recv
+        ws.send = _send
+        timeout = self.idle_timeout
+        while True:
+            idle = monotonic() - last_message
+            if idle >= timeout:
+                break
+            await sleep(timeout - idle)
+        self.idle_closed += 1
+        await ws.close(self.idle_close_code, "Idle timeout")
+
+    def stats(self):
+        return {'open': self.open, 'total': self.total, 'rejected': self.rejected, 'idle_closed': self.idle_closed}
+
+
+class WsgiInputStream(object):
+    """
+    A file-like wsgi.input which reads the request body from the Sanic request stream on demand, rather
+    than from a preloaded body. A task on the event loop pumps the body into a small bounded queue, and
+    the WSGI thread takes the chunks off that queue as the app reads them, so an upload of any size only
+    ever holds a few chunks in memory. Once the request is finished or cancelled, reading raises IOError
+    instead of waiting for a body which will never arrive.
+    """
+    __slots__ = ['stream', 'loop', 'queue', 'pump', 'buffer', 'eof', 'closed']
+
+    max_chunks = 4
+
+    def __init__(self, stream, loop):
+        self.stream = stream
+        self.loop = loop
+        self.queue = None
+        self.pump = None
+        self.buffer = bytearray()
+        self.eof = False
+        self.closed = False
+
+    async def _pump_body(self):
+        queue = self.queue
+        try:
+            async for data in self.stream:
+                await queue.put(data)
+        except Exception as e:
+            await queue.put(e)
+            return
+        except BaseException:
+            self.closed = True
+            self._wake()
+            raise
+        await queue.put(None)
+
+    @staticmethod
+    def _closed_error():
+        return IOError("The request body stream was closed before it was read")
+
+    def _wake(self):
+        """Unblocks a WSGI thread waiting on the queue, once no more of the body will be pumped into it."""
+        try:
+            self.queue.put_nowait(self._closed_error())
+        except QueueFull:
+            pass  # Nothing waits on a full queue, and once it is read down _get_chunk() sees closed
+
+    async def _get_chunk(self):
+        if self.closed:
+            return self._closed_error()
+        if self.pump is None:
+            self.queue = Queue(maxsize=self.max_chunks)
+            self.pump = ensure_future(self._pump_body())
+        return await self.queue.get()
+
+    def _read_chunk(self):
+        """Called on the WSGI thread, blocks until the next chunk of the body is available."""
+        if self.eof:
+            return None
+        chunk = run_coroutine_threadsafe(self._get_chunk(), self.loop).result()
+        if chunk is None:
+            self.eof = True
+        elif isinstance(chunk, Exception):
+            self.eof = True
+            raise chunk
+        return chunk
+
+    def close(self):
+        """Called on the event loop once the WSGI app is finished with the request, or it was cancelled."""
+        self.closed = True
+        if self.pump is not None and not self.pump.done():
+            self.pump.cancel()
+            # A pump cancelled before it first ran never gets to wake the WSGI thread itself
+            self._wake()
+
+    def read(self, size=-1):
+        buffer = self.buffer
+        read_all = size is None or size < 0
+        while read_all or len(buffer) < size:
+            chunk = self._read_chunk()
+            if chunk is None:
+                break
+            buffer.extend(chunk)
+        if read_all or size >= len(buffer):
+            data = bytes(buffer)
+            del buffer[:]
+        else:
+            data = bytes(buffer[:size])
+            del buffer[:size]
+        return data
+
+    def readline(self, size=-1):
+        buffer = self.buffer
+        limited = size is not None and size >= 0
+        searched = 0
+        while True:
+            end = buffer.find(b'\n', searched)
+            if end >= 0:
+                end += 1
+                break
+            searched = len(buffer)
+            if limited and searched >= size:
+                end = size
+                break
+            chunk = self._read_chunk()
+            if chunk is None:
+                end = len(buffer)
+                break
+            buffer.extend(chunk)
+        if limited and end > size:
+            end = size
+        data = bytes(buffer[:end])
+        del buffer[:end]
+        return data
+
+    def readlines(self, hint=-1):
+        lines = []
+        total = 0
+        for line in self:
+            lines.append(line)
+            total += len(line)
+            if 0 < hint <= total:
+                break
+        return lines
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
 
 class WsgiApplication(object):
-    __slots__ = ['app', 'apply_middleware']
+    __slots__ = ['app', 'apply_middleware', 'stream_response', 'stream_request_body', 'executor',
+                 'process_pool', 'limiter', 'cache', 'coalescer', 'environ_templates', 'server_info', 'in_flight']
+
+    # WSGI has no websockets
+    websockets = None
+
+    # Maps request header names to their environ keys. This is shared by all WSGI apps.
+    header_keys = {}
+    # Upper bound on each of the caches, so they can't be grown without limit by bogus headers.
+    max_cached = 256
+
+    def __init__(self, app, apply_middleware=False, stream_response=False, stream_request_body=False,
+                 executor=None, process_pool=None, limiter=None, cache=None, coalescer=None):
+        self.app = app
+        self.apply_middleware = apply_middleware
+        self.stream_response = stream_response
+        self.stream_request_body = stream_request_body
+        self.executor = executor
+        self.process_pool = process_pool
+        self.limiter = limiter
+        self.cache = cache
+        self.coalescer = coalescer
+        self.environ_templates = {}
+        self.server_info = {}
+        # Requests being handled by this mount
+        self.in_flight = 0
+
+    def _environ_template(self, script_name, multithread):
+        key = (script_name, multithread)
+        template = self.environ_templates.get(key, None)
+        if template is None:
+            template = {
+                'SCRIPT_NAME': script_name,
+                'wsgi.version': (1, 0),
+                'wsgi.url_scheme': 'http',  # todo: detect http vs https
+                'wsgi.errors': sys.stderr,
+                'wsgi.multithread': multithread,
+                'wsgi.multiprocess': False,
+                'wsgi.run_once': False,
+            }
+            self.environ_templates[key] = template
+        return template
+
+    def _get_server_info(self, request):
+        """
+        :return: a tuple of (SERVER_NAME, SERVER_PORT, HTTP_HOST), cached per host and port
+        """
+        parsed_url = request._parsed_url
+        if parsed_url and parsed_url.host is not None:
+            key = (parsed_url.host, parsed_url.port)
+        else:
+            key = (request.headers.get('host', None), parsed_url.port if parsed_url else None)
+        server_info = self.server_info.get(key, None)
+        if server_info is not None:
+            return server_info
+        host, port = key
+        if host is None:
+            host = 'localhost:80'
+        elif isinstance(host, bytes):
+            host = host.decode('utf-8')
+        split_host = host.split(':', 1)
+        host_has_port = len(split_host) > 1
+        server_name = split_host[0]
+        if port is not None:
+            server_port = port.decode('ascii')
+        elif host_has_port:
+            server_port = split_host[1]
+        else:
+            server_port = '80'  # TODO: Find a better way of determining the port number when not provided
+        if (not host_has_port) and (server_port != '80'):
+            host = ":".join((host, server_port))
+        server_info = (server_name, server_port, host)
+        if len(self.server_info) >= self.max_cached:
+            self.server_info.clear()
+        self.server_info[key] = server_info
+        return server_info
+
+    def make_environ(self, script_name, path_info, request, wsgi_input=None, multithread=True):
+        environ = self._environ_template(script_name, multithread).copy()
+        header_keys = self.header_keys
+        for name, value in request.headers.items():
+            key = header_keys.get(name, None)
+            if key is None:
+                key = 'HTTP_' + name.upper().replace('-', '_')
+                if len(header_keys) < self.max_cached:
+                    header_keys[name] = key
+            if key == 'HTTP_CONTENT_TYPE' or key == 'HTTP_CONTENT_LENGTH':
+                continue
+            if key in environ:
+                # Repeated headers are folded into one, as per the CGI spec
+                environ[key] = ('; ' if key == 'HTTP_COOKIE' else ',').join((environ[key], value))
+            else:
+                environ[key] = value
+        environ['SERVER_NAME'], environ['SERVER_PORT'], environ['HTTP_HOST'] = self._get_server_info(request)
+        environ['PATH_INFO'] = path_info
+        environ['QUERY_STRING'] = request.query_string or ''
+        environ['REQUEST_METHOD'] = request.method
+        environ['SERVER_PROTOCOL'] = 'HTTP/1.1' if request.version == "1.1" else 'HTTP/1.0'
+        environ['CONTENT_TYPE'] = request.headers.get('content-type', 'text/plain')
+        content_length = request.headers.get('content-length', None)
+        if content_length is not None:
+            environ['CONTENT_LENGTH'] = content_length
+        params = _get_mount_params(request)
+        if params:
+            environ['SCRIPT_NAME'] = _fill_script(script_name, params)
+            environ['wsgiorg.routing_args'] = ((), params)
+        if wsgi_input is not None:
+            environ['wsgi.input'] = wsgi_input
+        else:
+            environ['wsgi.input'] = BytesIO(request.body) if request.body is not None and len(request.body) > 0\
+                else BytesIO(b'')
+        return environ
+
+
+class AsgiLifespan(object):
+    """
+    Drives the ASGI lifespan protocol of a mounted ASGI application, so that its startup and shutdown
+    events run along with the parent app's server start and stop. Apps which don't support the lifespan
+    protocol (they raise, or return straight away) are simply left alone.
+    """
+    __slots__ = ['app', 'state', 'task', 'receive_queue', 'send_queue']
+
+    def __init__(self, app):
+        self.app = app
+        self.state = {}
+        self.task = None
+        self.receive_queue = None
+        self.send_queue = None
+
+    async def _run(self):
+        scope = {'type': 'lifespan', 'asgi': {'version': '3.0', 'spec_version': '2.0'}, 'state': self.state}
+        try:
+            await self.app(scope, self.receive_queue.get, self.send_queue.put)
+        except Exception:
+            error_logger.debug("ASGI app {!r} does not support the lifespan protocol.".format(self.app))
+        finally:
+            # The app has returned, no more messages will come from it.
+            self.send_queue.put_nowait(None)
+
+    async def _event(self, event):
+        if self.task is None or self.task.done():
+            return
+        await self.receive_queue.put({'type': 'lifespan.{}'.format(event)})
+        message = await self.send_queue.get()
+        if message is not None and message.get('type') == 'lifespan.{}.failed'.format(event):
+            raise RuntimeError("ASGI app {!r} failed lifespan {}: {}".format(
+                self.app, event, message.get('message', '')))
+
+    async def startup(self):
+        if self.task is not None:
+            return
+        self.receive_queue = Queue()
+        self.send_queue = Queue()
+        self.task = ensure_future(self._run())
+        await self._event('startup')
+
+    async def shutdown(self):
+        if self.task is None:
+            return
+        try:
+            await self._event('shutdown')
+            await self.task
+        finally:
+            self.task = None
+
+
+class AsgiApplication(object):
+    __slots__ = ['app', 'apply_middleware', 'lifespan', 'limiter', 'in_flight']
+
+    # The ASGI app is handed websocket connections through its own scope, so they aren't tracked here
+    websockets = None
 
-    def __init__(self, app, apply_middleware=False):
+    def __init__(self, app, apply_middleware=False, lifespan=None, limiter=None):
         self.app = app
         self.apply_middleware = apply_middleware
+        self.lifespan = lifespan if lifespan is not None else AsgiLifespan(app)
+        self.limiter = limiter
+        self.in_flight = 0
 
 
 class SanicApplication(object):
-    __slots__ = ['app', 'server_settings', 'apply_middleware']
+    __slots__ = ['app', 'server_settings', 'apply_middleware', 'limiter', 'websockets', 'in_flight']
 
-    def __init__(self, app, apply_middleware=False):
+    def __init__(self, app, apply_middleware=False, limiter=None, websockets=None):
         self.app = app
         self.server_settings = {}
         self.apply_middleware = apply_middleware
+        self.limiter = limiter
+        self.websockets = websockets if websockets is not None else WebsocketMount()
+        self.in_flight = 0
+
+
+class LazyApplication(object):
+    """
+    Stands in for an app which was registered by its import string or factory, until its first request
+    loads it. One LazyApplication is shared by all of the host aliases of the registration.
+    """
+    __slots__ = ['app', 'url_prefix', 'host', 'apply_middleware', 'options', 'idle_timeout', 'loader', 'loaded',
+                 'loading', 'flights', 'in_flight', 'last_used', 'watcher', 'loads', 'unloads']
+
+    limiter = None
+    websockets = None
+
+    def __init__(self, app, url_prefix, host=None, apply_middleware=False, idle_timeout=None, options=None):
+        """
+        :param app: The import string or factory of the app
+        :param url_prefix:
+        :param host:
+        :param apply_middleware:
+        :param idle_timeout: Unload the app after this many seconds without a request
+        :param dict options: The keyword arguments to register the app with, once it is loaded
+        """
+        self.app = app
+        self.url_prefix = url_prefix
+        self.host = host
+        self.apply_middleware = apply_middleware
+        self.options = options or {}
+        self.idle_timeout = idle_timeout
+        # Coroutine function which loads the app and fills in `loaded`, set by the controller
+        self.loader = None
+        # Maps each url to the registered application which was loaded for it
+        self.loaded = {}
+        # The same, while the app is being registered and started
+        self.loading = None
+        # Loads and unloads both run as the single flight, so requests wait for whichever is running
+        self.flights = SingleFlight()
+        self.in_flight = 0
+        self.last_used = 0.0
+        self.watcher = None
+        self.loads = 0
+        self.unloads = 0
+
+    async def acquire(self, url):
+        """
+        Loads the app, unless it is loaded already. Concurrent first requests all wait for the one load.
+        Each call must be followed by a call to release(), once the request is done.
+        :return: the registered application loaded for `url`
+        """
+        self.in_flight += 1
+        self.last_used = monotonic()
+        try:
+            # The app may have been unloading when this request came in, then it is loaded again
+            for _ in range(2):
+                reg_application = self.loaded.get(url, None)
+                if reg_application is not None:
+                    return reg_application
+                await self.flights.run(None, self.loader)
+            reg_application = self.loaded.get(url, None)
+            if reg_application is None:
+                raise SanicException("The app for {} could not be loaded.".format(url), 500)
+            return reg_application
+        except BaseException:
+            self.in_flight -= 1
+            raise
+
+    def release(self):
+        self.in_flight -= 1
+        self.last_used = monotonic()
+
+    def is_idle(self):
+        return self.in_flight == 0 and monotonic() - self.last_used >= self.idle_timeout
 
 
 class SanicCompatURL(object):
@@ -74,21 +772,486 @@ class SanicCompatURL(object):
         self.fragment = fragment
         self.userinfo = userinfo
 
-class SanicComatRequest(object):
-    __slots__ = ("orig_req", "parent_app")
-    def __init__(self, orig_req, parent_app):
-        self.orig_req = orig_req
-        self.parent_app = parent_app
 
-    def __getattr__(self, item):
-        if item in SanicComatRequest.__slots__:
-            return object.__getattribute__(self, item)
-        return getattr(self.orig_req, item)
+# A path segment like <tenant> or <tenant:[a-z]+> in a mount key matches any one segment, or one matching the regex
+_PARAM_SEGMENT = re.compile(rb'^<([A-Za-z_][A-Za-z0-9_]*)(?::(.+))?>$')
+_SCRIPT_PARAM = re.compile(r'<([A-Za-z_][A-Za-z0-9_]*)(?::[^>]+)?>')
 
-    def __setattr__(self, key, val):
-        if key in SanicComatRequest.__slots__:
-            return object.__setattr__(self, key, val)
-        return setattr(self.orig_req, key, val)
+
+def _parse_param(segment):
+    """
+    :param bytes segment:
+    :return: a tuple of (name, compiled regex or None), or None if the segment is a literal
+    """
+    if not segment.startswith(b'<'):
+        return None
+    matched = _PARAM_SEGMENT.match(segment)
+    if matched is None:
+        return None
+    name, pattern = matched.groups()
+    return name.decode('ascii'), None if pattern is None else re.compile(pattern)
+
+
+def _parse_wildcard_host(host):
+    """
+    A host like *.example.com matches any one label in front of .example.com, <tenant>.example.com does the
+    same and captures the label as the `tenant` parameter.
+    :return: a tuple of (suffix, parameter name or None), or None if the host is a literal
+    """
+    if host.startswith('*.'):
+        return host[1:], None
+    if host.startswith('<'):
+        close = host.find('>.')
+        if close > 1:
+            return host[close + 1:], host[1:close]
+    return None
+
+
+def _set_mount_params(request, params):
+    ctx = getattr(request, 'ctx', None)
+    if ctx is not None:
+        ctx.mount_params = params
+    else:
+        # Before Sanic 19.9, the request is a dict for storing things on
+        request['mount_params'] = params
+
+
+def _get_mount_params(request):
+    """:return: the parameters captured by the request's mount, or None"""
+    ctx = getattr(request, 'ctx', None)
+    if ctx is not None:
+        return getattr(ctx, 'mount_params', None)
+    return request.get('mount_params', None)
+
+
+def _fill_script(script, params):
+    """:return: the mount key `script`, with each of its parameters replaced by its captured value"""
+    return _SCRIPT_PARAM.sub(lambda m: quote(params.get(m.group(1), m.group(0)), safe="@:!$&'()*+,;=-._~"), script)
+
+
+class MountTrieNode(object):
+    __slots__ = ['children', 'params', 'param', 'application', 'script']
+
+    def __init__(self, param=None):
+        self.children = {}
+        # Maps each parameter segment below this node, like b'<tenant>', to its node
+        self.params = {}
+        # (name, regex) if this node is a parameter segment
+        self.param = param
+        self.application = None
+        self.script = None
+
+    def copy(self):
+        node = MountTrieNode(self.param)
+        node.children = dict(self.children)
+        node.params = dict(self.params)
+        node.application = self.application
+        node.script = self.script
+        return node
+
+    def branch(self, segment):
+        """:return: the dict which holds the child node for `segment`"""
+        return self.params if segment.startswith(b'<') and _parse_param(segment) is not None else self.children
+
+    def new_child(self, segment):
+        return MountTrieNode(_parse_param(segment) if segment.startswith(b'<') else None)
+
+
+class MountTrie(object):
+    """
+    A segment trie of the registered mount points. The mount keys are split on '/' once, when the
+    dispatcher is built, so routing a request is a single longest-prefix walk over the raw path bytes.
+    A parameter segment, like <tenant>, is a single node which matches any segment, so however many
+    values it sees, the walk costs the same. Literal segments are tried before parameters.
+    Once a trie is in use it is never modified. with_mount() and without_mount() return a new trie
+    instead, which copies only the nodes along the changed path and shares all the others.
+    """
+    __slots__ = ['root', 'has_params']
+
+    def __init__(self, mounts=None):
+        self.root = MountTrieNode()
+        self.has_params = False
+        if mounts:
+            for script, application in mounts.items():
+                self.insert(script, application)
+
+    def insert(self, path, application, script=None):
+        node = self.root
+        for segment in path.encode('utf-8').split(b'/'):
+            branch = node.branch(segment)
+            child = branch.get(segment, None)
+            if child is None:
+                child = branch[segment] = node.new_child(segment)
+                self.has_params = self.has_params or child.param is not None
+            node = child
+        node.application = application
+        node.script = path if script is None else script
+
+    def with_mount(self, path, application, script=None):
+        """
+        :return: a new MountTrie with `application` mounted at `path`
+        """
+        trie = MountTrie()
+        trie.has_params = self.has_params
+        trie.root = node = self.root.copy()
+        for segment in path.encode('utf-8').split(b'/'):
+            branch = node.branch(segment)
+            child = branch.get(segment, None)
+            child = node.new_child(segment) if child is None else child.copy()
+            trie.has_params = trie.has_params or child.param is not None
+            branch[segment] = child
+            node = child
+        node.application = application
+        node.script = path if script is None else script
+        return trie
+
+    def without_mount(self, path):
+        """
+        :return: a new MountTrie without the mount at `path`, or this trie if nothing is mounted there
+        """
+        segments = path.encode('utf-8').split(b'/')
+        nodes = [self.root]
+        for segment in segments:
+            child = nodes[-1].branch(segment).get(segment, None)
+            if child is None:
+                return self
+            nodes.append(child)
+        if nodes[-1].application is None:
+            return self
+        # Copy the path back up to the root, pruning any nodes which are left empty
+        replacement = nodes[-1].copy()
+        replacement.application = replacement.script = None
+        for depth in range(len(segments) - 1, -1, -1):
+            if not replacement.children and not replacement.params and replacement.application is None:
+                replacement = None
+            parent = nodes[depth].copy()
+            branch = parent.branch(segments[depth])
+            if replacement is None:
+                del branch[segments[depth]]
+            else:
+                branch[segments[depth]] = replacement
+            replacement = parent
+        trie = MountTrie()
+        trie.root = replacement
+        # Never cleared on removal, it only picks the slower walk
+        trie.has_params = self.has_params
+        return trie
+
+    def match(self, path, params=None):
+        """
+        Finds the longest mounted prefix of `path`, matching on whole segments only.
+        :param bytes path:
+        :param dict params: Filled in with the values of the parameter segments of the match, if given
+        :return: a tuple of (application, script, path_info), or (None, None, path) if nothing matches
+        """
+        if self.has_params:
+            found = self._match_segment(self.root, path, 0, len(path), ())
+            if found is None:
+                return None, None, path
+            node, found_end, captured = found
+            if params is not None:
+                for name, value in captured:
+                    params[name] = unquote(value.decode('utf-8'))
+            return node.application, node.script, path[found_end:]
+        node = self.root
+        found = None
+        found_end = 0
+        start = 0
+        length = len(path)
+        while True:
+            end = path.find(b'/', start)
+            if end < 0:
+                end = length
+            node = node.children.get(path[start:end], None)
+            if node is None:
+                break
+            if node.application is not None:
+                found = node
+                found_end = end
+            if end >= length:
+                break
+            start = end + 1
+        if found is None:
+            return None, None, path
+        return found.application, found.script, path[found_end:]
+
+    def _match_segment(self, node, path, start, length, captured):
+        """
+        Matches the segment of `path` at `start` against the children of `node`, literal ones first.
+        :return: a tuple of (node, end, captured) for the longest match below `node`, or None
+        """
+        end = path.find(b'/', start)
+        if end < 0:
+            end = length
+        segment = path[start:end]
+        best = None
+        child = node.children.get(segment, None)
+        if child is not None:
+            best = self._match_below(child, path, end, length, captured)
+        if node.params and segment:
+            for child in node.params.values():
+                name, regex = child.param
+                if regex is not None and regex.fullmatch(segment) is None:
+                    continue
+                found = self._match_below(child, path, end, length, captured + ((name, segment),))
+                if found is not None and (best is None or found[1] > best[1]):
+                    best = found
+        return best
+
+    def _match_below(self, node, path, end, length, captured):
+        best = (node, end, captured) if node.application is not None else None
+        if end < length:
+            found = self._match_segment(node, path, end + 1, length, captured)
+            if found is not None and (best is None or found[1] > best[1]):
+                best = found
+        return best
+
+
+class MountRoutingTable(object):
+    """
+    The compiled mount table. Every host that has host-specific mounts gets its own trie, and all of the
+    host-agnostic mounts share the default trie, so a request is routed with one host lookup and at most
+    two trie walks. Host-specific mounts take precedence over the host-agnostic ones. A wildcard host, like
+    *.example.com or <tenant>.example.com, gets a trie keyed on its suffix, which is looked up with the first
+    label of the request host cut off, when the host has no trie of its own.
+    Like the tries, a table is a snapshot. Changing a mount builds a new table, which the dispatcher swaps in
+    with a single assignment, so in-flight requests always see one consistent table.
+    Each table also keeps a small LRU cache of match results, hits and misses alike, keyed on the host and
+    the first `depth` segments of the path, as nothing past the deepest mount can change the result. A new
+    table starts with an empty cache, so changing the mounts invalidates it.
+    """
+    __slots__ = ['default', 'hosts', 'wildcards', 'depth', 'cache', 'has_params']
+
+    cache_size = 1024
+
+    def __init__(self, mounts=None, hosts=None):
+        self.default = MountTrie()
+        self.hosts = {}
+        # Maps the suffix of each wildcard host, like '.example.com', to (parameter name or None, trie)
+        self.wildcards = {}
+        self.depth = 0
+        self.cache = OrderedDict()
+        # Whether any match can capture parameters. Never cleared on removal, it only costs a dict.
+        self.has_params = False
+        if mounts:
+            hosts = hosts or frozenset()
+            for script, application in mounts.items():
+                self.insert(script, application, hosts)
+
+    def _add_depth(self, path):
+        self.depth = max(self.depth, path.count('/') + 1)
+
+    def _host_trie(self, host):
+        wildcard = _parse_wildcard_host(host)
+        if wildcard is None:
+            return self.hosts.get(host, None)
+        found = self.wildcards.get(wildcard[0], None)
+        return None if found is None else found[1]
+
+    def _set_host_trie(self, host, trie):
+        wildcard = _parse_wildcard_host(host)
+        if wildcard is None:
+            if trie is None:
+                del self.hosts[host]
+            else:
+                self.hosts[host] = trie
+        elif trie is None:
+            del self.wildcards[wildcard[0]]
+        else:
+            self.wildcards[wildcard[0]] = (wildcard[1], trie)
+            self.has_params = self.has_params or wildcard[1] is not None
+        if trie is not None:
+            self.has_params = self.has_params or trie.has_params
+
+    def insert(self, script, application, hosts):
+        host, sep, path = script.partition('/')
+        self._add_depth(sep + path)
+        if host and host in hosts:
+            trie = self._host_trie(host)
+            if trie is None:
+                trie = MountTrie()
+                self._set_host_trie(host, trie)
+            trie.insert(sep + path, application, script)
+            self.has_params = self.has_params or trie.has_params
+        else:
+            self.default.insert(script, application)
+            self.has_params = self.has_params or self.default.has_params
+
+    def _copy(self):
+        table = MountRoutingTable()
+        table.default = self.default
+        table.hosts = self.hosts
+        table.wildcards = self.wildcards
+        table.has_params = self.has_params
+        # Never lowered on removal, the cache key is only ever finer than it needs to be
+        table.depth = self.depth
+        return table
+
+    def with_mount(self, script, application, hosts):
+        """
+        :return: a new MountRoutingTable with `application` mounted at `script`
+        """
+        table = self._copy()
+        host, sep, path = script.partition('/')
+        table._add_depth(sep + path)
+        if host and host in hosts:
+            trie = self._host_trie(host) or MountTrie()
+            table.hosts = dict(self.hosts)
+            table.wildcards = dict(self.wildcards)
+            table._set_host_trie(host, trie.with_mount(sep + path, application, script))
+        else:
+            table.default = self.default.with_mount(script, application)
+            table.has_params = table.has_params or table.default.has_params
+        return table
+
+    def without_mount(self, script, hosts):
+        """
+        :return: a new MountRoutingTable without the mount at `script`
+        """
+        table = self._copy()
+        host, sep, path = script.partition('/')
+        if host and host in hosts:
+            trie = self._host_trie(host)
+            if trie is None:
+                return self
+            trie = trie.without_mount(sep + path)
+            table.hosts = dict(self.hosts)
+            table.wildcards = dict(self.wildcards)
+            table._set_host_trie(host, trie if trie.root.children or trie.root.params else None)
+        else:
+            table.default = self.default.without_mount(script)
+        return table
+
+    def _cache_key_end(self, path):
+        """
+        :return: the index in `path` where its first `depth` segments end
+        """
+        end = -1
+        for _ in range(self.depth):
+            end = path.find(b'/', end + 1)
+            if end < 0:
+                return len(path)
+        return max(end, 0)
+
+    def match(self, host, path, params=None):
+        """
+        :param str host: the request host, without the port
+        :param bytes path:
+        :param dict params: Filled in with the parameters captured by the match, if given
+        :return: a tuple of (application, script, path_info), or (None, None, path) if nothing matches
+        """
+        trie = self.hosts.get(host, None)
+        host_param = None
+        if trie is None and self.wildcards:
+            dot = host.find('.')
+            if dot > 0:
+                found = self.wildcards.get(host[dot:], None)
+                if found is not None:
+                    name, trie = found
+                    if name is not None:
+                        host_param = (name, host[:dot])
+        # All hosts without their own trie route the same way, so they share cache entries
+        key = (host if trie is not None else '', path[:self._cache_key_end(path)])
+        cache = self.cache
+        cached = cache.get(key, None)
+        if cached is not None:
+            cache.move_to_end(key)
+            application, script, end, captured = cached
+            if application is None:
+                return None, None, path
+            if captured and params is not None:
+                params.update(captured)
+            return application, script, path[end:]
+        application = None
+        captured = {}
+        if trie is not None:
+            application, script, path_info = trie.match(path, captured)
+            if application is not None and host_param is not None:
+                captured[host_param[0]] = host_param[1]
+        if application is None:
+            captured.clear()
+            application, script, path_info = self.default.match(path, captured)
+        cache[key] = (application, script, len(path) - len(path_info), captured)
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)
+        if captured and params is not None:
+            params.update(captured)
+        return application, script, path_info
+
+
+class ParentMiddlewareChain(object):
+    """
+    The parent app's request and response middleware, compiled once for all of the mounts which apply it.
+    Coroutine functions are told apart from plain callables when the chain is built, so they are awaited
+    without inspecting what they return. A plain callable's result is still checked, as it may be a
+    wrapper which returns an awaitable. The chain notes which middleware lists it was built from, and
+    how long they were, so the dispatcher can tell when middleware has been added since.
+    """
+    __slots__ = ['request_source', 'request_count', 'response_source', 'response_count', 'request_middleware',
+                 'response_middleware']
+
+    def __init__(self, parent_app):
+        request_middleware = parent_app.request_middleware
+        response_middleware = parent_app.response_middleware
+        self.request_source = request_middleware
+        self.request_count = len(request_middleware)
+        self.response_source = response_middleware
+        self.response_count = len(response_middleware)
+        self.request_middleware = tuple((middleware, iscoroutinefunction(middleware))
+                                        for middleware in request_middleware)
+        self.response_middleware = tuple((middleware, iscoroutinefunction(middleware))
+                                         for middleware in response_middleware)
+
+    def is_current(self, parent_app):
+        request_middleware = parent_app.request_middleware
+        response_middleware = parent_app.response_middleware
+        return request_middleware is self.request_source and len(request_middleware) == self.request_count and \
+            response_middleware is self.response_source and len(response_middleware) == self.response_count
+
+    async def run_request(self, request):
+        """
+        :return: the response from the first request middleware which returns one, or None
+        """
+        for middleware, is_coroutine in self.request_middleware:
+            if is_coroutine:
+                response = await middleware(request)
+            else:
+                response = middleware(request)
+                if isawaitable(response):
+                    response = await response
+            if response:
+                return response
+        return None
+
+    async def run_response(self, request, response, stream=None):
+        """
+        :param stream: The request's stream. A response returned by a middleware is connected to it.
+        :return: the response from the first response middleware which returns one, or the original response
+        """
+        for middleware, is_coroutine in self.response_middleware:
+            if is_coroutine:
+                _response = await middleware(request, response)
+            else:
+                _response = middleware(request, response)
+                if isawaitable(_response):
+                    _response = await _response
+            if _response:
+                if stream is not None and isinstance(_response, BaseHTTPResponse):
+                    _response = stream.respond(_response)
+                return _response
+        return response
+
+
+class SanicCompatRequestMixin(object):
+    """
+    Mixed into a subclass of the Sanic Request class, which dispatched requests are switched over to when
+    the parent app's middleware is applied to a child Sanic app. The subclass adds no slots of its own, so
+    the request keeps its layout and attribute access is as fast as it is on a plain Request.
+    """
+    __slots__ = ()
+
+    parent_app = None
+    dispatcher = None
 
     async def respond(self, response=None, *args, status=200, headers=None, content_type=None):
         # From Sanic 21.03
@@ -113,20 +1276,36 @@ class SanicComatRequest(object):
             error_logger.exception(
                 "Exception occurred in one of response middleware handlers"
             )
-        parent_app = self.parent_app
-        if parent_app.response_middleware:
-            self.orig_req.app = parent_app
-            for _middleware in parent_app.response_middleware:
-                _response = _middleware(self, response)
-                if isawaitable(_response):
-                    _response = await _response
-                if _response:
-                    response = _response
-                    if isinstance(response, BaseHTTPResponse):
-                        response = self.stream.respond(response)
+        chain = self.dispatcher._middleware_chain()
+        if chain.response_middleware:
+            self.app = self.parent_app
+            response = await chain.run_response(self, response, self.stream)
         return response
 
 
+class SanicComatRequest(object):
+    """
+    A proxy around the request, used in place of the SanicCompatRequestMixin subclass for request classes
+    whose instances can't be switched to a subclass.
+    """
+    __slots__ = ("orig_req", "parent_app", "dispatcher")
+    def __init__(self, orig_req, parent_app, dispatcher):
+        self.orig_req = orig_req
+        self.parent_app = parent_app
+        self.dispatcher = dispatcher
+
+    def __getattr__(self, item):
+        if item in SanicComatRequest.__slots__:
+            return object.__getattribute__(self, item)
+        return getattr(self.orig_req, item)
+
+    def __setattr__(self, key, val):
+        if key in SanicComatRequest.__slots__:
+            return object.__setattr__(self, key, val)
+        return setattr(self.orig_req, key, val)
+
+    respond = SanicCompatRequestMixin.respond
+
 
 class SanicDispatcherMiddleware(object):
     """
@@ -134,135 +1313,501 @@ class SanicDispatcherMiddleware(object):
     Based on the DispatcherMiddleware class in werkzeug.
     """
 
-    __slots__ = ['parent_app', 'parent_handle_request', 'mounts', 'hosts']
+    __slots__ = ['parent_app', 'parent_handle_request', 'mounts', 'hosts', 'router', 'metrics', 'middleware_chain',
+                 'host_info', 'compat_request_classes']
 
     use_wsgi_threads = True
+    # Upper bound on host_info, so it can't be grown without limit by bogus Host headers
+    max_cached_hosts = 256
 
-    def __init__(self, parent_app, parent_handle_request, mounts=None, hosts=None):
+    def __init__(self, parent_app, parent_handle_request, mounts=None, hosts=None, metrics=None):
         self.parent_app = parent_app
         self.parent_handle_request = parent_handle_request
         self.mounts = mounts or {}
         self.hosts = frozenset(hosts) if hosts else frozenset()
+        self.router = MountRoutingTable(self.mounts, self.hosts)
+        self.metrics = metrics
+        self.middleware_chain = None
+        # Maps each request class to its SanicCompatRequestMixin subclass, which is bound to this dispatcher
+        self.compat_request_classes = {}
+        # Maps each Host header to a tuple of (host, host as bytes, port as bytes or None)
+        self.host_info = {}
+
+    def _middleware_chain(self):
+        """
+        :return: the compiled parent middleware, rebuilt if middleware has been added to the parent app
+        :rtype: ParentMiddlewareChain
+        """
+        chain = self.middleware_chain
+        if chain is None or not chain.is_current(self.parent_app):
+            chain = self.middleware_chain = ParentMiddlewareChain(self.parent_app)
+        return chain
 
     @staticmethod
-    def _call_wsgi(script_name, path_info, request, wsgi_app, response_callback):
+    def _encode_wsgi_body(body_data):
+        if isinstance(body_data, bytes):
+            return body_data
+        try:
+            # Try to encode it regularly
+            return body_data.encode()
+        except AttributeError:
+            # Convert it to a str if you can't
+            return str(body_data).encode()
+
+    @staticmethod
+    def _wsgi_response_args(status, headers, *args, **kwargs):
+        """Turns the arguments given to the WSGI start_response callback into HTTPResponse constructor args."""
+        if isinstance(status, int):
+            code = status
+        elif isinstance(status, str):
+            code = int(status.split(" ")[0])
+        else:
+            raise RuntimeError("status cannot be turned into a code.")
+        # A multi-dict, so repeated headers like Set-Cookie are all kept
+        sanic_headers = Header(headers)
+        response_constructor_args = {'status': code,  'headers': sanic_headers}
+        if 'content_type' in kwargs:
+            response_constructor_args['content_type'] = kwargs['content_type']
+        else:
+            content_type = sanic_headers.get('Content-Type', None)
+            if content_type is not None:
+                response_constructor_args['content_type'] = str(content_type).split(";")[0].strip()
+        return response_constructor_args
+
+    @staticmethod
+    def _call_wsgi(environ, wsgi_app, response_callback):
         http_response = None
-        body_bytes = bytearray()
+        body_parts = []
 
         def _start_response(status, headers, *args, **kwargs):
             """The start_response callback as required by the wsgi spec. This sets up a response including the
             status code and the headers, but doesn't write a body."""
             nonlocal http_response
-            nonlocal body_bytes
-            if isinstance(status, int):
-                code = status
-            elif isinstance(status, str):
-                code = int(status.split(" ")[0])
-            else:
-                raise RuntimeError("status cannot be turned into a code.")
-            sanic_headers = dict(headers)
-            response_constructor_args = {'status': code,  'headers': sanic_headers}
-            if 'content_type' in kwargs:
-                response_constructor_args['content_type'] = kwargs['content_type']
-            elif 'Content-Type' in sanic_headers:
-                response_constructor_args['content_type'] = str(sanic_headers['Content-Type']).split(";")[0].strip()
-            http_response = HTTPResponse(**response_constructor_args)
+            http_response = HTTPResponse(**SanicDispatcherMiddleware._wsgi_response_args(status, headers,
+                                                                                          *args, **kwargs))
 
             def _write_body(body_data):
                 """This doesn't seem to be used, but it is part of the wsgi spec, so need to have it."""
-                nonlocal body_bytes
-                nonlocal http_response
-                if isinstance(body_data, bytes):
-                    pass
-                else:
-                    try:
-                        # Try to encode it regularly
-                        body_data = body_data.encode()
-                    except AttributeError:
-                        # Convert it to a str if you can't
-                        body_data = str(body_data).encode()
-                body_bytes.extend(body_data)
+                body_parts.append(SanicDispatcherMiddleware._encode_wsgi_body(body_data))
             return _write_body
 
-        environ = {}
-        original_script_name = environ.get('SCRIPT_NAME', '')
-        environ['SCRIPT_NAME'] = original_script_name + script_name
-        environ['PATH_INFO'] = path_info
-        if request._parsed_url and request._parsed_url.host is not None:
-            host = request._parsed_url.host.decode('utf-8')
-        elif 'host' in request.headers:
-            host = request.headers['host']
-        else:
-            host = 'localhost:80'
-        if 'content-type' in request.headers:
-            content_type = request.headers['content-type']
+        try:
+            wsgi_return = wsgi_app(environ, _start_response)
+            try:
+                # A generator-based app only calls start_response once it is iterated
+                for body_part in wsgi_return:
+                    if body_part:
+                        body_parts.append(SanicDispatcherMiddleware._encode_wsgi_body(body_part))
+            finally:
+                close = getattr(wsgi_return, 'close', None)
+                if close is not None:
+                    close()
+        except Exception as e:
+            error_logger.exception(e)
+            raise e
+        if http_response is None:
+            http_response = HTTPResponse("WSGI call error.", 500)
         else:
-            content_type = 'text/plain'
-        environ['CONTENT_TYPE'] = content_type
-        if 'content-length' in request.headers:
-            content_length = request.headers['content-length']
-            environ['CONTENT_LENGTH'] = content_length
+            # Joining a single part returns it as it is, without a copy
+            http_response.body = b''.join(body_parts)
+        if response_callback:
+            return response_callback(http_response)
+        return http_response
+
+    @staticmethod
+    def _next_wsgi_chunk(body_iter):
+        """Advances the WSGI body iterable to its next non-empty chunk. Returns None once it is exhausted."""
+        for body_part in body_iter:
+            if body_part:
+                return SanicDispatcherMiddleware._encode_wsgi_body(body_part)
+        return None
+
+    async def _run_wsgi_blocking(self, executor, func, *args):
+        if not self.use_wsgi_threads:
+            return func(*args)
+        if executor is None:
+            return await get_event_loop().run_in_executor(None, func, *args)
+        return await executor.run(get_event_loop(), func, *args)
+
+    async def _run_wsgi_app(self, executor, stats, func, *args):
+        """
+        Like _run_wsgi_blocking, but when metrics are on it also records how long the call waited
+        for a free thread.
+        """
+        if stats is None or not self.use_wsgi_threads:
+            return await self._run_wsgi_blocking(executor, func, *args)
+        submitted = perf_counter()
+        started = []
+
+        def _timed_call():
+            started.append(perf_counter())
+            return func(*args)
+        try:
+            return await self._run_wsgi_blocking(executor, _timed_call)
+        finally:
+            if started:
+                stats.observe('queue', started[0] - submitted)
+
+    async def _call_wsgi_process(self, script_name, path_info, request, application):
+        """Runs the WSGI app in its process pool, and builds the HTTPResponse from the result."""
+        environ = application.make_environ(script_name, path_info, request, multithread=False)
+        result = await application.process_pool.run(environ, request.body)
+        if result is None:
+            return HTTPResponse("WSGI call error.", 500)
+        status, headers, body = result
+        http_response = HTTPResponse(**self._wsgi_response_args(status, headers))
+        http_response.body = body
+        return http_response
+
+    @staticmethod
+    async def _fetch_wsgi_shared(script_name, path_info, request, application, call):
+        """Answers the request through the mount's response cache and request coalescer, which wrap `call`."""
+        params = _get_mount_params(request)
+        if params:
+            # Requests for different parameter values are different requests
+            script_name = _fill_script(script_name, params)
+        if application.coalescer is not None:
+            call = partial(application.coalescer.fetch, request, script_name, path_info, call)
+        if application.cache is not None:
+            return await application.cache.fetch(request, script_name, path_info, call)
+        return await call()
+
+    async def _start_wsgi_stream(self, environ, application, stats=None):
+        """
+        Calls the WSGI app and pulls the first chunk of its body, which is when a generator-based app is
+        allowed to call start_response.
+        :return: a tuple of (wsgi_return, body_iter, response_args, written_chunks, first_chunk)
+        """
+        started = []
+        written = []
+        executor = application.executor
+
+        def _start_response(status, headers, *args, **kwargs):
+            started[:] = [SanicDispatcherMiddleware._wsgi_response_args(status, headers, *args, **kwargs)]
+
+            def _write_body(body_data):
+                written.append(SanicDispatcherMiddleware._encode_wsgi_body(body_data))
+            return _write_body
 
-        split_host = host.split(':', 1)
-        host_has_port = len(split_host) > 1
-        server_name = split_host[0]
-        if request._parsed_url and request._parsed_url.port is not None:
-            server_port = request._parsed_url.port.decode('ascii')
-        elif host_has_port:
-            server_port = split_host[1]
-        else:
-            server_port = '80'  # TODO: Find a better way of determining the port number when not provided
-        if (not host_has_port) and (server_port != '80'):
-            host = ":".join((host, server_port))
-        environ['SERVER_PORT'] = server_port
-        environ['SERVER_NAME'] = server_name
-        environ['SERVER_PROTOCOL'] = 'HTTP/1.1' if request.version == "1.1" else 'HTTP/1.0'
-        environ['HTTP_HOST'] = host
-        environ['QUERY_STRING'] = request.query_string or ''
-        environ['REQUEST_METHOD'] = request.method
-        environ['wsgi.url_scheme'] = 'http'  # todo: detect http vs https
-        environ['wsgi.input'] = BytesIO(request.body) if request.body is not None and len(request.body) > 0\
-            else BytesIO(b'')
         try:
-            wsgi_return = wsgi_app(environ, _start_response)
+            wsgi_return = await self._run_wsgi_app(executor, stats, application.app, environ, _start_response)
         except Exception as e:
             error_logger.exception(e)
             raise e
-        if http_response is None:
-            http_response = HTTPResponse("WSGI call error.", 500)
-        else:
-            for body_part in wsgi_return:
-                if body_part is not None:
-                    if isinstance(body_part, bytes):
-                        pass
-                    else:
-                        try:
-                            # Try to encode it regularly
-                            body_part = body_part.encode()
-                        except AttributeError:
-                            # Convert it to a str if you can't
-                            body_part = str(body_part).encode()
-                    body_bytes.extend(body_part)
-            http_response.body = bytes(body_bytes)
-        if response_callback:
-            return response_callback(http_response)
-        return http_response
+        try:
+            body_iter = iter(wsgi_return)
+            chunk = await self._run_wsgi_blocking(executor, self._next_wsgi_chunk, body_iter)
+        except BaseException:
+            await self._close_wsgi_return(wsgi_return, executor)
+            raise
+        response_args = started[0] if started else None
+        return wsgi_return, body_iter, response_args, written, chunk
+
+    async def _close_wsgi_return(self, wsgi_return, executor):
+        close = getattr(wsgi_return, 'close', None)
+        if close is not None:
+            await self._run_wsgi_blocking(executor, close)
+
+    if IS_21_03:
+        def _make_wsgi_input(self, request):
+            """
+            Builds a streaming wsgi.input when the request body was left on the Sanic request stream
+            rather than preloaded. Reading it blocks, so this is only possible on a WSGI thread.
+            """
+            stream = request.stream
+            if self.use_wsgi_threads and stream is not None and not request.body and \
+                    getattr(stream, 'request_body', None):
+                return WsgiInputStream(stream, get_event_loop())
+            return None
+
+        async def call_wsgi_app(self, script_name, path_info, request, application, stats=None):
+            if application.cache is not None or application.coalescer is not None:
+                return await self._fetch_wsgi_shared(script_name, path_info, request, application,
+                                                     partial(self._call_wsgi_app, script_name, path_info, request,
+                                                             application, stats))
+            return await self._call_wsgi_app(script_name, path_info, request, application, stats)
+
+        async def _call_wsgi_app(self, script_name, path_info, request, application, stats=None):
+            if application.process_pool is not None:
+                return await self._call_wsgi_process(script_name, path_info, request, application)
+            executor = application.executor
+            if executor is not None:
+                executor.acquire()
+            wsgi_input = self._make_wsgi_input(request)
+            try:
+                environ = application.make_environ(script_name, path_info, request, wsgi_input,
+                                                   self.use_wsgi_threads)
+                return await self._run_wsgi_app(executor, stats, self._call_wsgi, environ, application.app, False)
+            finally:
+                if wsgi_input is not None:
+                    wsgi_input.close()
+                if executor is not None:
+                    executor.release()
+
+        async def stream_wsgi_app(self, script_name, path_info, request, application, stats=None):
+            """
+            Forwards each chunk of the WSGI body to the client as soon as the app produces it, instead of
+            buffering the whole body. The next chunk is only pulled from the app once the previous one has
+            been written to the transport, so a slow client applies backpressure to the WSGI app.
+            """
+            executor = application.executor
+            if executor is not None:
+                executor.acquire()
+            wsgi_input = self._make_wsgi_input(request)
+            try:
+                environ = application.make_environ(script_name, path_info, request, wsgi_input,
+                                                   self.use_wsgi_threads)
+                wsgi_return, body_iter, response_args, written, chunk = \
+                    await self._start_wsgi_stream(environ, application, stats)
+                try:
+                    if response_args is None:
+                        response = await request.respond(HTTPResponse("WSGI call error.", 500))
+                        await response.send(end_stream=True)
+                        return response
+                    http_response = HTTPResponse(**response_args)
+                    response = await request.respond(http_response)
+                    if response is not http_response:
+                        # Response middleware replaced the response, so the WSGI body is not used.
+                        if isinstance(response, BaseHTTPResponse):
+                            await response.send(end_stream=True)
+                        return response
+                    # Each chunk is held back until the next one arrives, so the last chunk goes out together
+                    # with the end of the stream. A body which fits in one chunk is then sent in a single write,
+                    # with a Content-Length, and chunked framing is only used for a longer body of unknown length.
+                    pending = b''.join(written)
+                    while chunk is not None:
+                        if pending:
+                            await response.send(pending, end_stream=False)
+                        pending = chunk
+                        chunk = await self._run_wsgi_blocking(executor, self._next_wsgi_chunk, body_iter)
+                    await response.send(pending, end_stream=True)
+                    return response
+                finally:
+                    await self._close_wsgi_return(wsgi_return, executor)
+            finally:
+                if wsgi_input is not None:
+                    wsgi_input.close()
+                if executor is not None:
+                    executor.release()
+    else:
+        async def call_wsgi_app(self, script_name, path_info, request, application, response_callback, stats=None):
+            if application.cache is not None or application.coalescer is not None:
+                response = await self._fetch_wsgi_shared(script_name, path_info, request, application,
+                                                         partial(self._call_wsgi_app, script_name, path_info,
+                                                                 request, application, False, stats))
+                return response_callback(response)
+            return await self._call_wsgi_app(script_name, path_info, request, application, response_callback, stats)
+
+        async def _call_wsgi_app(self, script_name, path_info, request, application, response_callback,
+                                 stats=None):
+            if application.process_pool is not None:
+                if not response_callback:
+                    return await self._call_wsgi_process(script_name, path_info, request, application)
+                return response_callback(await self._call_wsgi_process(script_name, path_info, request, application))
+            executor = application.executor
+            if executor is not None:
+                executor.acquire()
+            try:
+                environ = application.make_environ(script_name, path_info, request,
+                                                   multithread=self.use_wsgi_threads)
+                return await self._run_wsgi_app(executor, stats, self._call_wsgi, environ, application.app,
+                                                response_callback)
+            finally:
+                if executor is not None:
+                    executor.release()
+
+        async def stream_wsgi_app(self, script_name, path_info, request, application, write_callback,
+                                  stream_callback, stats=None):
+            """
+            Forwards each chunk of the WSGI body to the client as soon as the app produces it, using a
+            StreamingHTTPResponse. Each write is drained before the next chunk is pulled from the app.
+            """
+            executor = application.executor
+            if executor is not None:
+                executor.acquire()
+            try:
+                environ = application.make_environ(script_name, path_info, request,
+                                                   multithread=self.use_wsgi_threads)
+                wsgi_return, body_iter, response_args, written, chunk = \
+                    await self._start_wsgi_stream(environ, application, stats)
+            except BaseException:
+                if executor is not None:
+                    executor.release()
+                raise
+            if response_args is None:
+                await self._close_wsgi_return(wsgi_return, executor)
+                if executor is not None:
+                    executor.release()
+                return write_callback(HTTPResponse("WSGI call error.", 500))
+
+            async def _streaming_fn(response):
+                nonlocal chunk
+                try:
+                    for body_part in written:
+                        _written = response.write(body_part)
+                        if isawaitable(_written):
+                            await _written
+                    while chunk is not None:
+                        _written = response.write(chunk)
+                        if isawaitable(_written):
+                            await _written
+                        chunk = await self._run_wsgi_blocking(executor, self._next_wsgi_chunk, body_iter)
+                finally:
+                    await self._close_wsgi_return(wsgi_return, executor)
+                    if executor is not None:
+                        executor.release()
+
+            return stream_callback(StreamingHTTPResponse(_streaming_fn, **response_args))
+
+    def _make_asgi_scope(self, script_name, path_info, request, application):
+        headers = [(name.lower().encode('latin-1'), str(value).encode('latin-1'))
+                   for name, value in request.headers.items()]
+        # The path bytes exactly as they came in on the request line, before the dispatcher split them at the
+        # mount. path_info is still percent-encoded, so the ASGI path is its decoded form.
+        raw_url = getattr(request, 'raw_url', None)
+        raw_path = raw_url.partition(b'?')[0] if raw_url else (script_name + path_info).encode('utf-8')
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0', 'spec_version': '2.1'},
+            'http_version': request.version,
+            'method': request.method,
+            'scheme': self.get_request_scheme(request).decode('ascii'),
+            'path': unquote(path_info),
+            'raw_path': raw_path,
+            'root_path': script_name,
+            'query_string': request._parsed_url.query or b'',
+            'headers': headers,
+            'client': None,
+            'server': None,
+            'state': dict(application.lifespan.state),
+        }
+        params = _get_mount_params(request)
+        if params:
+            scope['root_path'] = _fill_script(script_name, params)
+            # Where Starlette's Mount puts the parameters it captures
+            scope['path_params'] = dict(params)
+        transport = getattr(request, 'transport', None)
+        if transport is not None:
+            for key, info in (('client', 'peername'), ('server', 'sockname')):
+                address = transport.get_extra_info(info)
+                if isinstance(address, tuple):
+                    scope[key] = tuple(address[:2])
+        return scope
 
     if IS_21_03:
-        async def call_wsgi_app(self, script_name, path_info, request, wsgi_app):
+        async def call_asgi_app(self, script_name, path_info, request, application):
+            """
+            Calls the ASGI app directly on the event loop. Its receive channel reads the request body from the
+            Sanic request stream on demand, and each body message it sends is written straight to the client.
+            """
+            scope = self._make_asgi_scope(script_name, path_info, request, application)
+            stream = request.stream
+            preloaded = request.body
+            body_pending = True
+            response_complete = Event()
+            http_response = None
+            response = None
+
+            async def _receive():
+                nonlocal body_pending, preloaded
+                if body_pending:
+                    if preloaded:
+                        data, preloaded = preloaded, None
+                        body_pending = bool(stream.request_body)
+                        return {'type': 'http.request', 'body': data, 'more_body': body_pending}
+                    data = await stream.read() if stream.request_body else None
+                    if data is None:
+                        body_pending = False
+                        return {'type': 'http.request', 'body': b'', 'more_body': False}
+                    return {'type': 'http.request', 'body': data, 'more_body': True}
+                await response_complete.wait()
+                return {'type': 'http.disconnect'}
+
+            async def _send(message):
+                nonlocal http_response, response
+                message_type = message['type']
+                if message_type == 'http.response.start':
+                    if http_response is not None:
+                        raise RuntimeError("ASGI app sent http.response.start more than once.")
+                    headers = Header([(name.decode('latin-1'), value.decode('latin-1'))
+                                      for name, value in message.get('headers', ())])
+                    http_response = HTTPResponse(status=message['status'], headers=headers,
+                                                 content_type=headers.get('content-type', 'application/octet-stream'))
+                elif message_type == 'http.response.body':
+                    if http_response is None:
+                        raise RuntimeError("ASGI app sent http.response.body before http.response.start.")
+                    if response_complete.is_set():
+                        return
+                    if response is None:
+                        response = await request.respond(http_response)
+                        if response is not http_response:
+                            # Response middleware replaced the response, so the ASGI body is not used.
+                            response_complete.set()
+                            if isinstance(response, BaseHTTPResponse):
+                                await response.send(end_stream=True)
+                            return
+                    more_body = message.get('more_body', False)
+                    await response.send(message.get('body', b''), end_stream=not more_body)
+                    if not more_body:
+                        response_complete.set()
 
-            if self.use_wsgi_threads:
-                return await self.parent_app.loop.run_in_executor(None, self._call_wsgi, script_name, path_info, request, wsgi_app, False)
-            else:
-                return self._call_wsgi(script_name, path_info, request, wsgi_app, False)
+            try:
+                await application.app(scope, _receive, _send)
+            finally:
+                response_complete.set()
+            if http_response is None:
+                response = await request.respond(HTTPResponse("ASGI call error.", 500))
+                await response.send(end_stream=True)
+            elif response is None:
+                # The app sent no body at all
+                response = await request.respond(http_response)
+                if isinstance(response, BaseHTTPResponse):
+                    await response.send(end_stream=True)
+            return response
     else:
-        async def call_wsgi_app(self, script_name, path_info, request, wsgi_app, response_callback):
-            if self.use_wsgi_threads:
-                return await self.parent_app.loop.run_in_executor(
-                    None, self._call_wsgi, script_name, path_info, request,
-                    wsgi_app, response_callback)
-            else:
-                return self._call_wsgi(script_name, path_info, request, wsgi_app, response_callback)
+        async def call_asgi_app(self, script_name, path_info, request, application, response_callback):
+            """
+            Calls the ASGI app directly on the event loop. This Sanic version has no response streaming
+            from a handler, so the ASGI response body is collected before it is sent.
+            """
+            scope = self._make_asgi_scope(script_name, path_info, request, application)
+            body_pending = True
+            response_complete = Event()
+            response_args = None
+            body_bytes = bytearray()
+
+            async def _receive():
+                nonlocal body_pending
+                if body_pending:
+                    body_pending = False
+                    return {'type': 'http.request', 'body': request.body or b'', 'more_body': False}
+                await response_complete.wait()
+                return {'type': 'http.disconnect'}
+
+            async def _send(message):
+                nonlocal response_args
+                message_type = message['type']
+                if message_type == 'http.response.start':
+                    headers = Header([(name.decode('latin-1'), value.decode('latin-1'))
+                                      for name, value in message.get('headers', ())])
+                    response_args = {'status': message['status'], 'headers': headers}
+                    if 'content-type' in headers:
+                        response_args['content_type'] = headers['content-type']
+                elif message_type == 'http.response.body':
+                    body_bytes.extend(message.get('body', b''))
+                    if not message.get('more_body', False):
+                        response_complete.set()
+
+            try:
+                await application.app(scope, _receive, _send)
+            finally:
+                response_complete.set()
+            if response_args is None:
+                return response_callback(HTTPResponse("ASGI call error.", 500))
+            http_response = HTTPResponse(**response_args)
+            http_response.body = bytes(body_bytes)
+            return response_callback(http_response)
+
     @staticmethod
     def get_request_scheme(request):
         try:
@@ -276,168 +1821,420 @@ class SanicDispatcherMiddleware(object):
             scheme = b'http'
         return scheme
 
-    def _get_application_by_route(self, request, use_host=False):
-        host = request.headers.get('Host', '')
-        scheme = self.get_request_scheme(request)
-        path = request._parsed_url.path
-        port = request._parsed_url.port
-        query_string = request._parsed_url.query
-        fragment = request._parsed_url.fragment
-        userinfo = request._parsed_url.userinfo
-        script = path
-        if ':' in host and port is None:
-            (host, port) = host.split(':', 1)[0:2]
-            port = port.encode('ascii')
-        host_bytes = host.encode('utf-8')
-
-        if use_host:
-            script = b'%s%s' % (host_bytes, script)
-        path_info = b''
-        while b'/' in script:
-            script_str = script.decode('utf-8')
-            try:
-                application = self.mounts[script_str]
-                break
-            except KeyError:
-                pass
-            script, last_item = script.rsplit(b'/', 1)
-            path_info = b'/%s%s' % (last_item, path_info)
-        else:
-            script_str = script.decode('utf-8')
-            application = self.mounts.get(script_str, None)
+    def _get_host_info(self, host_header):
+        """
+        :return: a tuple of (host, host as bytes, port as bytes or None), cached per Host header
+        """
+        host_info = self.host_info.get(host_header, None)
+        if host_info is not None:
+            return host_info
+        host, sep, port = host_header.partition(':')
+        host_info = (host, host.encode('utf-8'), port.encode('ascii') if sep else None)
+        if len(self.host_info) >= self.max_cached_hosts:
+            self.host_info.clear()
+        self.host_info[host_header] = host_info
+        return host_info
+
+    def _get_application_by_route(self, request):
+        parsed_url = request._parsed_url
+        path = parsed_url.path
+        host, host_bytes, port = self._get_host_info(request.headers.get('Host', ''))
+        router = self.router
+        params = {} if router.has_params else None
+        application, script_str, path_info = router.match(host, path, params)
         if application is not None:
-            request._parsed_url = SanicCompatURL(scheme, host_bytes, port,
-                                                 path_info, query_string, fragment, userinfo)
-            if IS_19_03:
-                # To trigger re-parse args
-                request.parsed_args = defaultdict(RequestParameters)
-            else:
-                request.parsed_args = None  # To trigger re-parse args
+            if params:
+                _set_mount_params(request, params)
+            if parsed_url.port is not None:
+                port = parsed_url.port
+            # Only the path changes. The query string is the same, so whatever has been parsed from it is kept.
+            request._parsed_url = SanicCompatURL(self.get_request_scheme(request), host_bytes, port,
+                                                 path_info, parsed_url.query, parsed_url.fragment,
+                                                 parsed_url.userinfo)
             path = request.path
         return application, script_str, path
 
+    @staticmethod
+    def _is_websocket_upgrade(request):
+        # The scheme was worked out once, with get_request_scheme, when the request was routed to a child
+        return request._parsed_url.schema == b'ws'
+
+    @staticmethod
+    async def _track_websocket(request, websockets, call):
+        """
+        Runs `call`, which dispatches a websocket upgrade to a child Sanic app. The child's handler does the
+        handshake on the parent's connection as usual, and is handed the upgraded connection. The handshake
+        is hooked, so the connection is counted and watched for idleness from the moment it is upgraded.
+        :raises ServiceUnavailable: if the mount already has as many connections as it allows
+        """
+        if websockets.is_full():
+            websockets.rejected += 1
+            raise ServiceUnavailable("Too many websocket connections.")
+        protocol = request.transport.get_protocol()
+        handshake = getattr(protocol, 'websocket_handshake', None)
+        if handshake is None:
+            # Not a websocket-capable connection, the child's handler will refuse it
+            return await call()
+        upgraded = False
+        watchdog = None
+
+        async def _websocket_handshake(request, subprotocols=None):
+            nonlocal upgraded, watchdog
+            ws = await handshake(request, subprotocols)
+            upgraded = True
+            websockets.open += 1
+            websockets.total += 1
+            if websockets.idle_timeout:
+                watchdog = ensure_future(websockets.watch(ws))
+            return ws
+        protocol.websocket_handshake = _websocket_handshake
+        try:
+            return await call()
+        finally:
+            del protocol.websocket_handshake
+            if upgraded:
+                websockets.open -= 1
+            if watchdog is not None:
+                watchdog.cancel()
+
     if IS_21_03:
         async def __call__(self, request):
+            if self.metrics is not None:
+                return await self._call_measured(request)
             # Assume at this point that we have no app. So we cannot know if we are on Websocket or not.
-            if self.hosts and len(self.hosts) > 0:
-                application, script, path = self._get_application_by_route(request, use_host=True)
-                if application is None:
-                    application, script, path = self._get_application_by_route(request, use_host=False)
-            else:
-                application, script, path = self._get_application_by_route(request)
+            application, script, path = self._get_application_by_route(request)
             if application is None:  # no child matches, call the parent
                 return await self.parent_handle_request(request)
+            if type(application) is LazyApplication:
+                return await self._call_lazy(request, application, script, path)
+            if application.websockets is not None and self._is_websocket_upgrade(request):
+                return await self._call_websocket(request, application, script, path)
+            if application.limiter is not None:
+                return await self._call_limited(request, application, script, path)
             return await self._call_2103(request, application, script, path)
+
+        async def _call_measured(self, request):
+            started = perf_counter()
+            application, script, path = self._get_application_by_route(request)
+            stats = self.metrics.mount(script)
+            stats.observe('routing', perf_counter() - started)
+            stats.requests += 1
+            try:
+                if application is None:
+                    return await self.parent_handle_request(request)
+                if type(application) is LazyApplication:
+                    return await self._call_lazy(request, application, script, path, stats)
+                if application.websockets is not None and self._is_websocket_upgrade(request):
+                    return await self._call_websocket(request, application, script, path, stats)
+                if application.limiter is not None:
+                    return await self._call_limited(request, application, script, path, stats)
+                return await self._call_2103(request, application, script, path, stats)
+            except ServiceUnavailable:
+                stats.rejected += 1
+                raise
+            except BaseException:
+                stats.errors += 1
+                raise
+            finally:
+                stats.observe('total', perf_counter() - started)
+
+        async def _call_limited(self, request, application, script, path, stats=None):
+            """Waits for a free slot in the mount's limiter before dispatching, or sheds the request."""
+            limiter = application.limiter
+            try:
+                await limiter.acquire()
+            except ServiceUnavailable:
+                if stats is not None:
+                    stats.rejected += 1
+                # Sent straight away, without preloading the body or running any middleware
+                response = limiter.shed_response()
+                request.stream.respond(response)
+                await response.send(end_stream=True)
+                return response
+            try:
+                return await self._call_2103(request, application, script, path, stats)
+            finally:
+                limiter.release()
+
+        async def _call_websocket(self, request, application, script, path, stats=None):
+            """Dispatches a websocket upgrade. It doesn't take a slot in the mount's limiter, as it is long-lived."""
+            return await self._track_websocket(request, application.websockets,
+                                               partial(self._call_2103, request, application, script, path, stats))
+
+        async def _call_lazy(self, request, lazy, script, path, stats=None):
+            """Loads the app behind a LazyApplication if it isn't loaded yet, then dispatches to it."""
+            application = await lazy.acquire(script)
+            try:
+                if application.websockets is not None and self._is_websocket_upgrade(request):
+                    return await self._call_websocket(request, application, script, path, stats)
+                if application.limiter is not None:
+                    return await self._call_limited(request, application, script, path, stats)
+                return await self._call_2103(request, application, script, path, stats)
+            finally:
+                lazy.release()
     else:
         async def __call__(self, request, write_callback, stream_callback):
+            if self.metrics is not None:
+                return await self._call_measured(request, write_callback, stream_callback)
             # Assume at this point that we have no app. So we cannot know if we are on Websocket or not.
-            if self.hosts and len(self.hosts) > 0:
-                application, script, path = self._get_application_by_route(request, use_host=True)
-                if application is None:
-                    application, script, path = self._get_application_by_route(request, use_host=False)
-            else:
-                application, script, path = self._get_application_by_route(request)
+            application, script, path = self._get_application_by_route(request)
             if application is None:  # no child matches, call the parent
                 return await self.parent_handle_request(request, write_callback, stream_callback)
+            if type(application) is LazyApplication:
+                return await self._call_lazy(request, application, script, path, write_callback, stream_callback)
+            if application.websockets is not None and self._is_websocket_upgrade(request):
+                return await self._call_websocket(request, application, script, path, write_callback,
+                                                  stream_callback)
+            if application.limiter is not None:
+                return await self._call_limited(request, application, script, path, write_callback, stream_callback)
             return await self._call_old(request, application, script, path, write_callback, stream_callback)
 
-    async def _call_old(self, request, application, script, path, write_callback, stream_callback):
-        real_write_callback = write_callback
-        real_stream_callback = stream_callback
-        response = False
-        streaming_response = False
-        def _write_callback(child_response):
-            nonlocal response
-            response = child_response
-
-        def _stream_callback(child_stream):
-            nonlocal streaming_response
-            streaming_response = child_stream
-
-        replaced_write_callback = _write_callback
-        replaced_stream_callback = _stream_callback
-        parent_app = self.parent_app
-        if application.apply_middleware and parent_app.request_middleware:
-            request.app = parent_app
-            for middleware in parent_app.request_middleware:
-                response = middleware(request)
-                if isawaitable(response):
-                    response = await response
-                if response:
-                    break
-        child_app = application.app
-        if not response and not streaming_response:
-            if isinstance(application, WsgiApplication):  # child is wsgi_app
-                await self.call_wsgi_app(script, path, request,
-                                         child_app, replaced_write_callback)
-            else:  # must be a sanic application
-                request.app = child_app
-                await child_app.handle_request(request, replaced_write_callback, replaced_stream_callback)
-
-        if application.apply_middleware and parent_app.response_middleware:
-            request.app = parent_app
-            for _middleware in parent_app.response_middleware:
-                _response = _middleware(request, response)
-                if isawaitable(_response):
-                    _response = await _response
-                if _response:
-                    response = _response
-                    break
-
-        while isawaitable(response):
-            response = await response
-        if streaming_response:
-            return real_stream_callback(streaming_response)
-        return real_write_callback(response)
-
-
-    async def _call_2103(self, request, application, script, path):
-
-        our_response = False
-        streaming_response = False
+        async def _call_measured(self, request, write_callback, stream_callback):
+            started = perf_counter()
+            application, script, path = self._get_application_by_route(request)
+            stats = self.metrics.mount(script)
+            stats.observe('routing', perf_counter() - started)
+            stats.requests += 1
+            try:
+                if application is None:
+                    return await self.parent_handle_request(request, write_callback, stream_callback)
+                if type(application) is LazyApplication:
+                    return await self._call_lazy(request, application, script, path, write_callback,
+                                                 stream_callback, stats)
+                if application.websockets is not None and self._is_websocket_upgrade(request):
+                    return await self._call_websocket(request, application, script, path, write_callback,
+                                                      stream_callback, stats)
+                if application.limiter is not None:
+                    return await self._call_limited(request, application, script, path, write_callback,
+                                                    stream_callback, stats)
+                return await self._call_old(request, application, script, path, write_callback,
+                                            stream_callback, stats)
+            except BaseException:
+                stats.errors += 1
+                raise
+            finally:
+                stats.observe('total', perf_counter() - started)
 
-        if request.stream.request_body:  # type: ignore
-            # Non-streaming handler: preload body
-            await request.receive_body()
+        async def _call_limited(self, request, application, script, path, write_callback, stream_callback,
+                                stats=None):
+            """Waits for a free slot in the mount's limiter before dispatching, or sheds the request."""
+            limiter = application.limiter
+            try:
+                await limiter.acquire()
+            except ServiceUnavailable:
+                if stats is not None:
+                    stats.rejected += 1
+                return write_callback(limiter.shed_response())
+            try:
+                return await self._call_old(request, application, script, path, write_callback, stream_callback,
+                                            stats)
+            finally:
+                limiter.release()
+
+        async def _call_websocket(self, request, application, script, path, write_callback, stream_callback,
+                                  stats=None):
+            """Dispatches a websocket upgrade. It doesn't take a slot in the mount's limiter, as it is long-lived."""
+            try:
+                return await self._track_websocket(request, application.websockets,
+                                                   partial(self._call_old, request, application, script, path,
+                                                           write_callback, stream_callback, stats))
+            except ServiceUnavailable as e:
+                if stats is not None:
+                    stats.rejected += 1
+                response = self.parent_app.error_handler.response(request, e)
+                while isawaitable(response):
+                    response = await response
+                return write_callback(response)
 
-        parent_app = self.parent_app
-        if application.apply_middleware and parent_app.request_middleware:
-            request.app = parent_app
-            for middleware in parent_app.request_middleware:
-                our_response = middleware(request)
-                if isawaitable(our_response):
-                    our_response = await our_response
-                if our_response:
-                    break
-        child_app = application.app
-        if application.apply_middleware:
-            request = SanicComatRequest(request, parent_app)
-        if not our_response and not streaming_response:
-            if isinstance(application, WsgiApplication):  # child is wsgi_app
-                our_response = await self.call_wsgi_app(script, path, request, child_app)
-            else:  # must be a sanic application
-                request.app = child_app
-                return await child_app.handle_request(request)
-        if our_response is not None:
+        async def _call_lazy(self, request, lazy, script, path, write_callback, stream_callback, stats=None):
+            """Loads the app behind a LazyApplication if it isn't loaded yet, then dispatches to it."""
+            application = await lazy.acquire(script)
             try:
-                our_response = await request.respond(our_response)
-            except BaseException:
-                # Skip response middleware
+                if application.websockets is not None and self._is_websocket_upgrade(request):
+                    return await self._call_websocket(request, application, script, path, write_callback,
+                                                      stream_callback, stats)
+                if application.limiter is not None:
+                    return await self._call_limited(request, application, script, path, write_callback,
+                                                    stream_callback, stats)
+                return await self._call_old(request, application, script, path, write_callback, stream_callback,
+                                            stats)
+            finally:
+                lazy.release()
+
+    async def _call_old(self, request, application, script, path, write_callback, stream_callback, stats=None):
+        # Counted, so an app which is unmounted is only stopped once the requests routed to it are done
+        application.in_flight += 1
+        try:
+            real_write_callback = write_callback
+            real_stream_callback = stream_callback
+            response = False
+            streaming_response = False
+            def _write_callback(child_response):
+                nonlocal response
+                response = child_response
+
+            def _stream_callback(child_stream):
+                nonlocal streaming_response
+                streaming_response = child_stream
+
+            replaced_write_callback = _write_callback
+            replaced_stream_callback = _stream_callback
+            parent_app = self.parent_app
+            chain = self._middleware_chain() if application.apply_middleware else None
+            if chain is not None and chain.request_middleware:
+                if stats is not None:
+                    started = perf_counter()
+                request.app = parent_app
+                response = await chain.run_request(request)
+                if stats is not None:
+                    stats.observe('middleware', perf_counter() - started)
+            child_app = application.app
+            if not response and not streaming_response:
+                if stats is not None:
+                    started = perf_counter()
+                if isinstance(application, AsgiApplication):  # child is asgi_app
+                    await self.call_asgi_app(script, path, request, application, replaced_write_callback)
+                elif isinstance(application, WsgiApplication):  # child is wsgi_app
+                    try:
+                        if application.stream_response:
+                            await self.stream_wsgi_app(script, path, request, application,
+                                                       replaced_write_callback, replaced_stream_callback, stats)
+                        else:
+                            await self.call_wsgi_app(script, path, request,
+                                                     application, replaced_write_callback, stats)
+                    except ServiceUnavailable as e:
+                        if stats is not None:
+                            stats.rejected += 1
+                        response = parent_app.error_handler.response(request, e)
+                        while isawaitable(response):
+                            response = await response
+                else:  # must be a sanic application
+                    request.app = child_app
+                    await child_app.handle_request(request, replaced_write_callback, replaced_stream_callback)
+                if stats is not None:
+                    stats.observe('child', perf_counter() - started)
+
+            if chain is not None and chain.response_middleware:
+                if stats is not None:
+                    started = perf_counter()
+                request.app = parent_app
+                response = await chain.run_response(request, response)
+                if stats is not None:
+                    stats.observe('middleware', perf_counter() - started)
+
+            while isawaitable(response):
+                response = await response
+            if streaming_response:
+                return real_stream_callback(streaming_response)
+            return real_write_callback(response)
+        finally:
+            application.in_flight -= 1
+
+
+    def _compat_request(self, request):
+        """
+        Switches the request over to a subclass of its own class, which has the parent app attached and
+        runs the parent's response middleware from respond(). The subclass is built once per request class.
+        """
+        parent_app = self.parent_app
+        request_class = type(request)
+        compat_class = self.compat_request_classes.get(request_class, None)
+        if compat_class is None:
+            compat_class = type(request_class.__name__, (SanicCompatRequestMixin, request_class),
+                                {'__slots__': (), '__module__': request_class.__module__,
+                                 'parent_app': parent_app, 'dispatcher': self})
+            self.compat_request_classes[request_class] = compat_class
+        try:
+            request.__class__ = compat_class
+        except TypeError:
+            return SanicComatRequest(request, parent_app, self)
+        return request
+
+    async def _call_2103(self, request, application, script, path, stats=None):
+        # Counted, so an app which is unmounted is only stopped once the requests routed to it are done
+        application.in_flight += 1
+        try:
+            our_response = False
+            streaming_response = False
+
+            if request.stream.request_body:  # type: ignore
+                if isinstance(application, WsgiApplication) and application.stream_request_body and \
+                        self.use_wsgi_threads:
+                    # The WSGI app reads the body from the request stream itself, through wsgi.input
+                    pass
+                elif isinstance(application, AsgiApplication):
+                    # The ASGI app receives the body from the request stream itself
+                    pass
+                else:
+                    # Non-streaming handler: preload body
+                    await request.receive_body()
+
+            parent_app = self.parent_app
+            chain = self._middleware_chain() if application.apply_middleware else None
+            if chain is not None and chain.request_middleware:
+                if stats is not None:
+                    started = perf_counter()
+                request.app = parent_app
+                our_response = await chain.run_request(request)
+                if stats is not None:
+                    stats.observe('middleware', perf_counter() - started)
+            child_app = application.app
+            if application.apply_middleware:
+                request = self._compat_request(request)
+            if not our_response and not streaming_response:
+                if stats is not None:
+                    started = perf_counter()
+                try:
+                    if isinstance(application, WsgiApplication):  # child is wsgi_app
+                        if application.stream_response:
+                            return await self.stream_wsgi_app(script, path, request, application, stats)
+                        our_response = await self.call_wsgi_app(script, path, request, application, stats)
+                    elif isinstance(application, AsgiApplication):  # child is asgi_app
+                        return await self.call_asgi_app(script, path, request, application)
+                    else:  # must be a sanic application
+                        request.app = child_app
+                        return await child_app.handle_request(request)
+                finally:
+                    if stats is not None:
+                        stats.observe('child', perf_counter() - started)
+            if stats is not None:
+                started = perf_counter()
+            if our_response is not None:
+                try:
+                    our_response = await request.respond(our_response)
+                except BaseException:
+                    # Skip response middleware
+                    if request.stream:
+                        request.stream.respond(our_response)
+                    await our_response.send(end_stream=True)
+                    raise
+                if stats is not None and application.apply_middleware:
+                    # Only count respond() as middleware time if the parent's middleware was applied
+                    now = perf_counter()
+                    stats.observe('middleware', now - started)
+                    started = now
+            else:
                 if request.stream:
-                    request.stream.respond(our_response)
+                    our_response = request.stream.response
+            if isinstance(our_response, BaseHTTPResponse):
                 await our_response.send(end_stream=True)
-                raise
-        else:
-            if request.stream:
-                our_response = request.stream.response
-        if isinstance(our_response, BaseHTTPResponse):
-            await our_response.send(end_stream=True)
-        return our_response
+            if stats is not None:
+                stats.observe('send', perf_counter() - started)
+            return our_response
+        finally:
+            application.in_flight -= 1
 
 
 class SanicDispatcherMiddlewareController(object):
     __slots__ = ['parent_app', 'parent_handle_request', 'parent_url_for', 'applications', 'url_prefix',
-                 'filter_host', 'hosts', 'started']
+                 'filter_host', 'hosts', 'started', 'url_index', 'url_cache', 'metrics', 'dispatcher', 'app_urls',
+                 'running', 'lifecycle_timings', 'snapshot', 'snapshot_interval', 'snapshot_task', 'shared_apps',
+                 'app_keys', 'starting', 'lifecycle_tasks', 'child_views', 'app_settings']
+
+    # How often an unmounted application is checked for requests still in flight, in seconds
+    drain_interval = 0.01
+    # Upper bound on url_cache, so it can't be grown without limit by url_for() arguments
+    max_cached_urls = 4096
 
     def __init__(self, app, url_prefix=None, host=None):
         """
@@ -454,6 +2251,29 @@ class SanicDispatcherMiddlewareController(object):
         else:
             self.filter_host = None
         self.started = False
+        self.running = False
+        self.url_index = {}
+        self.url_cache = {}
+        self.child_views = set()
+        self.metrics = None
+        self.dispatcher = None
+        # Maps id() of each registered app to the urls it is mounted at, in registration order
+        self.app_urls = {}
+        # Maps each child's url to how long each of its lifecycle events took, in seconds
+        self.lifecycle_timings = {}
+        self.snapshot = None
+        self.snapshot_interval = None
+        self.snapshot_task = None
+        # Maps the key of each app in the shared mount table to the registered application it stands for
+        self.shared_apps = {}
+        # Maps id() of each app in the shared mount table to its key
+        self.app_keys = {}
+        # Maps the lifecycle key of each app being started while the server runs to its start task
+        self.starting = {}
+        # The tasks which start, route and stop apps mounted and unmounted while the server runs
+        self.lifecycle_tasks = set()
+        # Maps id() of each child Sanic app which has been started to (app, its server settings)
+        self.app_settings = {}
         self.parent_app.register_listener(self._before_server_start_listener, 'before_server_start')
         self.parent_app.register_listener(self._after_server_start_listener, 'after_server_start')
         self.parent_app.register_listener(self._before_server_stop_listener, 'before_server_stop')
@@ -470,24 +2290,15 @@ class SanicDispatcherMiddlewareController(object):
     async def _before_server_start_listener(self, app, loop):
         if self.started is True:
             raise RuntimeError("Cannot start a sanic parent application more than once.")
-        has_ws = False
-        for route, child_app in self.applications.items():
-            if isinstance(child_app, SanicApplication):
-                s_app = child_app.app
-                is_ws = getattr(s_app, 'websocket_enabled', False)
-                protocol = WebSocketProtocol if is_ws else HttpProtocol
-                server_settings = s_app._helper(host=None, port=None, loop=loop,
-                                                protocol=protocol, run_async=False)
-                child_app.server_settings = server_settings
-                await s_app.trigger_events(
-                    server_settings.get("before_start", []),
-                    server_settings.get("loop"),
-                )
-                has_ws = has_ws or is_ws
+        # Routes can still be added to any app up until the server starts
+        self._clear_url_index()
+        has_ws = any(getattr(child_app.app, 'websocket_enabled', False) for child_app in self.applications.values()
+                     if isinstance(child_app, SanicApplication))
         if not getattr(app, 'websocket_enabled', False) and has_ws:
             raise RuntimeError(
                 "Found child apps with Websockets enabled, but parent app is not Websockets enabled.\n"
                 "Add parent_app.enable_websocket() before starting the app.")
+        await self._run_lifecycle_event('before_start', loop)
 
     async def _after_server_start_listener(self, app, loop):
         is_asgi = getattr(app, 'asgi', False)
@@ -495,32 +2306,187 @@ class SanicDispatcherMiddlewareController(object):
             error_logger.warning("Sanic-Dispatcher has not been tested on ASGI apps. It may not work correctly.")
 
         self.started = True
-
-        for route, child_app in self.applications.items():
-            if isinstance(child_app, SanicApplication):
-                server_settings = child_app.server_settings
-                await child_app.app.trigger_events(
-                    server_settings.get("after_start", []),
-                    server_settings.get("loop"),
-                )
+        self.running = True
+        await self._run_lifecycle_event('after_start', loop)
+        if self.snapshot is not None:
+            self.snapshot_task = ensure_future(self._follow_snapshot())
 
     async def _before_server_stop_listener(self, app, loop):
-        for route, child_app in self.applications.items():
-            if isinstance(child_app, SanicApplication):
-                server_settings = child_app.server_settings
-                await child_app.app.trigger_events(
-                    server_settings.get("before_stop", []),
-                    server_settings.get("loop"),
-                )
+        self.running = False
+        if self.snapshot_task is not None:
+            self.snapshot_task.cancel()
+            self.snapshot_task = None
+        for child_app in self.applications.values():
+            if type(child_app) is LazyApplication and child_app.watcher is not None:
+                child_app.watcher.cancel()
+        # Apps which haven't finished starting are stopped with the rest, apps being stopped finish stopping
+        for task in self.starting.values():
+            task.cancel()
+        if self.lifecycle_tasks:
+            await gather(*self.lifecycle_tasks, return_exceptions=True)
+        await self._run_lifecycle_event('before_stop', loop)
 
     async def _after_server_stop_listener(self, app, loop):
-        for route, child_app in self.applications.items():
-            if isinstance(child_app, SanicApplication):
-                server_settings = child_app.server_settings
-                await child_app.app.trigger_events(
-                    server_settings.get("after_stop", []),
-                    server_settings.get("loop"),
-                )
+        await self._run_lifecycle_event('after_stop', loop)
+
+    @staticmethod
+    def _lifecycle_key(child_app):
+        """
+        Identifies what a registered application's lifecycle events act on, so that host aliases and
+        repeat registrations sharing it only run them once. None if there is nothing to run.
+        """
+        if isinstance(child_app, SanicApplication):
+            return id(child_app.app)
+        elif isinstance(child_app, WsgiApplication):
+            if child_app.process_pool is not None:
+                return id(child_app.process_pool)
+            return None if child_app.executor is None else id(child_app.executor)
+        elif isinstance(child_app, AsgiApplication):
+            return id(child_app.lifespan)
+        return None
+
+    async def _run_lifecycle_event(self, event, loop):
+        """
+        Runs one lifecycle event on all of the child applications at once, once per app instance.
+        """
+        children = {}
+        for url, child_app in self._mounted_applications():
+            key = self._lifecycle_key(child_app)
+            if key is None:
+                continue
+            children.setdefault(key, (url, child_app))
+        results = await gather(*(self._run_child_event(event, url, child_app, loop)
+                                 for url, child_app in children.values()))
+        if event == 'before_start':
+            # Aliases share the settings of the instance that actually ran the listeners
+            for url, child_app in self._mounted_applications():
+                if isinstance(child_app, SanicApplication):
+                    child_app.server_settings = children[id(child_app.app)][1].server_settings
+        return results
+
+    def _mounted_applications(self):
+        """
+        Yields (url, registered application) for each mount, with each LazyApplication replaced by the
+        application it has loaded. Lazy applications which haven't been loaded are left out.
+        """
+        for url, child_app in self.applications.items():
+            if type(child_app) is LazyApplication:
+                child_app = child_app.loaded.get(url, None)
+                if child_app is None:
+                    continue
+            yield url, child_app
+
+    async def _run_child_event(self, event, url, child_app, loop):
+        """
+        Runs one lifecycle event on one child application. A failure is logged rather than raised, so
+        it doesn't stop the other children. The time taken goes into lifecycle_timings.
+        :return: True if the event ran without error
+        """
+        started = perf_counter()
+        try:
+            if event == 'before_start':
+                await self._before_start_application(child_app, loop)
+            elif event == 'after_start':
+                await self._after_start_application(child_app)
+            elif event == 'before_stop':
+                await self._before_stop_application(child_app)
+            else:
+                await self._after_stop_application(child_app)
+        except Exception:
+            error_logger.exception("Child application mounted at {} failed in {}.".format(url, event))
+            return False
+        finally:
+            duration = perf_counter() - started
+            self.lifecycle_timings.setdefault(url, {})[event] = duration
+        logger.debug("Child application mounted at {} ran {} in {:.3f}s.".format(url, event, duration))
+        return True
+
+    def _child_server_settings(self, s_app, loop):
+        """
+        Works out the server settings a child Sanic app's listeners run with, once per app instance.
+        Each call to Sanic's _helper() adds another router finalize listener to the app, and on Sanic 21.3
+        finalizing a second time fails outside of test mode. So an app which is started again, after an
+        unload or a re-registration, reuses its settings without the finalize listener.
+        """
+        cached = self.app_settings.get(id(s_app), None)
+        if cached is None or cached[0] is not s_app:
+            # The child doesn't get a server of its own, its requests and websockets are served by the
+            # parent's connections, so no protocol is picked for it here
+            server_settings = s_app._helper(host=None, port=None, loop=loop, run_async=False)
+            self.app_settings[id(s_app)] = (s_app, server_settings)
+            return server_settings
+        server_settings = dict(cached[1], loop=loop)
+        finalize = getattr(Sanic, 'finalize', None)
+        if finalize is not None:
+            server_settings['before_start'] = [listener for listener in server_settings.get('before_start', [])
+                                               if getattr(listener, 'func', None) is not finalize]
+        return server_settings
+
+    async def _before_start_application(self, child_app, loop):
+        if isinstance(child_app, SanicApplication):
+            s_app = child_app.app
+            server_settings = self._child_server_settings(s_app, loop)
+            child_app.server_settings = server_settings
+            await s_app.trigger_events(
+                server_settings.get("before_start", []),
+                server_settings.get("loop"),
+            )
+        elif isinstance(child_app, WsgiApplication):
+            if child_app.executor is not None:
+                child_app.executor.start()
+            if child_app.process_pool is not None:
+                child_app.process_pool.start()
+        elif isinstance(child_app, AsgiApplication):
+            await child_app.lifespan.startup()
+
+    @staticmethod
+    async def _after_start_application(child_app):
+        if isinstance(child_app, SanicApplication):
+            server_settings = child_app.server_settings
+            await child_app.app.trigger_events(
+                server_settings.get("after_start", []),
+                server_settings.get("loop"),
+            )
+
+    @staticmethod
+    async def _before_stop_application(child_app):
+        if isinstance(child_app, SanicApplication):
+            server_settings = child_app.server_settings
+            await child_app.app.trigger_events(
+                server_settings.get("before_stop", []),
+                server_settings.get("loop"),
+            )
+        elif isinstance(child_app, AsgiApplication):
+            await child_app.lifespan.shutdown()
+
+    @staticmethod
+    async def _after_stop_application(child_app):
+        if isinstance(child_app, SanicApplication):
+            server_settings = child_app.server_settings
+            await child_app.app.trigger_events(
+                server_settings.get("after_stop", []),
+                server_settings.get("loop"),
+            )
+        elif isinstance(child_app, WsgiApplication):
+            if child_app.executor is not None:
+                child_app.executor.shutdown()
+            if child_app.process_pool is not None:
+                child_app.process_pool.shutdown()
+
+    async def _hot_start_application(self, url, child_app):
+        """
+        Starts an application which was registered while the server was already running.
+        :return: True if its start listeners all ran without error
+        """
+        loop = get_event_loop()
+        return await self._run_child_event('before_start', url, child_app, loop) and \
+            await self._run_child_event('after_start', url, child_app, loop)
+
+    async def _hot_stop_application(self, url, child_app):
+        """Stops an application which was unregistered while the server was still running."""
+        loop = get_event_loop()
+        await self._run_child_event('before_stop', url, child_app, loop)
+        await self._run_child_event('after_stop', url, child_app, loop)
 
     def _determine_uri(self, url_prefix, host=None):
         uri = ''
@@ -534,72 +2500,268 @@ class SanicDispatcherMiddlewareController(object):
         uri += url_prefix
         return uri
 
-    def register_app(self, app, url_prefix, host=None, apply_middleware=False):
+    def register_app(self, app, url_prefix, host=None, apply_middleware=False, **kwargs):
         if isinstance(app, Sanic):
             self.register_sanic_application(app, url_prefix, host=host,
-                                            apply_middleware=apply_middleware)
+                                            apply_middleware=apply_middleware, **kwargs)
+        elif iscoroutinefunction(app) or iscoroutinefunction(getattr(app, '__call__', None)):
+            self.register_asgi_application(app, url_prefix, host=host,
+                                           apply_middleware=apply_middleware, **kwargs)
         else:
             self.register_wsgi_application(app, url_prefix, host=host,
-                                           apply_middleware=apply_middleware)
+                                           apply_middleware=apply_middleware, **kwargs)
 
-    def register_sanic_application(self, application, url_prefix, host=None, apply_middleware=False):
+    def register_sanic_application(self, application, url_prefix, host=None, apply_middleware=False,
+                                   max_in_flight=None, max_queued=None, queue_timeout=None, max_websockets=None,
+                                   websocket_idle_timeout=None):
         """
         :param Sanic application:
         :param url_prefix:
         :param host:
         :param apply_middleware:
+        :param max_in_flight: The most requests this app may handle at once. Defaults to unlimited.
+        :param max_queued: How many more requests may wait for a free slot. Any more are shed with a 503.
+        :param queue_timeout: Seconds a request may wait for a free slot before it is shed with a 503.
+        :param max_websockets: The most websocket connections this app may have open at once. Any more
+                               upgrades are refused with a 503. Defaults to unlimited.
+        :param websocket_idle_timeout: Close websocket connections which send and receive no messages for
+                                       this many seconds.
         :return:
         """
-        if self.started is True:
-            raise warn("Registering an application when the server is already started may work,"
-                       "but is not supported.")
         assert isinstance(application, Sanic),\
             "Pass only instances of Sanic to register_sanic_application."
+        if self.running and getattr(application, 'websocket_enabled', False) and \
+                not getattr(self.parent_app, 'websocket_enabled', False):
+            raise RuntimeError("Cannot register a child app with Websockets enabled, because the parent app is "
+                               "not Websockets enabled.")
         if str(url_prefix).endswith('/'):
             url_prefix = url_prefix[:-1]
-        if host is not None and isinstance(host, (list, set)):
-            for _host in host:
-                self.register_sanic_application(application, url_prefix, host=_host,
-                                                apply_middleware=apply_middleware)
-            return
-
-        registered_service_url = self._determine_uri(url_prefix, host)
-        self.applications[registered_service_url] = SanicApplication(application, apply_middleware)
-        self._update_request_handler()
+        # All of the host aliases of one app share the same limits
+        limiter = self._make_limiter(max_in_flight, max_queued, queue_timeout)
+        websockets = WebsocketMount(max_websockets, websocket_idle_timeout)
+        hosts = host if host is not None and isinstance(host, (list, set)) else [host]
+        for _host in hosts:
+            registered_service_url = self._determine_uri(url_prefix, _host)
+            self._mount(registered_service_url, SanicApplication(application, apply_middleware, limiter, websockets))
 
-    def register_wsgi_application(self, application, url_prefix, host=None, apply_middleware=False):
+    @staticmethod
+    def _make_limiter(max_in_flight, max_queued, queue_timeout):
+        if max_in_flight is None:
+            return None
+        return MountLimiter(max_in_flight, max_queued, queue_timeout)
+
+    def register_wsgi_application(self, application, url_prefix, host=None, apply_middleware=False,
+                                  stream_response=False, stream_request_body=False, executor_workers=None,
+                                  executor_queue=None, process_workers=None, process_max_requests=None,
+                                  process_timeout=None, max_in_flight=None, max_queued=None, queue_timeout=None,
+                                  cache_max_bytes=None, cache_ttl=0, coalesce_requests=False, coalesce_headers=None,
+                                  coalesce_private='bypass'):
         """
-        :param application:
+        :param application: The WSGI app. With process_workers, this can also be an import string
+                            like 'package.module:app', which each worker process imports for itself.
         :param url_prefix:
         :param apply_middleware:
+        :param stream_response: Send each chunk of the WSGI response body to the client as it is produced,
+                                rather than buffering the whole body first.
+        :param executor_workers: Run this app on its own pool of this many threads, instead of on the
+                                 event loop's default executor.
+        :param executor_queue: How many requests may wait for a free thread in the app's own pool. Any more
+                               than that are refused with a 503. Defaults to unbounded.
+        :param stream_request_body: Don't preload the request body, let the WSGI app read it from the request
+                                    stream on demand through wsgi.input instead. (Sanic 21.03+ only)
+        :param process_workers: Run this app in its own pool of this many worker processes, for CPU-bound
+                                apps which would otherwise hold the GIL. The app or its import string must be
+                                picklable. Can't be combined with streaming or executor_workers.
+        :param process_max_requests: Replace the worker processes after this many requests.
+        :param process_timeout: Seconds to wait for a worker process to respond before answering with a 504.
+        :param max_in_flight: The most requests this app may handle at once. Defaults to unlimited.
+        :param max_queued: How many more requests may wait for a free slot. Any more are shed with a 503.
+        :param queue_timeout: Seconds a request may wait for a free slot before it is shed with a 503.
+        :param cache_max_bytes: Cache the app's GET and HEAD responses, in at most this many bytes. Only
+                                responses with Cache-Control max-age or s-maxage are cached, unless cache_ttl
+                                is given. Can't be combined with stream_response.
+        :param cache_ttl: Seconds to cache responses which don't say how long they are fresh for.
+        :param coalesce_requests: Let identical GET and HEAD requests which arrive while the first of them is
+                                  being handled share its response, rather than each calling the app. Can't be
+                                  combined with stream_response.
+        :param coalesce_headers: Names of request headers which must also match for requests to be identical.
+        :param coalesce_private: How to coalesce requests with a Cookie or Authorization header. 'bypass' never
+                                 coalesces them, 'key' only with requests which have the same Cookie and
+                                 Authorization headers, and 'share' coalesces them like any other request.
         :return:
         """
-        if self.started is True:
-            raise RuntimeError("Cannot register an application when the server is already started.")
+        if cache_max_bytes or coalesce_requests:
+            assert not stream_response, \
+                "cache_max_bytes and coalesce_requests can't be combined with stream_response."
+        if process_workers:
+            if sys.version_info < (3, 7):
+                raise RuntimeError("process_workers needs Python 3.7 or greater.")
+            assert not (stream_response or stream_request_body or executor_workers),\
+                "process_workers can't be combined with stream_response, stream_request_body or executor_workers."
+        else:
+            assert not isinstance(application, str),\
+                "Import strings can only be registered with process_workers."
         if str(url_prefix).endswith('/'):
             url_prefix = url_prefix[:-1]
+        # All of the host aliases of one app share the same thread or process pool
+        executor = WsgiExecutor(executor_workers, executor_queue) if executor_workers else None
+        process_pool = WsgiProcessPool(application, process_workers, process_max_requests, process_timeout)\
+            if process_workers else None
+        limiter = self._make_limiter(max_in_flight, max_queued, queue_timeout)
+        cache = ResponseCache(cache_max_bytes, cache_ttl) if cache_max_bytes else None
+        coalescer = RequestCoalescer(coalesce_headers, coalesce_private) if coalesce_requests else None
         if host is not None and isinstance(host, (list, set)):
             for _host in host:
-                self.register_wsgi_application(application, url_prefix, host=_host,
-                                               apply_middleware=apply_middleware)
+                self._register_wsgi_application(application, url_prefix, _host, apply_middleware,
+                                                stream_response, stream_request_body, executor, process_pool,
+                                                limiter, cache, coalescer)
             return
+        self._register_wsgi_application(application, url_prefix, host, apply_middleware, stream_response,
+                                        stream_request_body, executor, process_pool, limiter, cache, coalescer)
 
+    def _register_wsgi_application(self, application, url_prefix, host, apply_middleware, stream_response,
+                                   stream_request_body, executor, process_pool=None, limiter=None, cache=None,
+                                   coalescer=None):
         registered_service_url = self._determine_uri(url_prefix, host)
-        self.applications[registered_service_url] = WsgiApplication(application, apply_middleware)
-        self._update_request_handler()
+        self._mount(registered_service_url, WsgiApplication(application, apply_middleware,
+                                                            stream_response=stream_response,
+                                                            stream_request_body=stream_request_body,
+                                                            executor=executor, process_pool=process_pool,
+                                                            limiter=limiter, cache=cache, coalescer=coalescer))
+
+    def register_asgi_application(self, application, url_prefix, host=None, apply_middleware=False,
+                                  max_in_flight=None, max_queued=None, queue_timeout=None):
+        """
+        :param application: An ASGI 3 application, eg a Starlette or FastAPI app
+        :param url_prefix:
+        :param host:
+        :param apply_middleware:
+        :param max_in_flight: The most requests this app may handle at once. Defaults to unlimited.
+        :param max_queued: How many more requests may wait for a free slot. Any more are shed with a 503.
+        :param queue_timeout: Seconds a request may wait for a free slot before it is shed with a 503.
+        :return:
+        """
+        if str(url_prefix).endswith('/'):
+            url_prefix = url_prefix[:-1]
+        # All of the host aliases of one app share the same lifespan
+        lifespan = AsgiLifespan(application)
+        limiter = self._make_limiter(max_in_flight, max_queued, queue_timeout)
+        hosts = host if host is not None and isinstance(host, (list, set)) else [host]
+        for _host in hosts:
+            registered_service_url = self._determine_uri(url_prefix, _host)
+            self._mount(registered_service_url, AsgiApplication(application, apply_middleware, lifespan, limiter))
+
+    def register_lazy_application(self, loader, url_prefix, host=None, apply_middleware=False, idle_timeout=None,
+                                  **kwargs):
+        """
+        Registers an app which isn't imported or built until its first request. Requests which arrive
+        while it is loading wait for it. Its start listeners run once it is loaded, before any request
+        is dispatched to it.
+        :param loader: An import string for the app, like 'package.module:app', or a function which takes no
+                       arguments and returns the app
+        :param url_prefix:
+        :param host:
+        :param apply_middleware:
+        :param idle_timeout: Stop and unload the app once it has had no requests for this many seconds. It is
+                             loaded again on its next request. A module imported from an import string stays
+                             imported, so only a factory builds a fresh app.
+        :param kwargs: Passed on to register_sanic_application, register_wsgi_application or
+                       register_asgi_application, once the app is loaded
+        :return:
+        """
+        assert isinstance(loader, str) or callable(loader),\
+            "Pass an import string or a factory function to register_lazy_application."
+        if str(url_prefix).endswith('/'):
+            url_prefix = url_prefix[:-1]
+        lazy = LazyApplication(loader, url_prefix, host, apply_middleware, idle_timeout, kwargs)
+        lazy.loader = partial(self._load_lazy, lazy)
+        hosts = host if host is not None and isinstance(host, (list, set)) else [host]
+        for _host in hosts:
+            self._mount(self._determine_uri(url_prefix, _host), lazy)
+
+    async def _load_lazy(self, lazy):
+        loader = lazy.app
+        app = _resolve_wsgi_app(loader) if isinstance(loader, str) else loader()
+        if isawaitable(app):
+            app = await app
+        lazy.loading = {}
+        try:
+            # Each of the mounts this makes lands in lazy.loading, rather than replacing the LazyApplication
+            self.register_app(app, lazy.url_prefix, host=lazy.host, apply_middleware=lazy.apply_middleware,
+                              **lazy.options)
+            loaded = lazy.loading
+        finally:
+            lazy.loading = None
+        if self.running:
+            # Host aliases share the app, so its listeners only run once
+            started = {}
+            for url, reg_application in loaded.items():
+                key = self._lifecycle_key(reg_application)
+                first = started.get(key, None) if key is not None else None
+                if first is None:
+                    if not await self._hot_start_application(url, reg_application):
+                        # Not loaded, so the next request tries again
+                        if not isinstance(lazy.app, str):
+                            self._forget_built_app(reg_application.app)
+                            self.app_settings.pop(id(reg_application.app), None)
+                        raise SanicException("The app for {} failed to start.".format(url), 500)
+                    started[key] = reg_application
+                elif isinstance(reg_application, SanicApplication):
+                    reg_application.server_settings = first.server_settings
+        lazy.loaded = loaded
+        lazy.loads += 1
+        self._clear_url_index()
+        if lazy.idle_timeout and lazy.watcher is None and self.running:
+            lazy.watcher = ensure_future(self._watch_lazy(lazy))
+
+    async def _watch_lazy(self, lazy):
+        """Unloads a LazyApplication's app once it has been idle for its idle_timeout."""
+        try:
+            while lazy.loaded:
+                idle = monotonic() - lazy.last_used
+                if lazy.in_flight == 0 and idle >= lazy.idle_timeout:
+                    await lazy.flights.run(None, partial(self._unload_lazy, lazy))
+                    continue
+                await sleep(lazy.idle_timeout - idle if idle < lazy.idle_timeout else lazy.idle_timeout)
+        finally:
+            lazy.watcher = None
+
+    async def _unload_lazy(self, lazy):
+        if not lazy.is_idle():
+            return  # A request came in while waiting for the flight
+        loaded = lazy.loaded
+        lazy.loaded = {}
+        stopped = set()
+        for url, reg_application in loaded.items():
+            key = self._lifecycle_key(reg_application)
+            if key is not None and key in stopped:
+                continue
+            stopped.add(key)
+            await self._hot_stop_application(url, reg_application)
+        if not isinstance(lazy.app, str):
+            for reg_application in loaded.values():
+                self._forget_built_app(reg_application.app)
+                # A factory builds a new app next time, which gets settings of its own
+                self.app_settings.pop(id(reg_application.app), None)
+        lazy.unloads += 1
+        self._clear_url_index()
+
+    @staticmethod
+    def _forget_built_app(app):
+        """Takes a Sanic app out of Sanic's registry of app names, so its factory can build it again."""
+        registry = getattr(Sanic, '_app_registry', None)
+        if isinstance(app, Sanic) and registry is not None and registry.get(app.name, None) is app:
+            del registry[app.name]
 
     def unregister_application(self, application, all_matches=False):
-        if isinstance(application, (SanicApplication, WsgiApplication)):
+        if isinstance(application, (SanicApplication, WsgiApplication, AsgiApplication, LazyApplication)):
             application = application.app
-        urls_to_unregister = []
-        for url, reg_application in self.applications.items():
-            if reg_application.app == application:
-                urls_to_unregister.append(url)
-                if not all_matches:
-                    break
+        urls = self.app_urls.get(id(application), None)
+        if not urls:
+            return
+        urls_to_unregister = list(urls) if all_matches else urls[:1]
         for url in urls_to_unregister:
-            del self.applications[url]
-        self._update_request_handler()
+            self._unmount(url)
 
     def unregister_prefix(self, url_prefix, host=None):
         if str(url_prefix).endswith('/'):
@@ -609,32 +2771,392 @@ class SanicDispatcherMiddlewareController(object):
                 self.unregister_prefix(url_prefix, host=_host)
             return
         registered_service_url = self._determine_uri(url_prefix, host)
+        self._unmount(registered_service_url)
+
+    def _get_dispatcher(self):
+        """
+        Builds the SanicDispatcherMiddleware the first time it is needed, and installs it as the
+        parent app's request handler. After that, mounts are changed on its routing table.
+        :rtype: SanicDispatcherMiddleware
+        """
+        dispatcher = self.dispatcher
+        if dispatcher is None:
+            dispatcher = SanicDispatcherMiddleware(self.parent_app, self.parent_handle_request, self.applications,
+                                                   self.hosts, self.metrics)
+            self.dispatcher = dispatcher
+            self.parent_app.handle_request = dispatcher
+        return dispatcher
+
+    def _mount(self, url, reg_application, publish=True):
+        """
+        Mounts one application, swapping a new routing table into the dispatcher. An application
+        registered while the server is running is started straight away, unless it is already running
+        under another url, and requests are only routed to it once it has started. Until then, any
+        application it replaces keeps serving the url.
+        :param publish: Also write the change to the shared mount table, if there is one
+        """
+        previous = self.applications.get(url, None)
+        if type(previous) is LazyApplication and previous.loading is not None:
+            # The app behind a LazyApplication is being registered, it is served through the LazyApplication
+            previous.loading[url] = reg_application
+            return
+        if previous is not None:
+            self._forget_url(previous.app, url)
+        self.applications[url] = reg_application
+        self.app_urls.setdefault(id(reg_application.app), []).append(url)
+        dispatcher = self._get_dispatcher()
+        if reg_application.apply_middleware:
+            dispatcher._middleware_chain()
+        start = self._start_mounted(url, reg_application) if self.running else None
+        if start is None:
+            self._route(url, reg_application)
+            if previous is not None and self.running:
+                self._stop_unmounted(url, previous)
+        else:
+            self._track(self._route_when_started(url, reg_application, previous, start))
+        if publish and self.snapshot is not None:
+            self._publish({url: self._snapshot_entry(url, reg_application)})
+
+    def _route(self, url, reg_application):
+        dispatcher = self._get_dispatcher()
+        dispatcher.router = dispatcher.router.with_mount(url, reg_application, self.hosts)
+        self._clear_url_index()
+
+    def _start_mounted(self, url, reg_application):
+        """
+        Starts an application mounted while the server is running, unless it is running already.
+        :return: the task which starts it, or None if it can be routed to straight away
+        """
+        key = self._lifecycle_key(reg_application)
+        if key is None:
+            # Nothing to start. A LazyApplication starts its app when it loads it.
+            return None
+        start = self.starting.get(key, None)
+        if start is not None:
+            return start
+        peer = self._lifecycle_peer(reg_application)
+        if peer is not None:
+            # Already running under another url
+            if isinstance(reg_application, SanicApplication):
+                reg_application.server_settings = peer.server_settings
+            return None
+        start = self.starting[key] = self._track(self._hot_start_application(url, reg_application))
+        start.add_done_callback(partial(self._forget_start, key))
+        return start
+
+    def _forget_start(self, key, task):
+        if self.starting.get(key, None) is task:
+            del self.starting[key]
+
+    def _track(self, coro):
+        task = ensure_future(coro)
+        self.lifecycle_tasks.add(task)
+        task.add_done_callback(self.lifecycle_tasks.discard)
+        return task
+
+    async def _route_when_started(self, url, reg_application, previous, start):
+        try:
+            started = await shield(start)
+        except CancelledError:
+            if not start.cancelled():
+                raise
+            return  # The server is stopping
+        if not started:
+            if self.applications.get(url, None) is reg_application:
+                # Never routed to, so put back whatever the url was serving before
+                self._forget_url(reg_application.app, url)
+                if previous is None:
+                    del self.applications[url]
+                else:
+                    self.applications[url] = previous
+                    self.app_urls.setdefault(id(previous.app), []).append(url)
+            return
+        if self.applications.get(url, None) is reg_application:
+            if isinstance(reg_application, SanicApplication) and not reg_application.server_settings:
+                peer = self._lifecycle_peer(reg_application)
+                if peer is not None:
+                    # A host alias of the application which ran the listeners
+                    reg_application.server_settings = peer.server_settings
+            self._route(url, reg_application)
+        if previous is not None:
+            self._stop_unmounted(url, previous)
+
+    def _unmount(self, url, publish=True):
+        """
+        Unmounts one url, swapping a new routing table into the dispatcher. An application unregistered
+        while the server is running is stopped once it is no longer mounted anywhere.
+        :param publish: Also write the change to the shared mount table, if there is one
+        """
+        reg_application = self.applications.pop(url, None)
+        if reg_application is None:
+            return
+        self._forget_url(reg_application.app, url)
+        dispatcher = self._get_dispatcher()
+        dispatcher.router = dispatcher.router.without_mount(url, self.hosts)
+        self._clear_url_index()
+        if self.running:
+            self._stop_unmounted(url, reg_application)
+        elif type(reg_application) is LazyApplication:
+            reg_application.loaded.pop(url, None)
+        if publish and self.snapshot is not None:
+            self._publish({url: None})
+
+    def _stop_unmounted(self, url, reg_application):
+        """Stops an application which was just unmounted from `url`, unless it is still mounted elsewhere."""
+        if type(reg_application) is LazyApplication:
+            lazy = reg_application
+            reg_application = lazy.loaded.pop(url, None)
+            if lazy.watcher is not None and not any(child_app is lazy for child_app in self.applications.values()):
+                lazy.watcher.cancel()
+            if reg_application is None:
+                return
+        if self._lifecycle_peer(reg_application) is None:
+            self._track(self._stop_drained(url, reg_application))
+
+    async def _stop_drained(self, url, reg_application):
+        """
+        Stops an unmounted application once it has started, if it was still starting, and once the requests
+        already routed to it are done, or GRACEFUL_SHUTDOWN_TIMEOUT has passed.
+        """
+        start = self.starting.get(self._lifecycle_key(reg_application), None)
+        if start is not None:
+            await gather(shield(start), return_exceptions=True)
+        deadline = monotonic() + self.parent_app.config.get('GRACEFUL_SHUTDOWN_TIMEOUT', 15.0)
+        while reg_application.in_flight and monotonic() < deadline:
+            await sleep(self.drain_interval)
+        await self._hot_stop_application(url, reg_application)
+
+    def _lifecycle_peer(self, reg_application):
+        """
+        :return: another mounted application which shares the lifecycle of `reg_application`, or None
+        """
+        key = self._lifecycle_key(reg_application)
+        if key is None:
+            return None
+        for url, child_app in self._mounted_applications():
+            if child_app is not reg_application and self._lifecycle_key(child_app) == key:
+                return child_app
+        return None
+
+    def _forget_url(self, application, url):
+        urls = self.app_urls.get(id(application), None)
+        if urls is None:
+            return
         try:
-            del self.applications[registered_service_url]
-        except KeyError:
+            urls.remove(url)
+        except ValueError:
             pass
-        self._update_request_handler()
+        if not urls:
+            del self.app_urls[id(application)]
+
+    def share_mounts(self, path, create=True, poll_interval=1.0):
+        """
+        Shares the mount table with the other worker processes of the server, through a memory-mapped file.
+        After this, each register and unregister call is written to the file, and every worker applies
+        the changes it finds there every `poll_interval` seconds while the server runs.
+        Only the urls, app keys and apply_middleware are shared, not the apps themselves. A worker mounts
+        an app it has registered itself, a Sanic app by its name, or an app from its import string.
+        :param str path: The file to share the mount table through
+        :param bool create: Start a new table from this process's mounts. Pass False to join the table
+                            another process started, taking its mounts instead.
+        :param poll_interval: How often each worker checks the table for changes, in seconds
+        :return: the MountSnapshot
+        :rtype: MountSnapshot
+        """
+        self.snapshot = MountSnapshot(path, create=create)
+        self.snapshot_interval = poll_interval
+        for url, reg_application in self.applications.items():
+            self._app_key(url, reg_application)
+        if create:
+            self._publish({url: self._snapshot_entry(url, reg_application)
+                           for url, reg_application in self.applications.items()})
+        else:
+            self.sync_mounts()
+        return self.snapshot
+
+    def sync_mounts(self):
+        """Applies any changes which other workers have made to the shared mount table."""
+        mounts = self.snapshot.poll()
+        if mounts is not None:
+            self._apply_snapshot(mounts)
+
+    async def _follow_snapshot(self):
+        while True:
+            await sleep(self.snapshot_interval)
+            try:
+                self.sync_mounts()
+            except Exception:
+                error_logger.exception("Could not apply the shared mount table.")
+
+    def _publish(self, changes):
+        # Other workers may have changed the table since it was last read here, so apply all of it
+        self._apply_snapshot(self.snapshot.update(changes))
+
+    def _app_key(self, url, reg_application):
+        """
+        :return: the key which stands for the registered application's app in the shared mount table
+        """
+        app = reg_application.app
+        key = self.app_keys.get(id(app), None)
+        if key is None:
+            if isinstance(app, str):
+                key = app
+            elif isinstance(app, Sanic):
+                key = 'sanic:' + app.name
+            else:
+                # Every worker registers the same apps at the same urls at startup, so the first url names it
+                key = _import_path(app) or 'url:' + url
+            self.app_keys[id(app)] = key
+            self.shared_apps.setdefault(key, reg_application)
+        return key
+
+    def _snapshot_entry(self, url, reg_application):
+        if isinstance(reg_application, SanicApplication):
+            kind = 'sanic'
+        elif isinstance(reg_application, LazyApplication):
+            kind = 'lazy'
+        elif isinstance(reg_application, AsgiApplication):
+            kind = 'asgi'
+        else:
+            kind = 'wsgi'
+        return {'kind': kind, 'app': self._app_key(url, reg_application),
+                'apply_middleware': bool(reg_application.apply_middleware)}
+
+    @staticmethod
+    def _snapshot_application(entry, app=None):
+        """
+        Builds a registered application for a shared mount table entry.
+        :param app: The entry's app, if this process has it already. Otherwise it is looked up by its key.
+        :return: the registered application, or None if the app can't be found in this process
+        """
+        key = entry['app']
+        if entry['kind'] == 'lazy':
+            # Its url prefix and registration options aren't shared, so only a worker which registered it can mount it
+            return None
+        if app is None:
+            try:
+                if key.startswith('sanic:'):
+                    app = Sanic.get_app(key[len('sanic:'):])
+                elif key.startswith('url:'):
+                    return None
+                else:
+                    app = _resolve_wsgi_app(key)
+            except (ImportError, AttributeError, SanicException):
+                return None
+        kind = entry['kind']
+        if kind == 'sanic':
+            return SanicApplication(app, entry['apply_middleware'])
+        elif kind == 'asgi':
+            return AsgiApplication(app, entry['apply_middleware'])
+        return WsgiApplication(app, entry['apply_middleware'])
+
+    def _apply_snapshot(self, mounts):
+        for url in [url for url in self.applications if url not in mounts]:
+            self._unmount(url, publish=False)
+        for url, entry in mounts.items():
+            current = self.applications.get(url, None)
+            key = entry['app']
+            if current is not None and self._app_key(url, current) == key and \
+                    bool(current.apply_middleware) == entry['apply_middleware']:
+                continue
+            reg_application = self.shared_apps.get(key, None)
+            if reg_application is not None and bool(reg_application.apply_middleware) != entry['apply_middleware']:
+                reg_application = self._snapshot_application(entry, reg_application.app)
+                if reg_application is None:
+                    continue
+            elif reg_application is None:
+                reg_application = self._snapshot_application(entry)
+                if reg_application is None:
+                    error_logger.warning("Cannot mount {} from the shared mount table, because {} is not known "
+                                         "in this process.".format(url, key))
+                    continue
+                self.app_keys[id(reg_application.app)] = key
+                self.shared_apps[key] = reg_application
+            host = url.partition('/')[0]
+            if host:
+                self.hosts.add(host)
+            self._mount(url, reg_application, publish=False)
+
+    def enable_metrics(self, endpoint=None):
+        """
+        Turns on per-mount request counters and latency histograms.
+        :param str endpoint: Optional path on the parent app to serve the metrics from, in the Prometheus
+                             text format
+        :return: the DispatcherMetrics
+        :rtype: DispatcherMetrics
+        """
+        if self.metrics is None:
+            self.metrics = DispatcherMetrics()
+            self._get_dispatcher().metrics = self.metrics
+        if endpoint is not None:
+            self.parent_app.add_route(self._metrics_endpoint, endpoint, methods=['GET'])
+        return self.metrics
+
+    def get_metrics(self):
+        """
+        :return: A dict of every counter and histogram, or None if metrics are not enabled
+        """
+        if self.metrics is None:
+            return None
+        return self.metrics.snapshot()
 
-    def _update_request_handler(self):
+    async def _metrics_endpoint(self, request):
+        return HTTPResponse(self.metrics.render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    def _clear_url_index(self):
         """
-        Rebuilds the SanicDispatcherMiddleware every time a new application is registered
+        Forgets which application owns each view name, and all memoized urls
         :return:
         """
-        dispatcher = SanicDispatcherMiddleware(self.parent_app, self.parent_handle_request, self.applications,
-                                               self.hosts)
-        self.parent_app.handle_request = dispatcher
+        self.url_index = {}
+        self.url_cache = {}
+        # View names which the parent app has no route for, and a child app could build
+        self.child_views = set()
+
+    @staticmethod
+    def _url_cache_key(order, view_name, kwargs):
+        """:return: the url_cache key of a url_for() call, or None if its arguments can't be hashed"""
+        if not kwargs:
+            return order, view_name
+        key = (order, view_name, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _cache_url(self, key, url):
+        if len(self.url_cache) >= self.max_cached_urls:
+            self.url_cache.clear()
+        self.url_cache[key] = url
+
+    def _parent_has_view(self, view_name):
+        """
+        Whether the parent app may have a route named view_name. A URLBuildError from the parent can
+        depend on the values passed to url_for(), so only a view name with no route at all is
+        passed over to the child applications.
+        :param str view_name:
+        :return: False only if the parent app certainly has no such route
+        """
+        find_route = getattr(self.parent_app.router, 'find_route_by_view_name', None)
+        if find_route is None or view_name.endswith('static'):
+            # Static routes are looked up by their name argument, not by view name
+            return True
+        if IS_21_03:
+            if '.' not in view_name:
+                view_name = '{}.{}'.format(self.parent_app.name, view_name)
+            return bool(find_route(view_name))
+        return find_route(view_name)[1] is not None
 
     async def handle_request(self, request, write_callback, stream_callback):
         """
-        This is only called as a backup handler if _update_request_handler was not yet called.
+        This is only called as a backup handler if no application was registered yet.
         :param request:
         :param write_callback:
         :param stream_callback:
         :return:
         """
-        dispatcher = SanicDispatcherMiddleware(self.parent_app, self.parent_handle_request, self.applications,
-                                               self.hosts)
-        self.parent_app.handle_request = dispatcher  # save it for next time
+        dispatcher = self._get_dispatcher()  # installs it for next time
         retval = dispatcher(request, write_callback, stream_callback)
         if isawaitable(retval):
             retval = await retval
@@ -642,37 +3164,61 @@ class SanicDispatcherMiddlewareController(object):
 
     async def handle_request_2103(self, request):
         """
-        This is only called as a backup handler if _update_request_handler was not yet called.
+        This is only called as a backup handler if no application was registered yet.
         :param request:
         :return:
         """
-        dispatcher = SanicDispatcherMiddleware(self.parent_app, self.parent_handle_request, self.applications,
-                                               self.hosts)
-        self.parent_app.handle_request = dispatcher  # save it for next time
+        dispatcher = self._get_dispatcher()  # installs it for next time
         _ = await dispatcher(request)
         # This 2103 handler doesn't return anything
 
+    @staticmethod
+    def _child_url_for(url_prefix, app, view_name, kwargs):
+        """
+        Asks a single registered application for `url_for()`
+        :param str url_prefix:
+        :param app:
+        :param str view_name:
+        :param dict kwargs:
+        :return: the url, or None if the application cannot build it
+        """
+        try:
+            _url_for = getattr(app, 'url_for', None)
+            if _url_for is None:
+                return None
+            try:
+                _url = _url_for(view_name, **kwargs)
+            except URLBuildError:
+                return None
+            if _url is not None:
+                return ''.join((url_prefix, str(_url)))
+        except (AssertionError, KeyError):
+            pass
+        return None
+
     def _dispatcher_url_for(self, view_name, **kwargs):
         """
-        Checks all of the registered applications in the dispatcher for `url_for()`
+        Checks the registered applications in the dispatcher for `url_for()`
+        The application which resolved a view name last time is asked first, the
+        rest are only checked if that one cannot build the url.
         :param str view_name:
         :param kwargs:
         :return:
         """
+        owner = self.url_index.get(view_name, None)
+        if owner is not None:
+            url = self._child_url_for(owner[0], owner[1], view_name, kwargs)
+            if url is not None:
+                return url
         for url_prefix, reg_application in self.applications.items():
             app = reg_application.app
-            try:
-                _url_for = getattr(app, 'url_for', None)
-                if _url_for is None:
-                    continue
-                try:
-                    _url = _url_for(view_name, **kwargs)
-                except URLBuildError:
-                    continue
-                if _url is not None:
-                    return ''.join((url_prefix, str(_url)))
-            except (AssertionError, KeyError):
+            if owner is not None and owner[1] is app and owner[0] == url_prefix:
                 continue
+            url = self._child_url_for(url_prefix, app, view_name, kwargs)
+            if url is not None:
+                if owner is None:
+                    self.url_index[view_name] = (url_prefix, app)
+                return url
         return None
 
     def patched_url_for(self, view_name, **kwargs):
@@ -682,18 +3228,35 @@ class SanicDispatcherMiddlewareController(object):
         :param kwargs:
         :return:
         """
-        try:
-            url = self.parent_url_for(view_name, **kwargs)
-        except URLBuildError:
-            url = None
+        cache_key = self._url_cache_key('parent', view_name, kwargs)
+        if cache_key is not None:
+            url = self.url_cache.get(cache_key, None)
+            if url is not None:
+                return url
+        url = None
+        child_view = view_name in self.child_views
+        if child_view:
+            # The parent couldn't build it before, so save raising and catching its URLBuildError again
+            try:
+                url = self._dispatcher_url_for(view_name, **kwargs)
+            except URLBuildError:
+                url = None
         if url is None:
+            try:
+                url = self.parent_url_for(view_name, **kwargs)
+            except URLBuildError:
+                url = None
+        if url is None and not child_view:
             try:
                 url = self._dispatcher_url_for(view_name, **kwargs)
             except URLBuildError:
                 url = None
+            if url is not None and not self._parent_has_view(view_name):
+                self.child_views.add(view_name)
         if url is None:
             raise URLBuildError("Url Not found in the Parent App, nor the Dispatcher routes")
-
+        if cache_key is not None:
+            self._cache_url(cache_key, url)
         return url
 
     def url_for(self, view_name, **kwargs):
@@ -703,6 +3266,11 @@ class SanicDispatcherMiddlewareController(object):
         :param kwargs:
         :return:
         """
+        cache_key = self._url_cache_key('dispatcher', view_name, kwargs)
+        if cache_key is not None:
+            url = self.url_cache.get(cache_key, None)
+            if url is not None:
+                return url
         try:
             url = self._dispatcher_url_for(view_name, **kwargs)
         except URLBuildError:
@@ -714,4 +3282,6 @@ class SanicDispatcherMiddlewareController(object):
                 url = None
         if url is None:
             raise URLBuildError("Url Not found in the Dispatcher routes, nor the Parent App")
+        if cache_key is not None:
+            self._cache_url(cache_key, url)
         return url
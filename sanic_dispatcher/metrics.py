@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+    sanic_dispatcher.metrics
+    ~~~~
+
+    Per-mount request counters and latency histograms for the dispatcher.
+
+    :copyright: (c) 2017 by Ashley Sommer (based on DispatcherMiddleware in the Werkzeug Project).
+    :license: MIT, see LICENSE for more details.
+"""
+from bisect import bisect_left
+
+
+class LatencyHistogram(object):
+    """
+    A fixed-bucket latency histogram, in seconds. Bucket counts are kept non-cumulative, and only summed
+    up when the histogram is read.
+    """
+    __slots__ = ['counts', 'count', 'sum']
+
+    buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+               5.0, 10.0)
+
+    def __init__(self):
+        # The extra last bucket is +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def cumulative(self):
+        """
+        :return: a list of (upper bound, cumulative count) pairs, the last upper bound being +Inf
+        """
+        total = 0
+        bounds = self.buckets + (float('inf'),)
+        result = []
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def as_dict(self):
+        return {'count': self.count, 'sum': self.sum,
+                'buckets': [(bound, count) for bound, count in self.cumulative()]}
+
+
+class MountMetrics(object):
+    """
+    Counters and per-stage latency histograms for one mount.
+    The stages are:
+      routing - matching the request to the mount
+      middleware - the parent app's request middleware, and response middleware on buffered responses
+      queue - time a WSGI call waited for a free thread
+      child - the child application handling the request, including sending streamed responses
+      send - sending a buffered response
+      total - the whole request, as seen by the dispatcher
+    """
+    __slots__ = ['requests', 'errors', 'rejected', 'latency']
+
+    stages = ('routing', 'middleware', 'queue', 'child', 'send', 'total')
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.rejected = 0
+        self.latency = {stage: LatencyHistogram() for stage in self.stages}
+
+    def observe(self, stage, seconds):
+        self.latency[stage].observe(seconds)
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'rejected': self.rejected,
+            'latency': {stage: histogram.as_dict() for stage, histogram in self.latency.items()
+                        if histogram.count},
+        }
+
+
+def _escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_bound(bound):
+    if bound == float('inf'):
+        return '+Inf'
+    return repr(bound)
+
+
+class DispatcherMetrics(object):
+    """
+    Holds the MountMetrics of every mount which has served a request, keyed by the mount's prefix.
+    Requests which did not match any mount are counted against the parent app.
+    """
+    __slots__ = ['mounts', 'parent']
+
+    parent_label = '<parent>'
+
+    def __init__(self):
+        self.mounts = {}
+        self.parent = MountMetrics()
+
+    def mount(self, script):
+        """
+        :param str script: the mount prefix, or None for the parent app
+        :return: the MountMetrics for that mount
+        """
+        if script is None:
+            return self.parent
+        stats = self.mounts.get(script, None)
+        if stats is None:
+            stats = self.mounts[script] = MountMetrics()
+        return stats
+
+    def reset(self):
+        self.mounts = {}
+        self.parent = MountMetrics()
+
+    def snapshot(self):
+        """
+        :return: a plain dict of every counter and histogram
+        """
+        return {
+            'parent': self.parent.as_dict(),
+            'mounts': {script: stats.as_dict() for script, stats in self.mounts.items()},
+        }
+
+    def _labelled(self):
+        yield self.parent_label, self.parent
+        for script, stats in self.mounts.items():
+            yield script, stats
+
+    def render_prometheus(self):
+        """
+        :return: the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        labelled = [(_escape_label(script), stats) for script, stats in self._labelled()]
+        for name, attr, description in (('requests', 'requests', 'Requests dispatched.'),
+                                         ('errors', 'errors', 'Requests which raised an exception.'),
+                                         ('rejected', 'rejected', 'Requests refused because a mount was busy.')):
+            metric = 'sanic_dispatcher_{}_total'.format(name)
+            lines.append('# HELP {} {}'.format(metric, description))
+            lines.append('# TYPE {} counter'.format(metric))
+            for label, stats in labelled:
+                lines.append('{}{{mount="{}"}} {}'.format(metric, label, getattr(stats, attr)))
+        metric = 'sanic_dispatcher_latency_seconds'
+        lines.append('# HELP {} Time spent in each stage of dispatching a request.'.format(metric))
+        lines.append('# TYPE {} histogram'.format(metric))
+        for label, stats in labelled:
+            for stage, histogram in stats.latency.items():
+                if not histogram.count:
+                    continue
+                labels = 'mount="{}",stage="{}"'.format(label, stage)
+                for bound, count in histogram.cumulative():
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(metric, labels, _format_bound(bound), count))
+                lines.append('{}_sum{{{}}} {!r}'.format(metric, labels, histogram.sum))
+                lines.append('{}_count{{{}}} {}'.format(metric, labels, histogram.count))
+        lines.append('')
+        return '\n'.join(lines)
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+    sanic_dispatcher.snapshot
+    ~~~~
+
+    A versioned mount table in a memory-mapped file, shared by all of the worker processes of one server.
+
+    :copyright: (c) 2017 by Ashley Sommer (based on DispatcherMiddleware in the Werkzeug Project).
+    :license: MIT, see LICENSE for more details.
+"""
+import json
+import mmap
+import os
+import struct
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+# magic, flags, sequence, payload length
+_HEADER = struct.Struct('<4sIQQ')
+_SEQUENCE = struct.Struct('<Q')
+_MAGIC = b'SDMT'
+# Set on a file which has been replaced by a bigger one, so readers know to map the new file
+_MOVED = 1
+
+
+class MountSnapshot(object):
+    """
+    The mount table, as a JSON payload behind a small header in a memory-mapped file. Writers take a lock
+    file, and bump the header's sequence number to odd before changing the payload, and to even once it is
+    done. A reader can tell whether the table has changed by reading the sequence number straight out of
+    the mapped memory, and only copies and parses the payload when it has. A payload which outgrows the
+    file is written to a bigger file, which replaces the old one, and the old one is flagged as moved.
+    """
+    __slots__ = ['path', 'map', 'sequence', 'inode']
+
+    initial_capacity = 64 * 1024
+
+    def __init__(self, path, create=False):
+        """
+        :param str path: The file to share the mount table through
+        :param bool create: Start a new, empty table, replacing any which is already there
+        """
+        self.path = path
+        self.map = None
+        # The sequence number of the table this process last read
+        self.sequence = 0
+        # Identifies the file which is mapped, to tell when it has been replaced
+        self.inode = None
+        if create:
+            with self._locked():
+                self._replace({}, 0, self.initial_capacity)
+        self._open()
+
+    @property
+    def version(self):
+        return self.sequence // 2
+
+    def _open(self):
+        if self.map is not None:
+            self.map.close()
+        with open(self.path, 'r+b') as f:
+            self.map = mmap.mmap(f.fileno(), 0)
+            self.inode = os.fstat(f.fileno()).st_ino
+        magic = _HEADER.unpack_from(self.map, 0)[0]
+        if magic != _MAGIC:
+            raise RuntimeError("{} is not a Sanic-Dispatcher mount table.".format(self.path))
+
+    def _locked(self):
+        return _LockFile(self.path + '.lock')
+
+    def _replace(self, mounts, sequence, capacity):
+        """Writes the table to a new file of at least `capacity` bytes, and moves it over the old one."""
+        payload = self._encode(mounts)
+        capacity = max(capacity, len(payload))
+        temp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, 0, sequence, len(payload)))
+            f.write(payload)
+            f.truncate(_HEADER.size + capacity)
+        os.replace(temp_path, self.path)
+
+    @staticmethod
+    def _encode(mounts):
+        return json.dumps({'mounts': mounts}, separators=(',', ':'), sort_keys=True).encode('utf-8')
+
+    def _read(self):
+        """
+        :return: a tuple of (sequence, mounts), or None if the table is being written right now
+        """
+        while True:
+            magic, flags, sequence, length = _HEADER.unpack_from(self.map, 0)
+            if not flags & _MOVED:
+                break
+            self._open()
+        if sequence & 1:
+            return None
+        payload = self.map[_HEADER.size:_HEADER.size + length]
+        if _SEQUENCE.unpack_from(self.map, 8)[0] != sequence:
+            return None
+        return sequence, json.loads(payload.decode('utf-8'))['mounts']
+
+    def _read_locked(self):
+        """
+        Reads the table while holding the lock, so nothing else can be writing to it. A file which was
+        replaced, but not flagged as moved, or a table which still reads as half-written, was left behind
+        by a writer which died part way through. The file is mapped again, and the read retried. Failing
+        that, the payload is used if it still parses, so that one failed writer doesn't block every later
+        update.
+        :return: a tuple of (sequence, mounts)
+        """
+        if os.stat(self.path).st_ino != self.inode:
+            self._open()
+        result = self._read()
+        if result is not None:
+            return result
+        self._open()
+        result = self._read()
+        if result is not None:
+            return result
+        magic, flags, sequence, length = _HEADER.unpack_from(self.map, 0)
+        try:
+            mounts = json.loads(self.map[_HEADER.size:_HEADER.size + length].decode('utf-8'))['mounts']
+        except (ValueError, KeyError, TypeError):
+            mounts = {}
+        # Even again, as if the dead writer had finished
+        return sequence + 1, mounts
+
+    def poll(self):
+        """
+        :return: the mount table, if it has changed since this process last read it, otherwise None
+        """
+        if _SEQUENCE.unpack_from(self.map, 8)[0] == self.sequence and \
+                not _HEADER.unpack_from(self.map, 0)[1] & _MOVED:
+            return None
+        result = self._read()
+        if result is None:
+            return None
+        self.sequence, mounts = result
+        return mounts
+
+    def update(self, changes):
+        """
+        Applies changes to the shared mount table, on top of whatever other processes have written to it.
+        :param dict changes: Maps each changed url to its new entry, or to None to remove it
+        :return: the whole mount table, after the changes
+        """
+        with self._locked():
+            sequence, mounts = self._read_locked()
+            for url, entry in changes.items():
+                if entry is None:
+                    mounts.pop(url, None)
+                else:
+                    mounts[url] = entry
+            payload = self._encode(mounts)
+            sequence += 2
+            current = self.map
+            if len(payload) > len(current) - _HEADER.size:
+                self._replace(mounts, sequence, len(payload) * 2)
+                struct.pack_into('<I', current, 4, _MOVED)
+                self._open()
+            else:
+                _SEQUENCE.pack_into(current, 8, sequence - 1)
+                current[_HEADER.size:_HEADER.size + len(payload)] = payload
+                struct.pack_into('<Q', current, 16, len(payload))
+                _SEQUENCE.pack_into(current, 8, sequence)
+            self.sequence = sequence
+        return mounts
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+class _LockFile(object):
+    __slots__ = ['path', 'file']
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, 'a+b')
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.file.close()
+        self.file = None
@@ -0,0 +1,82 @@
+from sanic import response
+
+
+def _add_parent_route(dispatcher):
+    @dispatcher.parent_app.route("/test")
+    async def index(request):
+        return response.text("parent")
+
+
+class EchoAsgiApp(object):
+    def __init__(self):
+        self.events = []
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                self.events.append(message['type'])
+                if message['type'] == 'lifespan.startup':
+                    scope['state']['started'] = True
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        body = bytearray()
+        while True:
+            message = await receive()
+            body.extend(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/plain'), (b'set-cookie', b'a=1'), (b'set-cookie', b'b=2')]})
+        await send({'type': 'http.response.body', 'more_body': True,
+                    'body': "{} {} {} {} ".format(scope['method'], scope['root_path'], scope['path'],
+                                                  scope['state'].get('started')).encode()})
+        await send({'type': 'http.response.body', 'body': bytes(body)})
+
+
+def test_asgi_child(dispatcher):
+    _add_parent_route(dispatcher)
+    asgi_app = EchoAsgiApp()
+    dispatcher.register_app(asgi_app, '/asgichild')
+    tester = dispatcher.parent_app.test_client
+    request, resp = tester.post("/asgichild/test", data=b"x" * 100000, gather_request=True)
+    assert resp.status == 200
+    assert resp.text == "POST /asgichild /test True " + "x" * 100000
+    assert resp.headers.get_list("set-cookie") == ["a=1", "b=2"]
+    assert asgi_app.events == ['lifespan.startup', 'lifespan.shutdown']
+
+
+def test_asgi_path_decoding(dispatcher):
+    _add_parent_route(dispatcher)
+    scopes = []
+
+    async def asgi_app(scope, receive, send):
+        assert scope['type'] == 'http'
+        scopes.append(scope)
+        await send({'type': 'http.response.start', 'status': 204, 'headers': []})
+        await send({'type': 'http.response.body'})
+
+    dispatcher.register_asgi_application(asgi_app, '/asgichild')
+    tester = dispatcher.parent_app.test_client
+    request, resp = tester.get("/asgichild/hello%20world%2Fx?a=1", gather_request=True)
+    assert resp.status == 204
+    assert scopes[0]['path'] == "/hello world/x"
+    assert scopes[0]['raw_path'] == b"/asgichild/hello%20world%2Fx"
+    assert scopes[0]['root_path'] == "/asgichild"
+    assert scopes[0]['query_string'] == b"a=1"
+
+
+def test_asgi_child_without_lifespan(dispatcher):
+    _add_parent_route(dispatcher)
+
+    async def asgi_app(scope, receive, send):
+        assert scope['type'] == 'http'
+        await send({'type': 'http.response.start', 'status': 204, 'headers': []})
+        await send({'type': 'http.response.body'})
+
+    dispatcher.register_asgi_application(asgi_app, '/asgichild')
+    tester = dispatcher.parent_app.test_client
+    request, resp = tester.get("/asgichild/test", gather_request=True)
+    assert resp.status == 204
@@ -129,3 +129,66 @@ def test_flask_child(dispatcher):
     request, resp = tester.get("/flaskchild/test", gather_request=True)
     assert resp.status == 200
     assert "flask!" in resp.text
+
+def test_child_request_class(dispatcher):
+    from sanic.request import Request
+    child_sanic_app = Sanic("child5")
+    seen = {}
+    @dispatcher.parent_app.route("/test", methods=['GET', 'OPTIONS'])
+    async def index1(request):
+        return response.text("Hello World from {}.".format(request.app.name))
+    @child_sanic_app.route("/test", methods=['GET', 'OPTIONS'])
+    async def index2(request):
+        seen['is_request'] = isinstance(request, Request)
+        seen['parent_app'] = request.parent_app
+        return response.text("Hello World from {}.".format(request.app.name))
+    dispatcher.register_sanic_application(child_sanic_app, '/sanicchild', apply_middleware=True)
+    tester = dispatcher.parent_app.test_client
+    request, resp = tester.get("/sanicchild/test", gather_request=True)
+    assert resp.status == 200
+    assert seen['is_request']
+    assert seen['parent_app'] is dispatcher.parent_app
+
+def test_compat_request_classes_not_shared():
+    import gc
+    import weakref
+
+    class FakeRequest(object):
+        __slots__ = ('app', '__weakref__')
+
+    dispatcher = SanicDispatcherMiddleware(None, None)
+    request = dispatcher._compat_request(FakeRequest())
+    assert type(request) is dispatcher.compat_request_classes[FakeRequest]
+    assert type(request).dispatcher is dispatcher
+    assert SanicDispatcherMiddleware(None, None).compat_request_classes == {}
+    compat_class_ref = weakref.ref(type(request))
+    del dispatcher, request
+    gc.collect()
+    # Nothing at class level keeps the dispatcher, or its request subclass, alive
+    assert compat_class_ref() is None
+
+def test_child_mw_added_after_register(dispatcher):
+    child_sanic_app = Sanic("child6")
+    calls = []
+    @dispatcher.parent_app.route("/test", methods=['GET', 'OPTIONS'])
+    async def index1(request):
+        return response.text("Hello World from {}.".format(request.app.name))
+    @dispatcher.parent_app.middleware("request")
+    def sync_mw(request):
+        calls.append(request.app.name)
+    @child_sanic_app.route("/test", methods=['GET', 'OPTIONS'])
+    async def index2(request):
+        return response.text("Hello World from {}.".format(request.app.name))
+    dispatcher.register_sanic_application(child_sanic_app, '/sanicchild', apply_middleware=True)
+    chain = dispatcher.dispatcher.middleware_chain
+    assert len(chain.request_middleware) == 1
+    async def replace(request, resp):
+        return response.text("Hello from a wrapped response middleware.")
+    # A plain function which returns a coroutine, like an undecorated wrapper would
+    dispatcher.parent_app.middleware("response")(lambda request, resp: replace(request, resp))
+    tester = dispatcher.parent_app.test_client
+    request, resp = tester.get("/sanicchild/test", gather_request=True)
+    assert resp.status == 200
+    assert "wrapped response middleware" in resp.text
+    assert calls == [dispatcher.parent_app.name]
+    assert dispatcher.dispatcher.middleware_chain is not chain
@@ -0,0 +1,204 @@
+import asyncio
+
+from sanic import response
+from sanic.compat import Header
+from sanic.response import HTTPResponse
+
+from sanic_dispatcher.cache import RequestCoalescer, ResponseCache, SingleFlight
+
+
+class FakeRequest(object):
+    def __init__(self, method="GET", headers=None, query_string=""):
+        self.method = method
+        self.headers = Header(headers or {})
+        self.query_string = query_string
+
+
+def _fetch_all(cache, requests, make_response, delay=0.0):
+    calls = []
+
+    async def call():
+        calls.append(1)
+        await asyncio.sleep(delay)
+        return make_response()
+
+    async def run():
+        responses = []
+        for batch in requests:
+            responses.extend(await asyncio.gather(*[cache.fetch(request, '/docs', '/page', call)
+                                                    for request in batch]))
+        return responses
+
+    return asyncio.new_event_loop().run_until_complete(run()), calls
+
+
+def _cacheable(body=b"page", **headers):
+    headers = {name.replace('_', '-'): value for name, value in headers.items()}
+    headers.setdefault('Cache-Control', 'max-age=60')
+    return HTTPResponse(body, headers=headers, content_type="text/plain")
+
+
+def test_cache_hit_and_not_modified():
+    cache = ResponseCache(1024 * 1024)
+    requests = [[FakeRequest()], [FakeRequest()], [FakeRequest(headers={'If-None-Match': 'W/"v1"'})]]
+    responses, calls = _fetch_all(cache, requests, lambda: _cacheable(ETag='"v1"'))
+    assert len(calls) == 1
+    assert [r.status for r in responses] == [200, 200, 304]
+    assert responses[1].body == b"page"
+    assert responses[1].headers['age'] == "0"
+    assert responses[2].headers['etag'] == '"v1"'
+    assert cache.stats()['hits'] == 2
+    assert cache.not_modified == 1
+
+
+def test_cache_not_modified_only_for_ok():
+    cache = ResponseCache(1024 * 1024)
+    requests = [[FakeRequest()], [FakeRequest(headers={'If-None-Match': '"v1"'})]]
+
+    def make_response():
+        resp = _cacheable(ETag='"v1"')
+        resp.status = 404
+        return resp
+
+    responses, calls = _fetch_all(cache, requests, make_response)
+    assert len(calls) == 1
+    assert [r.status for r in responses] == [404, 404]
+    assert responses[1].body == b"page"
+    assert cache.not_modified == 0
+
+
+def test_cache_respects_cache_control():
+    cache = ResponseCache(1024 * 1024)
+    requests = [[FakeRequest()], [FakeRequest()]]
+    responses, calls = _fetch_all(cache, requests, lambda: _cacheable(Cache_Control='private, max-age=60'))
+    assert len(calls) == 2
+    cache = ResponseCache(1024 * 1024)
+    requests = [[FakeRequest()], [FakeRequest(headers={'Cache-Control': 'no-cache'})], [FakeRequest("POST")],
+                [FakeRequest(headers={'Authorization': 'Basic eDp5'})]]
+    responses, calls = _fetch_all(cache, requests, _cacheable)
+    assert len(calls) == 4
+    assert cache.hits == 0
+
+
+def test_cache_vary():
+    cache = ResponseCache(1024 * 1024)
+    english = {'Accept-Language': 'en'}
+    requests = [[FakeRequest(headers=english)], [FakeRequest(headers={'Accept-Language': 'de'})],
+                [FakeRequest(headers=english)]]
+    responses, calls = _fetch_all(cache, requests, lambda: _cacheable(Vary='Accept-Language'))
+    assert len(calls) == 2
+    assert len(cache.entries) == 2
+    assert cache.hits == 1
+
+
+def test_cache_evicts_least_recently_used():
+    cache = ResponseCache(3000)
+
+    async def run():
+        for path in ('/a', '/b', '/a', '/c'):
+            await cache.fetch(FakeRequest(), '/docs', path, lambda: _async(_cacheable(b"x" * 1000)))
+
+    async def _async(value):
+        return value
+
+    asyncio.new_event_loop().run_until_complete(run())
+    assert [key[0][3] for key in cache.entries] == ['/a', '/c']
+    assert cache.evictions == 1
+    assert cache.size <= 3000
+
+
+def test_cache_coalesces_misses():
+    cache = ResponseCache(1024 * 1024)
+    responses, calls = _fetch_all(cache, [[FakeRequest() for _ in range(5)]], _cacheable, delay=0.01)
+    assert len(calls) == 1
+    assert [r.body for r in responses] == [b"page"] * 5
+    assert cache.coalesced == 4
+    assert not cache.flights.calls
+
+
+def test_cache_wsgi_mount(dispatcher):
+    @dispatcher.parent_app.route("/test")
+    async def index(request):
+        return response.text("parent")
+
+    def wsgi_app(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain"), ("ETag", '"v1"')])
+        return [b"docs"]
+
+    dispatcher.register_wsgi_application(wsgi_app, '/docs', cache_max_bytes=1024 * 1024, cache_ttl=60)
+    tester = dispatcher.parent_app.test_client
+    request, resp = tester.get("/docs/page", headers={'If-None-Match': '"v1"'}, gather_request=True)
+    assert resp.status == 304
+    cache = dispatcher.applications['/docs'].cache
+    assert cache.misses == 1
+    assert len(cache.entries) == 1
+
+
+def test_single_flight():
+    flights = SingleFlight()
+    calls = []
+
+    async def call(value):
+        calls.append(value)
+        await asyncio.sleep(0.01)
+        if value == "error":
+            raise ValueError(value)
+        return value
+
+    async def run():
+        results = await asyncio.gather(*[flights.run("a", lambda: call("first")) for _ in range(3)])
+        errors = await asyncio.gather(*[flights.run("b", lambda: call("error")) for _ in range(2)],
+                                      return_exceptions=True)
+        # When the call in flight is cancelled, a waiter runs the call itself
+        leader = asyncio.ensure_future(flights.run("c", lambda: call("cancelled")))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flights.run("c", lambda: call("retried")))
+        await asyncio.sleep(0)
+        leader.cancel()
+        return results, errors, await follower
+
+    results, errors, retried = asyncio.new_event_loop().run_until_complete(run())
+    assert results == ["first"] * 3
+    assert all(isinstance(error, ValueError) for error in errors)
+    assert retried == "retried"
+    assert calls == ["first", "error", "cancelled", "retried"]
+    assert flights.shared == 3
+    assert not flights.calls
+
+
+def test_request_coalescer():
+    coalescer = RequestCoalescer(key_headers=['Accept'])
+    requests = [[FakeRequest() for _ in range(4)] + [FakeRequest(headers={'Accept': 'text/html'})]]
+    responses, calls = _fetch_all(coalescer, requests, lambda: _cacheable(Cache_Control='no-store'), delay=0.01)
+    assert len(calls) == 2
+    assert len({id(r) for r in responses}) == 5
+    assert [r.body for r in responses] == [b"page"] * 5
+    assert coalescer.stats() == {'in_flight': 0, 'shared': 3, 'bypassed': 0}
+
+
+def test_request_coalescer_private():
+    cookies = [[FakeRequest(headers={'Cookie': 'session=1'}), FakeRequest(headers={'Cookie': 'session=1'}),
+                FakeRequest(headers={'Cookie': 'session=2'})]]
+    responses, calls = _fetch_all(RequestCoalescer(), cookies, _cacheable, delay=0.01)
+    assert len(calls) == 3
+    responses, calls = _fetch_all(RequestCoalescer(private='key'), cookies, _cacheable, delay=0.01)
+    assert len(calls) == 2
+    responses, calls = _fetch_all(RequestCoalescer(private='share'), cookies, _cacheable, delay=0.01)
+    assert len(calls) == 1
+
+
+def test_coalesce_wsgi_mount(dispatcher):
+    @dispatcher.parent_app.route("/test")
+    async def index(request):
+        return response.text("parent")
+
+    def wsgi_app(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [b"report"]
+
+    dispatcher.register_wsgi_application(wsgi_app, '/reports', coalesce_requests=True)
+    tester = dispatcher.parent_app.test_client
+    request, resp = tester.get("/reports/daily", gather_request=True)
+    assert resp.status == 200
+    assert resp.text == "report"
+    assert dispatcher.applications['/reports'].coalescer.stats()['in_flight'] == 0
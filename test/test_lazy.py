@@ -0,0 +1,176 @@
+import asyncio
+
+import pytest
+from sanic import Sanic
+from sanic import response
+from sanic.exceptions import SanicException
+
+from sanic_dispatcher.extension import LazyApplication
+
+
+def lazy_wsgi_app(environ, start_response):
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return [b"lazy ", environ['PATH_INFO'].encode()]
+
+
+lazy_sanic_app = Sanic("lazy_sanic_module")
+lazy_sanic_starts = []
+
+
+@lazy_sanic_app.listener('before_server_start')
+async def _lazy_sanic_start(app, loop):
+    lazy_sanic_starts.append(app.name)
+
+
+@lazy_sanic_app.route("/test")
+async def _lazy_sanic_index(request):
+    return response.text("lazy sanic")
+
+
+def _add_parent_route(dispatcher):
+    @dispatcher.parent_app.route("/test")
+    async def index(request):
+        return response.text("parent")
+
+
+def test_lazy_import_string(dispatcher):
+    _add_parent_route(dispatcher)
+    dispatcher.register_lazy_application('test_lazy:lazy_wsgi_app', '/lazy')
+    lazy = dispatcher.applications['/lazy']
+    assert isinstance(lazy, LazyApplication)
+    assert not lazy.loaded
+    tester = dispatcher.parent_app.test_client
+    request, resp = tester.get("/lazy/test", gather_request=True)
+    assert resp.status == 200
+    assert resp.text == "lazy /test"
+    assert lazy.loads == 1
+    assert lazy.loaded['/lazy'].app is lazy_wsgi_app
+    # Still served through the LazyApplication
+    assert dispatcher.applications['/lazy'] is lazy
+
+
+def test_lazy_factory_runs_listeners(dispatcher):
+    _add_parent_route(dispatcher)
+    events = []
+
+    def factory():
+        child = Sanic("lazy_child")
+
+        @child.listener('before_server_start')
+        async def before_start(app, loop):
+            events.append('before_start')
+
+        @child.listener('after_server_stop')
+        async def after_stop(app, loop):
+            events.append('after_stop')
+
+        @child.route("/test")
+        async def index(request):
+            events.append('request')
+            return response.text("child")
+
+        events.append('built')
+        return child
+
+    dispatcher.register_lazy_application(factory, '/child')
+    tester = dispatcher.parent_app.test_client
+    request, resp = tester.get("/child/test", gather_request=True)
+    assert resp.text == "child"
+    assert events == ['built', 'before_start', 'request', 'after_stop']
+
+
+def test_lazy_coalesce_and_unload(dispatcher):
+    builds = []
+
+    async def factory():
+        builds.append(len(builds))
+        await asyncio.sleep(0.05)
+        return lazy_wsgi_app
+
+    dispatcher.register_lazy_application(factory, '/lazy', idle_timeout=0.05)
+    lazy = dispatcher.applications['/lazy']
+
+    async def run():
+        dispatcher.running = True
+        try:
+            loaded = await asyncio.gather(*(lazy.acquire('/lazy') for _ in range(5)))
+            assert len(builds) == 1
+            assert all(reg_application is loaded[0] for reg_application in loaded)
+            assert lazy.flights.shared == 4
+            for _ in loaded:
+                lazy.release()
+            assert lazy.watcher is not None
+            await asyncio.sleep(0.2)
+            assert lazy.unloads == 1
+            assert not lazy.loaded
+            assert lazy.watcher is None
+            await lazy.acquire('/lazy')
+            lazy.release()
+            assert len(builds) == 2
+        finally:
+            dispatcher.running = False
+            if lazy.watcher is not None:
+                lazy.watcher.cancel()
+
+    asyncio.new_event_loop().run_until_complete(run())
+
+
+def test_lazy_reload_outside_test_mode(dispatcher):
+    dispatcher.register_lazy_application('test_lazy:lazy_sanic_app', '/lazy', idle_timeout=0.05)
+    lazy = dispatcher.applications['/lazy']
+
+    async def run():
+        dispatcher.running = True
+        try:
+            for _ in range(2):
+                await lazy.acquire('/lazy')
+                lazy.release()
+                await asyncio.sleep(0.2)
+                assert not lazy.loaded
+        finally:
+            dispatcher.running = False
+
+    # Outside of test mode, Sanic fails when an app's router is finalized a second time
+    test_mode = Sanic.test_mode
+    Sanic.test_mode = False
+    try:
+        asyncio.new_event_loop().run_until_complete(run())
+    finally:
+        Sanic.test_mode = test_mode
+    # The listeners ran on both loads, rather than the reload failing in Sanic's finalize
+    assert lazy_sanic_starts == ['lazy_sanic_module', 'lazy_sanic_module']
+    assert lazy.loads == 2
+    assert lazy.unloads == 2
+
+
+def test_lazy_failed_start(dispatcher):
+    attempts = []
+
+    def factory():
+        child = Sanic("lazy_broken")
+
+        @child.listener('before_server_start')
+        async def broken_start(app, loop):
+            attempts.append(1)
+            raise ValueError("no database")
+
+        return child
+
+    dispatcher.register_lazy_application(factory, '/broken')
+    lazy = dispatcher.applications['/broken']
+
+    async def run():
+        dispatcher.running = True
+        try:
+            for _ in range(2):
+                with pytest.raises(SanicException):
+                    await lazy.acquire('/broken')
+                # Not served by an app whose listeners didn't run
+                assert not lazy.loaded
+        finally:
+            dispatcher.running = False
+
+    asyncio.new_event_loop().run_until_complete(run())
+    # The next request tries again, with a freshly built app
+    assert len(attempts) == 2
+    assert lazy.loads == 0
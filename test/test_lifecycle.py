@@ -0,0 +1,46 @@
+import asyncio
+
+from sanic import Sanic
+from sanic import response
+
+
+def test_child_lifecycle_concurrent(dispatcher):
+    slow1 = Sanic("slow1")
+    slow2 = Sanic("slow2")
+    broken = Sanic("broken")
+    calls = []
+    starting = {'now': 0, 'most': 0}
+
+    @dispatcher.parent_app.route("/test")
+    async def index(request):
+        return response.text("parent")
+
+    for child in (slow1, slow2):
+        @child.listener('before_server_start')
+        async def slow_start(app, loop):
+            calls.append(app.name)
+            starting['now'] += 1
+            starting['most'] = max(starting['most'], starting['now'])
+            await asyncio.sleep(0.2)
+            starting['now'] -= 1
+
+    @broken.listener('before_server_start')
+    async def broken_start(app, loop):
+        raise ValueError("no database")
+
+    dispatcher.register_sanic_application(slow1, '/slow1', host=['a.example.com', 'b.example.com'])
+    dispatcher.register_sanic_application(slow2, '/slow2')
+    dispatcher.register_sanic_application(broken, '/broken')
+    tester = dispatcher.parent_app.test_client
+    request, resp = tester.get("/test", gather_request=True)
+    assert resp.text == "parent"
+    # Once per app instance, not once per host alias
+    assert sorted(calls) == ['slow1', 'slow2']
+    # Run side by side, not one after the other
+    assert starting['most'] == 2
+    timings = dispatcher.lifecycle_timings
+    assert timings['a.example.com/slow1']['before_start'] >= 0.15
+    assert 'b.example.com/slow1' not in timings
+    assert 'before_start' in timings['/broken']
+    assert dispatcher.applications['b.example.com/slow1'].server_settings is \
+        dispatcher.applications['a.example.com/slow1'].server_settings
@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+from sanic import response
+from sanic.exceptions import ServiceUnavailable
+
+from sanic_dispatcher.extension import MountLimiter
+
+
+def test_limit_sheds_before_middleware(dispatcher):
+    @dispatcher.parent_app.route("/test")
+    async def index(request):
+        return response.text("parent")
+
+    seen = []
+
+    @dispatcher.parent_app.middleware("request")
+    async def mw(request):
+        seen.append(request.path)
+
+    def wsgi_app(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [b"done"]
+
+    dispatcher.register_wsgi_application(wsgi_app, '/wsgichild', apply_middleware=True, max_in_flight=0)
+    dispatcher.enable_metrics()
+    tester = dispatcher.parent_app.test_client
+    request, resp = tester.get("/wsgichild/test", gather_request=True)
+    assert resp.status == 503
+    assert resp.headers['retry-after'] == "1"
+    assert seen == []
+    limiter = dispatcher.applications['/wsgichild'].limiter
+    assert limiter.shed == 1
+    assert limiter.in_flight == 0
+    assert dispatcher.get_metrics()['mounts']['/wsgichild']['rejected'] == 1
+
+
+def test_limit_shared_by_host_aliases(dispatcher):
+    def wsgi_app(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [b"done"]
+
+    dispatcher.register_wsgi_application(wsgi_app, '/wsgichild', host=['a.example.com', 'b.example.com'],
+                                         max_in_flight=2)
+    limiters = {id(application.limiter) for application in dispatcher.applications.values()}
+    assert len(dispatcher.applications) == 2
+    assert len(limiters) == 1
+
+
+def test_mount_limiter_queue():
+    async def run():
+        limiter = MountLimiter(1, max_queued=1, queue_timeout=0.05)
+        await limiter.acquire()
+        # The queue is full, so the third request is shed straight away
+        queued = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(ServiceUnavailable):
+            await limiter.acquire()
+        assert limiter.shed == 1
+        # Releasing hands the slot to the queued request
+        limiter.release()
+        await queued
+        assert limiter.in_flight == 1
+        # A request that waits too long is shed too
+        with pytest.raises(ServiceUnavailable):
+            await limiter.acquire()
+        assert limiter.timed_out == 1
+        assert not limiter.waiters
+        limiter.release()
+        assert limiter.in_flight == 0
+
+    asyncio.new_event_loop().run_until_complete(run())
@@ -0,0 +1,59 @@
+from sanic import response
+
+from sanic_dispatcher.metrics import DispatcherMetrics, LatencyHistogram
+
+
+def test_metrics_wsgi_child(dispatcher):
+    @dispatcher.parent_app.route("/test")
+    async def index(request):
+        return response.text("parent")
+
+    def wsgi_app(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [b"done"]
+
+    dispatcher.register_wsgi_application(wsgi_app, '/wsgichild', executor_workers=1)
+    metrics = dispatcher.enable_metrics()
+    tester = dispatcher.parent_app.test_client
+    request, resp = tester.get("/wsgichild/test", gather_request=True)
+    assert resp.text == "done"
+    snapshot = dispatcher.get_metrics()
+    stats = snapshot['mounts']['/wsgichild']
+    assert stats['requests'] == 1
+    assert stats['errors'] == 0
+    for stage in ('routing', 'queue', 'child', 'send', 'total'):
+        assert stats['latency'][stage]['count'] == 1
+    assert 'middleware' not in stats['latency']
+    assert metrics.parent.requests == 0
+
+
+def test_metrics_endpoint(dispatcher):
+    @dispatcher.parent_app.route("/test")
+    async def index(request):
+        return response.text("parent")
+
+    dispatcher.enable_metrics(endpoint='/metrics')
+    tester = dispatcher.parent_app.test_client
+    request, resp = tester.get("/metrics", gather_request=True)
+    assert resp.status == 200
+    assert resp.headers['content-type'].startswith('text/plain')
+    assert 'sanic_dispatcher_requests_total{mount="<parent>"} 1' in resp.text
+
+
+def test_metrics_disabled(dispatcher):
+    assert dispatcher.get_metrics() is None
+
+
+def test_prometheus_histogram():
+    histogram = LatencyHistogram()
+    histogram.observe(0.0001)
+    histogram.observe(0.003)
+    histogram.observe(100)
+    assert histogram.cumulative()[0] == (0.0001, 1)
+    assert histogram.cumulative()[-1] == (float('inf'), 3)
+    metrics = DispatcherMetrics()
+    metrics.mount('example.com/a"b').observe('child', 0.003)
+    text = metrics.render_prometheus()
+    assert 'sanic_dispatcher_latency_seconds_bucket{mount="example.com/a\\"b",stage="child",le="0.005"} 1' in text
+    assert 'sanic_dispatcher_latency_seconds_count{mount="example.com/a\\"b",stage="child"} 1' in text
+    assert 'stage="routing"' not in text
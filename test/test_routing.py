@@ -0,0 +1,379 @@
+import asyncio
+
+from sanic import Sanic
+from sanic import response
+
+from sanic_dispatcher.extension import MountTrie, MountRoutingTable, SanicCompatURL, SanicDispatcherMiddleware
+
+
+def test_trie_longest_prefix():
+    trie = MountTrie({'/a': 'a', '/a/b': 'ab', '': 'root', 'example.com/c': 'c'})
+    assert trie.match(b'/a/b/c') == ('ab', '/a/b', b'/c')
+    assert trie.match(b'/a/bc') == ('a', '/a', b'/bc')
+    assert trie.match(b'/a/') == ('a', '/a', b'/')
+    assert trie.match(b'/a') == ('a', '/a', b'')
+    assert trie.match(b'/x/y') == ('root', '', b'/x/y')
+    assert trie.match(b'example.com/c/d') == ('c', 'example.com/c', b'/d')
+
+
+def test_trie_no_match():
+    trie = MountTrie({'/a/b': 'ab'})
+    assert trie.match(b'/a') == (None, None, b'/a')
+    assert trie.match(b'/a/c/b') == (None, None, b'/a/c/b')
+
+
+def test_routing_table_host_precedence():
+    mounts = {'/a': 'a', 'example.com/a': 'host_a', 'example.com': 'host_root'}
+    table = MountRoutingTable(mounts, {'example.com'})
+    assert table.match('example.com', b'/a/b') == ('host_a', 'example.com/a', b'/b')
+    assert table.match('example.com', b'/c') == ('host_root', 'example.com', b'/c')
+    assert table.match('other.com', b'/a/b') == ('a', '/a', b'/b')
+    assert table.match('other.com', b'/c') == (None, None, b'/c')
+
+
+def test_routing_table_cache():
+    table = MountRoutingTable({'/a/b': 'ab', 'example.com/c': 'host_c'}, {'example.com'})
+    assert table.depth == 3
+    assert table.match('other.com', b'/x/y/z') == (None, None, b'/x/y/z')
+    assert table.match('another.com', b'/x/y/w') == (None, None, b'/x/y/w')
+    assert list(table.cache) == [('', b'/x/y')]
+    assert table.match('other.com', b'/a/b/c') == ('ab', '/a/b', b'/c')
+    assert table.match('other.com', b'/a/b/d/e') == ('ab', '/a/b', b'/d/e')
+    assert table.match('example.com', b'/c/d') == ('host_c', 'example.com/c', b'/d')
+    assert len(table.cache) == 3
+    # A changed table starts again with an empty cache
+    assert table.without_mount('/a/b', {'example.com'}).match('other.com', b'/a/b/c') == (None, None, b'/a/b/c')
+
+
+def test_routing_table_cache_bounded(monkeypatch):
+    monkeypatch.setattr(MountRoutingTable, 'cache_size', 2)
+    table = MountRoutingTable({'/a': 'a'})
+    for path in (b'/x', b'/y', b'/a', b'/z'):
+        table.match('', path)
+    assert list(table.cache) == [('', b'/a'), ('', b'/z')]
+
+
+def test_trie_params():
+    trie = MountTrie({'/t/<tenant>/api': 'api', '/t/admin': 'admin', '/n/<id:[0-9]+>': 'num'})
+    params = {}
+    assert trie.match(b'/t/acme%20co/api/users', params) == ('api', '/t/<tenant>/api', b'/users')
+    assert params == {'tenant': 'acme co'}
+    # Literal segments win, unless the parameter gives a longer match
+    assert trie.match(b'/t/admin/x') == ('admin', '/t/admin', b'/x')
+    assert trie.match(b'/t/admin/api') == ('api', '/t/<tenant>/api', b'')
+    assert trie.match(b'/t//api') == (None, None, b'/t//api')
+    assert trie.match(b'/n/42/x') == ('num', '/n/<id:[0-9]+>', b'/x')
+    assert trie.match(b'/n/abc') == (None, None, b'/n/abc')
+    removed = trie.without_mount('/t/<tenant>/api')
+    assert removed.match(b'/t/acme/api') == (None, None, b'/t/acme/api')
+    assert not removed.root.children[b''].children[b't'].params
+
+
+def test_routing_table_wildcard_hosts():
+    hosts = {'*.example.com', '<region>.example.org', 'www.example.org'}
+    table = MountRoutingTable({'*.example.com/a': 'star', '<region>.example.org/t/<tenant>': 'region',
+                               'www.example.org/t': 'www', '/t': 'default'}, hosts)
+    assert table.has_params
+    assert table.match('foo.example.com', b'/a/b') == ('star', '*.example.com/a', b'/b')
+    assert table.match('foo.bar.example.com', b'/a/b') == (None, None, b'/a/b')
+    params = {}
+    assert table.match('eu.example.org', b'/t/acme/x', params) == ('region', '<region>.example.org/t/<tenant>',
+                                                                  b'/x')
+    assert params == {'region': 'eu', 'tenant': 'acme'}
+    # Served from the cache the second time
+    params = {}
+    assert table.match('eu.example.org', b'/t/acme/y', params)[0] == 'region'
+    assert params == {'region': 'eu', 'tenant': 'acme'}
+    assert table.match('www.example.org', b'/t/acme') == ('www', 'www.example.org/t', b'/acme')
+    assert table.match('eu.example.org', b'/t') == ('default', '/t', b'')
+    removed = table.without_mount('*.example.com/a', hosts)
+    assert '.example.com' not in removed.wildcards
+    assert removed.match('foo.example.com', b'/a') == (None, None, b'/a')
+
+
+def test_param_mount_wsgi(dispatcher):
+    environs = []
+
+    @dispatcher.parent_app.route("/test")
+    async def index(request):
+        return response.text("parent")
+
+    def wsgi_app(environ, start_response):
+        environs.append(environ)
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [b"done"]
+
+    dispatcher.register_wsgi_application(wsgi_app, '/t/<tenant>/api', host='<region>.example.com')
+    tester = dispatcher.parent_app.test_client
+    request, resp = tester.get("/t/acme/api/users", headers={'Host': 'eu.example.com'}, gather_request=True)
+    assert resp.text == "done"
+    environ = environs[0]
+    assert environ['wsgiorg.routing_args'] == ((), {'region': 'eu', 'tenant': 'acme'})
+    assert environ['SCRIPT_NAME'] == 'eu.example.com/t/acme/api'
+    assert environ['PATH_INFO'] == '/users'
+
+
+def test_param_mount_sanic(dispatcher):
+    child = Sanic("tenant_child")
+
+    @dispatcher.parent_app.route("/test")
+    async def index(request):
+        return response.text("parent")
+
+    @child.route("/test")
+    async def child_index(request):
+        return response.text(request.ctx.mount_params['tenant'])
+
+    dispatcher.register_sanic_application(child, '/t/<tenant>')
+    tester = dispatcher.parent_app.test_client
+    request, resp = tester.get("/t/acme/test", gather_request=True)
+    assert resp.text == "acme"
+
+
+def test_routed_request_url(dispatcher):
+    child = Sanic("url_child")
+    seen = {}
+
+    @dispatcher.parent_app.route("/test")
+    async def index(request):
+        return response.text("parent")
+
+    @child.route("/test")
+    async def child_index(request):
+        seen['request'] = request
+        return response.text("{} {} {}".format(request.path, request.args.get('a'), request.host))
+
+    dispatcher.register_sanic_application(child, '/child')
+    tester = dispatcher.parent_app.test_client
+    request, resp = tester.get("/child/test?a=1", headers={'Host': 'example.com:8080'}, gather_request=True)
+    assert resp.text == "/test 1 example.com:8080"
+    request = seen['request']
+    assert request._parsed_url.host == b'example.com'
+    assert request._parsed_url.port == b'8080'
+    assert dispatcher.dispatcher.host_info['example.com:8080'] == ('example.com', b'example.com', b'8080')
+
+
+def test_routing_keeps_parsed_args():
+    class FakeRequest(object):
+        headers = {'Host': 'example.com'}
+        transport = None
+
+        def __init__(self):
+            self._parsed_url = SanicCompatURL(b'http', None, None, b'/child/test', b'a=1', None, None)
+            self.parsed_args = {'already': 'parsed'}
+
+        @property
+        def path(self):
+            return self._parsed_url.path.decode('utf-8')
+
+    dispatcher = SanicDispatcherMiddleware(None, None, {'/child': 'child'})
+    request = FakeRequest()
+    parsed_args = request.parsed_args
+    assert dispatcher._get_application_by_route(request) == ('child', '/child', '/test')
+    assert request.parsed_args is parsed_args
+    assert request._parsed_url.query == b'a=1'
+
+
+def test_host_info_bounded(monkeypatch):
+    monkeypatch.setattr(SanicDispatcherMiddleware, 'max_cached_hosts', 2)
+    dispatcher = SanicDispatcherMiddleware(None, None)
+    for host in ('a', 'b:81', 'c'):
+        dispatcher._get_host_info(host)
+    assert list(dispatcher.host_info) == ['c']
+    assert dispatcher._get_host_info('b:81') == ('b', b'b', b'81')
+
+
+def test_unregister_drains_requests(dispatcher):
+    child = Sanic("draining")
+    events = []
+
+    @child.listener('before_server_stop')
+    async def child_stopping(app, loop):
+        events.append('stop')
+
+    @child.route("/test")
+    async def child_index(request):
+        dispatcher.unregister_application(child)
+        await asyncio.sleep(0.1)
+        events.append('request')
+        return response.text("done")
+
+    @dispatcher.parent_app.route("/test")
+    async def index(request):
+        return response.text("parent")
+
+    dispatcher.register_sanic_application(child, '/child')
+    tester = dispatcher.parent_app.test_client
+    request, resp = tester.get("/child/test", gather_request=True)
+    assert resp.text == "done"
+    # Stopped once the request routed to it was done, and only once
+    assert events == ['request', 'stop']
+
+
+def test_nested_children(dispatcher):
+    outer = Sanic("outer")
+    inner = Sanic("inner")
+
+    @dispatcher.parent_app.route("/test")
+    async def index(request):
+        return response.text("parent")
+
+    @outer.route("/test")
+    async def outer_index(request):
+        return response.text("{} {}".format(request.app.name, request.path))
+
+    @inner.route("/test")
+    async def inner_index(request):
+        return response.text("{} {}".format(request.app.name, request.path))
+
+    dispatcher.register_sanic_application(outer, '/child')
+    dispatcher.register_sanic_application(inner, '/child/deeper')
+    tester = dispatcher.parent_app.test_client
+    request, resp = tester.get("/child/deeper/test", gather_request=True)
+    assert resp.text == "inner /test"
+
+
+def test_host_child(dispatcher):
+    hosted = Sanic("hosted")
+    unhosted = Sanic("unhosted")
+
+    @dispatcher.parent_app.route("/test")
+    async def index(request):
+        return response.text("parent")
+
+    @hosted.route("/test")
+    async def hosted_index(request):
+        return response.text(request.app.name)
+
+    @unhosted.route("/test")
+    async def unhosted_index(request):
+        return response.text(request.app.name)
+
+    dispatcher.register_sanic_application(unhosted, '/child')
+    dispatcher.register_sanic_application(hosted, '/child', host='example.com')
+    tester = dispatcher.parent_app.test_client
+    request, resp = tester.get("/child/test", headers={'Host': 'example.com'}, gather_request=True)
+    assert resp.text == "hosted"
+
+
+def test_trie_copy_on_write():
+    trie = MountTrie({'/a': 'a', '/a/b/c': 'abc'})
+    added = trie.with_mount('/a/b', 'ab')
+    assert added.match(b'/a/b/x') == ('ab', '/a/b', b'/x')
+    assert trie.match(b'/a/b/x') == ('a', '/a', b'/b/x')
+    removed = added.without_mount('/a/b/c')
+    assert removed.match(b'/a/b/c') == ('ab', '/a/b', b'/c')
+    assert added.match(b'/a/b/c') == ('abc', '/a/b/c', b'')
+    # The pruned branch is gone entirely, the untouched one is shared
+    assert b'c' not in removed.root.children[b''].children[b'a'].children[b'b'].children
+    assert removed.without_mount('/x') is removed
+
+
+def test_routing_table_copy_on_write():
+    table = MountRoutingTable({'/a': 'a'}, {'example.com'})
+    hosted = table.with_mount('example.com/a', 'host_a', {'example.com'})
+    assert hosted.match('example.com', b'/a') == ('host_a', 'example.com/a', b'')
+    assert table.match('example.com', b'/a') == ('a', '/a', b'')
+    unhosted = hosted.without_mount('example.com/a', {'example.com'})
+    assert unhosted.hosts == {}
+    assert unhosted.default is table.default
+
+
+def test_register_after_start(dispatcher):
+    late = Sanic("late")
+    started = []
+
+    @late.listener('before_server_start')
+    async def late_starting(app, loop):
+        await asyncio.sleep(0.1)
+        started.append('before')
+
+    @late.listener('after_server_start')
+    async def late_started(app, loop):
+        started.append(app.name)
+
+    @late.route("/test")
+    async def late_index(request):
+        return response.text(request.app.name)
+
+    @dispatcher.parent_app.route("/test")
+    async def index(request):
+        dispatcher.register_sanic_application(late, '/late')
+        # Not routed to until its start listeners are done
+        before = dispatcher.dispatcher.router.match('', b'/late/test')[0]
+        await asyncio.gather(*dispatcher.lifecycle_tasks)
+        application, script, path_info = dispatcher.dispatcher.router.match('', b'/late/test')
+        return response.text("{} {} {} {}".format(before, application.app.name, script, ','.join(started)))
+
+    tester = dispatcher.parent_app.test_client
+    request, resp = tester.get("/test", gather_request=True)
+    assert resp.text == "None late /late before,late"
+    assert not dispatcher.lifecycle_tasks
+    dispatcher.unregister_application(late)
+    assert dispatcher.app_urls == {}
+
+
+def test_reregister_after_start(dispatcher):
+    late = Sanic("late_again")
+    started = []
+
+    @late.listener('before_server_start')
+    async def late_starting(app, loop):
+        started.append('before')
+
+    @late.route("/test")
+    async def late_index(request):
+        return response.text(request.app.name)
+
+    @dispatcher.parent_app.route("/test")
+    async def index(request):
+        # Outside of test mode, Sanic fails when an app's router is finalized a second time
+        Sanic.test_mode = False
+        for _ in range(2):
+            dispatcher.register_sanic_application(late, '/late')
+            await asyncio.gather(*dispatcher.lifecycle_tasks)
+            routed = dispatcher.dispatcher.router.match('', b'/late/test')[0]
+            dispatcher.unregister_application(late)
+            await asyncio.gather(*dispatcher.lifecycle_tasks)
+        return response.text("{} {}".format(routed.app.name, ','.join(started)))
+
+    test_mode = Sanic.test_mode
+    try:
+        tester = dispatcher.parent_app.test_client
+        request, resp = tester.get("/test", gather_request=True)
+    finally:
+        Sanic.test_mode = test_mode
+    assert resp.text == "late_again before,before"
+
+
+def test_register_after_start_fails(dispatcher):
+    broken = Sanic("late_broken")
+    working = Sanic("late_working")
+
+    @broken.listener('before_server_start')
+    async def broken_start(app, loop):
+        raise ValueError("no database")
+
+    for child in (broken, working):
+        @child.route("/test")
+        async def child_index(request):
+            return response.text(request.app.name)
+
+    dispatcher.register_sanic_application(working, '/working')
+
+    @dispatcher.parent_app.route("/test")
+    async def index(request):
+        dispatcher.register_sanic_application(broken, '/broken')
+        dispatcher.register_sanic_application(broken, '/working')
+        await asyncio.gather(*dispatcher.lifecycle_tasks)
+        router = dispatcher.dispatcher.router
+        return response.text("{} {}".format(router.match('', b'/broken/test')[0],
+                                            router.match('', b'/working/test')[0].app.name))
+
+    tester = dispatcher.parent_app.test_client
+    request, resp = tester.get("/test", gather_request=True)
+    # An app whose start failed is never routed to, and the app it would have replaced keeps its url
+    assert resp.text == "None late_working"
+    assert set(dispatcher.applications) == {'/working'}
+    assert dispatcher.applications['/working'].app is working
+    assert id(broken) not in dispatcher.app_urls
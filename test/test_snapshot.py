@@ -0,0 +1,84 @@
+import struct
+
+from sanic import Sanic
+
+from sanic_dispatcher import SanicDispatcherMiddlewareController
+from sanic_dispatcher.snapshot import MountSnapshot
+from conftest import app_with_name
+
+
+def wsgi_app(environ, start_response):
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return [b"wsgi"]
+
+
+def other_wsgi_app(environ, start_response):
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return [b"other"]
+
+
+def test_mount_snapshot(tmp_path, monkeypatch):
+    monkeypatch.setattr(MountSnapshot, 'initial_capacity', 128)
+    path = str(tmp_path / "mounts")
+    writer = MountSnapshot(path, create=True)
+    reader = MountSnapshot(path)
+    assert reader.poll() is None
+    writer.update({'/a': {'app': 'a'}})
+    assert reader.poll() == {'/a': {'app': 'a'}}
+    assert reader.version == 1
+    # Nothing changed since the last poll
+    assert reader.poll() is None
+    # Outgrows the file, which is replaced by a bigger one
+    mounts = {'/b{}'.format(i): {'app': 'b' * 20} for i in range(10)}
+    writer.update(mounts)
+    mounts['/a'] = {'app': 'a'}
+    assert reader.poll() == mounts
+    writer.update({'/a': None})
+    del mounts['/a']
+    assert reader.poll() == mounts
+    assert reader.version == writer.version == 3
+
+
+def test_mount_snapshot_recovers(tmp_path):
+    path = str(tmp_path / "mounts")
+    writer = MountSnapshot(path, create=True)
+    writer.update({'/a': {'app': 'a'}})
+    # A writer which died while changing the payload left the sequence number odd
+    struct.pack_into('<Q', writer.map, 8, writer.sequence + 1)
+    assert writer.update({'/b': {'app': 'b'}}) == {'/a': {'app': 'a'}, '/b': {'app': 'b'}}
+    reader = MountSnapshot(path)
+    assert reader.poll() == {'/a': {'app': 'a'}, '/b': {'app': 'b'}}
+    # A writer which died after replacing the file, but before flagging the old one as moved
+    writer._replace({'/c': {'app': 'c'}}, writer.sequence + 2, 1024)
+    assert writer.update({'/d': {'app': 'd'}}) == {'/c': {'app': 'c'}, '/d': {'app': 'd'}}
+    assert MountSnapshot(path).poll() == {'/c': {'app': 'c'}, '/d': {'app': 'd'}}
+
+
+def test_share_mounts(tmp_path):
+    path = str(tmp_path / "mounts")
+    child = Sanic("snapshot_child")
+    workers = []
+    for name in ("snapshot_worker1", "snapshot_worker2"):
+        dispatcher = SanicDispatcherMiddlewareController(app_with_name(name))
+        dispatcher.register_sanic_application(child, '/sanicchild', apply_middleware=True)
+        dispatcher.register_wsgi_application(wsgi_app, '/wsgichild', host='example.com')
+        workers.append(dispatcher)
+    first, second = workers
+    first.share_mounts(path)
+    second.share_mounts(path, create=False)
+    assert second.applications['/sanicchild'].apply_middleware
+    first.unregister_prefix('/sanicchild')
+    first.register_wsgi_application(other_wsgi_app, '/other')
+    assert '/sanicchild' in second.applications
+    second.sync_mounts()
+    assert '/sanicchild' not in second.applications
+    assert second.applications['/other'].app is other_wsgi_app
+    assert 'example.com/wsgichild' in second.applications
+    # Changes made by the second worker are written on top of the first worker's changes
+    second.register_sanic_application(child, '/sanicchild')
+    first.sync_mounts()
+    assert not first.applications['/sanicchild'].apply_middleware
+    assert sorted(first.applications) == sorted(second.applications) == \
+        ['/other', '/sanicchild', 'example.com/wsgichild']
+    application, script, path_info = first.dispatcher.router.match('example.com', b'/wsgichild/test')
+    assert application.app is wsgi_app
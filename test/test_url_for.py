@@ -0,0 +1,92 @@
+import pytest
+from sanic import Sanic
+from sanic import response
+from sanic.exceptions import URLBuildError
+
+
+def test_url_for_index(dispatcher):
+    child1 = Sanic("url_child1")
+    child2 = Sanic("url_child2")
+
+    @dispatcher.parent_app.route("/test")
+    async def index1(request):
+        return response.text("parent")
+
+    @child1.route("/test")
+    async def index2(request):
+        return response.text("child1")
+
+    @child2.route("/item/<item_id>")
+    async def index3(request, item_id):
+        return response.text(item_id)
+
+    dispatcher.register_sanic_application(child1, '/child1')
+    dispatcher.register_sanic_application(child2, '/child2')
+    assert dispatcher.url_for("index2") == "/child1/test"
+    assert dispatcher.url_for("index3", item_id=5) == "/child2/item/5"
+    assert dispatcher.url_for("index3", item_id=6) == "/child2/item/6"
+    assert dispatcher.parent_app.url_for("index1") == "/test"
+    assert dispatcher.url_index["index3"] == ('/child2', child2)
+    assert dispatcher.url_cache[('dispatcher', 'index2')] == "/child1/test"
+    assert ('dispatcher', 'index3') not in dispatcher.url_cache
+
+    dispatcher.unregister_application(child2)
+    assert dispatcher.url_index == {}
+    assert dispatcher.url_cache == {}
+
+
+def test_url_for_skips_parent_for_child_views(dispatcher):
+    child = Sanic("url_child_views")
+    parent_calls = []
+
+    @dispatcher.parent_app.route("/test")
+    async def index(request):
+        return response.text("parent")
+
+    @child.route("/item/<item_id>")
+    async def item(request, item_id):
+        return response.text(item_id)
+
+    dispatcher.register_sanic_application(child, '/child')
+    parent_url_for = dispatcher.parent_url_for
+
+    def counting_url_for(view_name, **kwargs):
+        parent_calls.append(view_name)
+        return parent_url_for(view_name, **kwargs)
+
+    dispatcher.parent_url_for = counting_url_for
+    url_for = dispatcher.parent_app.url_for
+    assert url_for("item", item_id=1) == "/child/item/1"
+    assert url_for("item", item_id=2) == "/child/item/2"
+    assert url_for("item", item_id=2) == "/child/item/2"
+    # The parent is only asked the first time, after that the view is known to be a child's
+    assert parent_calls == ["item"]
+    assert ('parent', 'item', (('item_id', 2),)) in dispatcher.url_cache
+    with pytest.raises(URLBuildError):
+        url_for("missing", item_id=1)
+    dispatcher.unregister_application(child)
+    assert dispatcher.child_views == set()
+
+
+def test_url_for_value_dependent_errors(dispatcher):
+    child = Sanic("url_child_values")
+
+    @dispatcher.parent_app.route("/item/<item_id:int>")
+    async def item(request, item_id):
+        return response.text("parent")
+
+    @child.route("/item/<item_id>", name="item")
+    async def child_item(request, item_id):
+        return response.text(item_id)
+
+    url_for = dispatcher.parent_app.url_for
+    with pytest.raises(URLBuildError):
+        url_for("item", item_id="abc")
+    # A miss which depends on the value doesn't stop a valid call
+    assert url_for("item", item_id=5) == "/item/5"
+    dispatcher.register_sanic_application(child, '/child')
+    # Only the parent's value check fails, so the child builds it
+    assert url_for("item", item_id="abc") == "/child/item/abc"
+    # The parent still has the route, so it still comes first for values it accepts
+    assert dispatcher.child_views == set()
+    assert url_for("item", item_id=6) == "/item/6"
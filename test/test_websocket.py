@@ -0,0 +1,94 @@
+import asyncio
+from types import SimpleNamespace
+
+from sanic import Sanic
+from sanic import response
+
+from sanic_dispatcher import SanicDispatcherMiddleware
+from sanic_dispatcher.extension import WebsocketMount
+
+
+def _add_parent_route(dispatcher):
+    @dispatcher.parent_app.route("/test")
+    async def index(request):
+        return response.text("parent")
+
+
+class FakeWebsocket(object):
+    def __init__(self):
+        self.messages = asyncio.Queue()
+        self.sent = []
+        self.close_code = None
+
+    async def recv(self):
+        message = await self.messages.get()
+        if message is None:
+            raise ConnectionError("closed")
+        return message
+
+    async def send(self, message):
+        self.sent.append(message)
+
+    async def close(self, code=1000, reason=""):
+        self.close_code = code
+        self.messages.put_nowait(None)
+
+
+class FakeProtocol(object):
+    def __init__(self):
+        self.ws = FakeWebsocket()
+
+    async def websocket_handshake(self, request, subprotocols=None):
+        return self.ws
+
+
+class FakeRequest(object):
+    def __init__(self):
+        protocol = FakeProtocol()
+        self.transport = SimpleNamespace(get_protocol=lambda: protocol)
+
+
+def test_websocket_tracking():
+    websockets = WebsocketMount(max_connections=1, idle_timeout=0.1)
+    request = FakeRequest()
+    seen = {}
+
+    async def handler():
+        # What the child's websocket route does, on the parent's connection
+        ws = await request.transport.get_protocol().websocket_handshake(request)
+        seen['open'] = websockets.open
+        ws.messages.put_nowait("hello")
+        await ws.send("echo " + await ws.recv())
+        try:
+            await ws.recv()  # left idle until the dispatcher closes it
+        except ConnectionError:
+            pass
+        return ws
+
+    async def run():
+        return await SanicDispatcherMiddleware._track_websocket(request, websockets, handler)
+
+    ws = asyncio.new_event_loop().run_until_complete(run())
+    assert seen['open'] == 1
+    assert ws.sent == ["echo hello"]
+    assert ws.close_code == 1001
+    assert websockets.stats() == {'open': 0, 'total': 1, 'rejected': 0, 'idle_closed': 1}
+    # The handshake hook is removed once the connection is done
+    assert 'websocket_handshake' not in vars(request.transport.get_protocol())
+
+
+def test_websocket_child_full(dispatcher):
+    _add_parent_route(dispatcher)
+    dispatcher.parent_app.enable_websocket()
+    child = Sanic("wschild2")
+
+    @child.websocket("/feed")
+    async def feed(request, ws):
+        await ws.send("never sent")
+
+    dispatcher.register_sanic_application(child, '/wschild', max_websockets=0)
+    headers = {'Upgrade': 'websocket', 'Connection': 'upgrade', 'Sec-WebSocket-Key': 'dGhlIHNhbXBsZSBub25jZQ==',
+               'Sec-WebSocket-Version': '13'}
+    request, resp = dispatcher.parent_app.test_client.get("/wschild/feed", headers=headers, gather_request=True)
+    assert resp.status == 503
+    assert dispatcher.applications['/wschild'].websockets.rejected == 1
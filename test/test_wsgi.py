@@ -0,0 +1,392 @@
+import asyncio
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+from sanic import response
+from sanic.exceptions import SanicException, ServiceUnavailable
+
+from sanic_dispatcher.extension import WsgiExecutor, WsgiInputStream, WsgiProcessPool
+
+
+def _add_parent_route(dispatcher):
+    @dispatcher.parent_app.route("/test")
+    async def index(request):
+        return response.text("parent")
+
+
+def _serve(app, client):
+    """Serves app with create_server() on a new event loop, for as long as client(port) runs."""
+    loop = asyncio.new_event_loop()
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    server = loop.run_until_complete(app.create_server(sock=sock, access_log=False, return_asyncio_server=True))
+    try:
+        server.after_start()
+        return loop.run_until_complete(asyncio.wait_for(client(port), 10))
+    finally:
+        server.before_stop()
+        close_task = server.close()
+        if close_task is not None:
+            loop.run_until_complete(close_task)
+        server.after_stop()
+        loop.close()
+
+
+class ClosingBody(object):
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        self.closed = True
+
+
+def test_wsgi_stream_response(dispatcher):
+    _add_parent_route(dispatcher)
+    body = ClosingBody([b"chunk1,", b"", "chunk2,", b"chunk3"])
+
+    def wsgi_app(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return body
+
+    dispatcher.register_wsgi_application(wsgi_app, '/wsgichild', stream_response=True)
+    tester = dispatcher.parent_app.test_client
+    request, resp = tester.get("/wsgichild/test", gather_request=True)
+    assert resp.status == 200
+    assert resp.text == "chunk1,chunk2,chunk3"
+    assert resp.headers.get("transfer-encoding") == "chunked"
+    assert body.closed
+
+
+def test_wsgi_stream_response_generator(dispatcher):
+    _add_parent_route(dispatcher)
+
+    def wsgi_app(environ, start_response):
+        # start_response is deferred until the first chunk is pulled
+        start_response("201 Created", [("Content-Type", "text/plain")])
+        for i in range(3):
+            yield str(i).encode()
+
+    dispatcher.register_wsgi_application(wsgi_app, '/wsgichild', stream_response=True)
+    tester = dispatcher.parent_app.test_client
+    request, resp = tester.get("/wsgichild/test", gather_request=True)
+    assert resp.status == 201
+    assert resp.text == "012"
+
+
+def test_wsgi_stream_response_with_mw(dispatcher):
+    _add_parent_route(dispatcher)
+    body = ClosingBody([b"chunk1"])
+
+    @dispatcher.parent_app.middleware("response")
+    async def mw(request, resp):
+        return response.text("Hello from response middleware.")
+
+    def wsgi_app(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return body
+
+    dispatcher.register_wsgi_application(wsgi_app, '/wsgichild', apply_middleware=True, stream_response=True)
+    tester = dispatcher.parent_app.test_client
+    request, resp = tester.get("/wsgichild/test", gather_request=True)
+    assert resp.text == "Hello from response middleware."
+    assert body.closed
+
+
+def test_wsgi_stream_response_single_chunk(dispatcher):
+    _add_parent_route(dispatcher)
+
+    def wsgi_app(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [b"only chunk"]
+
+    dispatcher.register_wsgi_application(wsgi_app, '/wsgichild', stream_response=True)
+    tester = dispatcher.parent_app.test_client
+    request, resp = tester.get("/wsgichild/test", gather_request=True)
+    assert resp.text == "only chunk"
+    assert resp.headers.get("content-length") == "10"
+    assert "transfer-encoding" not in resp.headers
+
+
+def test_wsgi_repeated_headers(dispatcher):
+    _add_parent_route(dispatcher)
+    body = ClosingBody([b"a", b"b"])
+
+    def wsgi_app(environ, start_response):
+        start_response("200 OK", [("content-type", "text/plain"), ("Set-Cookie", "a=1"), ("Set-Cookie", "b=2")])
+        return body
+
+    dispatcher.register_wsgi_application(wsgi_app, '/wsgichild')
+    tester = dispatcher.parent_app.test_client
+    request, resp = tester.get("/wsgichild/test", gather_request=True)
+    assert resp.text == "ab"
+    assert resp.headers.get_list("set-cookie") == ["a=1", "b=2"]
+    assert resp.headers.get("content-type") == "text/plain"
+    assert body.closed
+
+
+def test_wsgi_executor(dispatcher):
+    _add_parent_route(dispatcher)
+    thread_names = []
+
+    def wsgi_app(environ, start_response):
+        thread_names.append(threading.current_thread().name)
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [b"done"]
+
+    dispatcher.register_wsgi_application(wsgi_app, '/wsgichild', executor_workers=2, executor_queue=4)
+    tester = dispatcher.parent_app.test_client
+    request, resp = tester.get("/wsgichild/test", gather_request=True)
+    assert resp.text == "done"
+    assert not thread_names[0].startswith("asyncio")
+    executor = dispatcher.applications['/wsgichild'].executor
+    assert executor.pending == 0
+    assert executor.executor is None  # shut down with the server
+
+
+def test_wsgi_executor_full():
+    executor = WsgiExecutor(1, 1)
+    executor.acquire()
+    executor.acquire()
+    with pytest.raises(ServiceUnavailable):
+        executor.acquire()
+    executor.release()
+    executor.acquire()
+
+
+def test_wsgi_stream_request_body(dispatcher):
+    _add_parent_route(dispatcher)
+    payload = b"".join(b"line %d\n" % i for i in range(50000))
+
+    def wsgi_app(environ, start_response):
+        wsgi_input = environ['wsgi.input']
+        assert isinstance(wsgi_input, WsgiInputStream)
+        first_line = wsgi_input.readline()
+        rest = bytearray()
+        while True:
+            data = wsgi_input.read(8192)
+            if not data:
+                break
+            rest.extend(data)
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [b"%s %d" % (first_line.strip(), len(first_line) + len(rest))]
+
+    dispatcher.register_wsgi_application(wsgi_app, '/wsgichild', stream_request_body=True)
+    tester = dispatcher.parent_app.test_client
+    request, resp = tester.post("/wsgichild/test", data=payload, gather_request=True)
+    assert resp.status == 200
+    assert resp.text == "line 0 %d" % len(payload)
+
+
+def test_wsgi_under_create_server(dispatcher):
+    # Sanic refuses app.loop under create_server(), so the dispatcher has to use the running loop
+    _add_parent_route(dispatcher)
+    payload = b"x" * 100000
+
+    def wsgi_app(environ, start_response):
+        body = environ['wsgi.input'].read()
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [b"%d" % len(body)]
+
+    # On the default executor, and on a dedicated one
+    dispatcher.register_wsgi_application(wsgi_app, '/wsgichild', stream_request_body=True)
+    dispatcher.register_wsgi_application(wsgi_app, '/pooled', stream_request_body=True, executor_workers=1)
+
+    async def post(port, path):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"POST %s HTTP/1.1\r\nHost: localhost\r\nContent-Length: %d\r\n"
+                     b"Connection: close\r\n\r\n%s" % (path, len(payload), payload))
+        try:
+            return await reader.read()
+        finally:
+            writer.close()
+
+    async def post_both(port):
+        return [await post(port, path) for path in (b"/wsgichild/test", b"/pooled/test")]
+
+    for raw_response in _serve(dispatcher.parent_app, post_both):
+        assert raw_response.startswith(b"HTTP/1.1 200")
+        assert raw_response.endswith(b"\r\n\r\n%d" % len(payload))
+
+
+def test_wsgi_input_client_disconnect(dispatcher):
+    _add_parent_route(dispatcher)
+    finished = threading.Event()
+    errors = []
+
+    def wsgi_app(environ, start_response):
+        try:
+            environ['wsgi.input'].read()
+        except IOError as e:
+            errors.append(e)
+        finally:
+            finished.set()
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [b"done"]
+
+    dispatcher.register_wsgi_application(wsgi_app, '/wsgichild', stream_request_body=True, executor_workers=1)
+
+    async def upload(port):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"POST /wsgichild/test HTTP/1.1\r\nHost: localhost\r\nContent-Length: 100000\r\n\r\n" +
+                     b"x" * 1000)
+        await writer.drain()
+        # The WSGI thread is now waiting for the rest of the body, which never comes
+        await asyncio.sleep(0.2)
+        writer.close()
+        await asyncio.sleep(0.2)
+
+    _serve(dispatcher.parent_app, upload)
+    # The thread is woken when the request is cancelled, rather than left blocked for good
+    assert finished.wait(5)
+    assert isinstance(errors[0], IOError)
+
+
+def test_wsgi_input_stream():
+    class FakeStream(object):
+        def __init__(self, chunks):
+            self.chunks = chunks
+
+        async def __aiter__(self):
+            for chunk in self.chunks:
+                yield chunk
+
+    def read_all(wsgi_input):
+        return [wsgi_input.readline(), wsgi_input.read(3), wsgi_input.readline(2), wsgi_input.readlines(),
+                wsgi_input.read()]
+
+    async def run():
+        loop = asyncio.get_event_loop()
+        wsgi_input = WsgiInputStream(FakeStream([b"ab", b"c\nde", b"fgh\n", b"ij\nk"]), loop)
+        try:
+            return await loop.run_in_executor(None, read_all, wsgi_input)
+        finally:
+            wsgi_input.close()
+
+    result = asyncio.new_event_loop().run_until_complete(run())
+    assert result == [b"abc\n", b"def", b"gh", [b"\n", b"ij\n", b"k"], b""]
+
+
+def test_wsgi_environ(dispatcher):
+    _add_parent_route(dispatcher)
+    environs = []
+
+    def wsgi_app(environ, start_response):
+        environs.append(environ)
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [b"done"]
+
+    dispatcher.register_wsgi_application(wsgi_app, '/wsgichild')
+    tester = dispatcher.parent_app.test_client
+    request, resp = tester.get("/wsgichild/test?a=1", headers={'X-Custom-Header': 'custom', 'Host': 'example.com'},
+                               gather_request=True)
+    assert resp.text == "done"
+    environ = environs[0]
+    assert environ['SCRIPT_NAME'] == '/wsgichild'
+    assert environ['PATH_INFO'] == '/test'
+    assert environ['QUERY_STRING'] == 'a=1'
+    assert environ['HTTP_X_CUSTOM_HEADER'] == 'custom'
+    assert environ['SERVER_NAME'] == 'example.com'
+    assert environ['SERVER_PORT'] == '80'
+    assert environ['HTTP_HOST'] == 'example.com'
+    assert environ['wsgi.version'] == (1, 0)
+    assert 'HTTP_CONTENT_TYPE' not in environ
+    application = dispatcher.applications['/wsgichild']
+    assert len(application.environ_templates) == 1
+    assert len(application.server_info) == 1
+
+
+needs_process_pool = pytest.mark.skipif(sys.version_info < (3, 7), reason="process_workers needs Python 3.7")
+
+
+def process_wsgi_app(environ, start_response):
+    body = environ['wsgi.input'].read()
+    if environ['PATH_INFO'] == '/slow':
+        time.sleep(1)
+    elif environ['PATH_INFO'] == '/hang':
+        time.sleep(60)
+    start_response("200 OK", [("Content-Type", "text/plain"), ("X-Multiprocess", str(environ['wsgi.multiprocess']))])
+    return [str(os.getpid()).encode(), b" ", body]
+
+
+@needs_process_pool
+def test_wsgi_process_pool(dispatcher):
+    _add_parent_route(dispatcher)
+    dispatcher.register_wsgi_application(process_wsgi_app, '/wsgichild', process_workers=1)
+    tester = dispatcher.parent_app.test_client
+    request, resp = tester.post("/wsgichild/test", data=b"payload", gather_request=True)
+    assert resp.status == 200
+    pid, body = resp.text.split(" ", 1)
+    assert int(pid) != os.getpid()
+    assert body == "payload"
+    assert resp.headers['x-multiprocess'] == "True"
+    assert dispatcher.applications['/wsgichild'].process_pool.pool is None  # shut down with the server
+
+
+@needs_process_pool
+def test_wsgi_process_pool_timeout(dispatcher):
+    _add_parent_route(dispatcher)
+    dispatcher.register_wsgi_application(process_wsgi_app, '/wsgichild', process_workers=1, process_timeout=0.2)
+    tester = dispatcher.parent_app.test_client
+    request, resp = tester.get("/wsgichild/slow", gather_request=True)
+    assert resp.status == 504
+
+
+@needs_process_pool
+def test_wsgi_process_pool_recycle():
+    async def run():
+        process_pool = WsgiProcessPool('test_wsgi:process_wsgi_app', 1, max_requests=2)
+        environ = {'PATH_INFO': '/', 'wsgi.input': None}
+        try:
+            first = await process_pool.run(environ, b"")
+            assert process_pool.pool is not None
+            second = await process_pool.run(environ, b"")
+            assert process_pool.pool is None
+            third = await process_pool.run(environ, b"")
+            return first, second, third
+        finally:
+            process_pool.shutdown()
+
+    first, second, third = asyncio.new_event_loop().run_until_complete(run())
+    assert first[0] == "200 OK"
+    assert first[2] == second[2]
+    assert first[2] != third[2]
+
+
+@needs_process_pool
+def test_wsgi_process_pool_timeout_kills_workers():
+    async def run():
+        process_pool = WsgiProcessPool('test_wsgi:process_wsgi_app', 2, timeout=0.2)
+        environ = {'PATH_INFO': '/hang', 'wsgi.input': None}
+        pools = []
+        try:
+            for _ in range(3):
+                task = asyncio.ensure_future(process_pool.run(environ, b""))
+                await asyncio.sleep(0.1)
+                pool = process_pool.pool
+                pools.append((pool, list(pool._processes.values())))
+                with pytest.raises(SanicException) as e:
+                    await task
+                assert e.value.status_code == 504
+                assert process_pool.pool is None
+            return pools
+        finally:
+            process_pool.shutdown()
+
+    pools = asyncio.new_event_loop().run_until_complete(run())
+    assert len({id(pool) for pool, processes in pools}) == 3
+    deadline = time.monotonic() + 2
+    processes = [process for pool, pool_processes in pools for process in pool_processes]
+    assert processes
+    while any(process.is_alive() for process in processes) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    # The stuck workers were killed, not left running alongside each fresh pool
+    assert not any(process.is_alive() for process in processes)